@@ -0,0 +1,168 @@
+#!/usr/bin/python3.5
+# -*- coding: utf-8 -*-
+"""
+Offline benchmark of ImageDownloader: serves synthetic shops from bench/fake_storefront.py on 127.0.0.1,
+runs either every site through ImageDownloader in this process (--engine worker)
+or the whole image_downloader.main() with its SilentProcessPool (--engine runner)
+against a local database, and reports products/sec, MB/sec, peak RSS and DB round trips.
+
+The database given by --db-* is wiped of products and sites, never point it at production.
+
+	python3 bench/benchmark.py --sites 4 --products 2000 --latency-ms 30 --set download_mode='"async"' --runs 2
+"""
+
+import argparse
+import ast
+import json
+import os
+import os.path
+import resource
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import id_config
+from fake_storefront import Catalogue, FakeStorefront
+
+
+def parse_args():
+	parser = argparse.ArgumentParser(description="Offline ImageDownloader benchmark")
+	parser.add_argument("--sites", type=int, default=2)
+	parser.add_argument("--products", type=int, default=1000, help="products per site")
+	parser.add_argument("--sizes", type=int, default=3, help="size params per product")
+	parser.add_argument("--small-kb", type=int, default=10)
+	parser.add_argument("--large-kb", type=int, default=100)
+	parser.add_argument("--latency-ms", type=float, default=0, help="mean response delay of the shops")
+	parser.add_argument("--error-rate", type=float, default=0, help="share of requests answered with 503")
+	parser.add_argument("--engine", choices=["worker", "runner"], default="worker")
+	parser.add_argument("--runs", type=int, default=1, help="runs over the same catalogue, later ones are incremental")
+	parser.add_argument("--set", action="append", default=[], metavar="NAME=VALUE",
+						help="id_config override, VALUE is a python literal")
+	parser.add_argument("--db-host", default="localhost")
+	parser.add_argument("--db-name", default="CrmBench")
+	parser.add_argument("--db-user", default=id_config.db_username)
+	parser.add_argument("--db-password", default=id_config.db_password)
+	parser.add_argument("--workdir", help="logs, images and state files, a temp dir by default")
+	parser.add_argument("--json", action="store_true", help="print one json line per run instead of text")
+	return parser.parse_args()
+
+
+def configure(args, workdir):
+	if (args.db_host, args.db_name) == (id_config.db_host, id_config.db_name):
+		sys.exit("Refusing to run the benchmark against the configured production database")
+
+	id_config.db_host = args.db_host
+	id_config.db_name = args.db_name
+	id_config.db_username = args.db_user
+	id_config.db_password = args.db_password
+	id_config.base_path = os.path.join(workdir, "images")
+	id_config.metrics_file = os.path.join(workdir, "metrics.prom")
+
+	for override in args.set:
+		name, value = override.split("=", 1)
+		if not hasattr(id_config, name):
+			sys.exit("Unknown config setting {}".format(name))
+		setattr(id_config, name, ast.literal_eval(value))
+
+
+def prepare_db(site_names):
+	import id_db
+
+	id_db.connect(id_config.db_username, id_config.db_password, id_config.db_host, id_config.db_name)
+	try:
+		id_db.create_db()
+		id_db.upgrade_db()
+		id_db.session.query(id_db.FeedProdStore).delete()
+		id_db.session.query(id_db.FeedStore).delete()
+		id_db.session.query(id_db.Site).delete()
+		for name in site_names:
+			id_db.session.add(id_db.Site(name=name, user_load="benchmark"))
+		id_db.session.commit()
+	finally:
+		id_db.disconnect()
+
+
+def counter_totals(prom_text):
+	totals = {}
+	for line in prom_text.splitlines():
+		if line.startswith("#") or not line.strip():
+			continue
+		name_labels, value = line.rsplit(" ", 1)
+		name = name_labels.split("{", 1)[0]
+		totals[name] = totals.get(name, 0) + float(value)
+	return totals
+
+
+def run_once(args, site_names):
+	# imported after configure() as these modules read id_config on import
+	import id_worker
+	import image_downloader
+	from id_metrics import metrics
+
+	metrics.reset()
+	started = time.monotonic()
+
+	if args.engine == "worker":
+		for site_name in site_names:
+			id_worker.ImageDownloader(site_name, id_config.base_path).run()
+		metrics.write(id_config.metrics_file)
+	else:
+		image_downloader.main()
+
+	elapsed = time.monotonic() - started
+
+	with open(id_config.metrics_file, encoding="utf8") as f:
+		return elapsed, counter_totals(f.read())
+
+
+def main():
+	args = parse_args()
+	workdir = args.workdir or tempfile.mkdtemp(prefix="id_bench_")
+	os.makedirs(workdir, exist_ok=True)
+	configure(args, workdir)
+	os.chdir(workdir)
+
+	catalogue = Catalogue(args.products, args.small_kb * 1024, args.large_kb * 1024, args.sizes, int(time.time()))
+	shops = [FakeStorefront(catalogue, latency=args.latency_ms / 1000.0, error_rate=args.error_rate).start()
+			 for _ in range(args.sites)]
+	site_names = [shop.site_name for shop in shops]
+
+	try:
+		prepare_db(site_names)
+
+		for run in range(1, args.runs + 1):
+			served_before = sum(shop.stats.bytes for shop in shops)
+			elapsed, totals = run_once(args, site_names)
+			served = sum(shop.stats.bytes for shop in shops) - served_before
+
+			products = args.sites * args.products
+			result = {
+				"run": run,
+				"engine": args.engine,
+				"seconds": round(elapsed, 3),
+				"products_per_sec": round(products / elapsed, 1),
+				"mb_per_sec": round(served / elapsed / 1048576, 2),
+				"requests": int(totals.get("image_downloader_http_requests_total", 0)),
+				"db_round_trips": int(totals.get("image_downloader_db_round_trips_total", 0)),
+				"peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0, 1),
+				"peak_child_rss_mb": round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024.0, 1),
+			}
+
+			if args.json:
+				print(json.dumps(result, sort_keys=True))
+			else:
+				print("run {run} ({engine}): {seconds}s, {products_per_sec} products/s, {mb_per_sec} MB/s, "
+					  "{requests} requests, {db_round_trips} DB round trips, "
+					  "peak RSS {peak_rss_mb} MB (largest worker process {peak_child_rss_mb} MB)".format(**result))
+	finally:
+		for shop in shops:
+			shop.stop()
+
+	if not args.json:
+		print("Work dir: {}".format(workdir))
+
+
+if __name__ == "__main__":
+	main()
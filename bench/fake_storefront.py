@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+"""
+Local stand-in for a shop serving feedxml_crm.php, its ?code= product info variant and product images.
+The catalogue is synthetic and deterministic: the same arguments always give the same feed and images.
+"""
+
+import base64
+import hashlib
+import http.server
+import random
+import socketserver
+import threading
+import time
+from urllib.parse import urlparse, parse_qs
+
+
+# 8x8 grey baseline JPEG made by Pillow, the images are this padded with comments to their size
+JPEG = base64.b64decode(
+	"/9j/4AAQSkZJRgABAQAAAQABAAD/2wBDABALDA4MChAODQ4SERATGCgaGBYWGDEjJR0oOjM9PDkzODdASFxOQERXRTc4UG1RV19i"
+	"Z2hnPk1xeXBkeFxlZ2P/wAALCAAIAAgBAREA/8QAHwAAAQUBAQEBAQEAAAAAAAAAAAECAwQFBgcICQoL/8QAtRAAAgEDAwIEAwUF"
+	"BAQAAAF9AQIDAAQRBRIhMUEGE1FhByJxFDKBkaEII0KxwRVS0fAkM2JyggkKFhcYGRolJicoKSo0NTY3ODk6Q0RFRkdISUpTVFVW"
+	"V1hZWmNkZWZnaGlqc3R1dnd4eXqDhIWGh4iJipKTlJWWl5iZmqKjpKWmp6ipqrKztLW2t7i5usLDxMXGx8jJytLT1NXW19jZ2uHi"
+	"4+Tl5ufo6erx8vP09fb3+Pn6/9oACAEBAAA/ACv/2Q==")
+
+# end of the JFIF header, the comments go after it
+JFIF_END = 20
+
+# longest comment of a JPEG segment
+COMMENT_MAX = 65533
+
+
+class Catalogue:
+	def __init__(self, products, small_image_size, large_image_size, sizes_per_product, timestamp):
+		self.products = products
+		self.small_image_size = small_image_size
+		self.large_image_size = large_image_size
+		self.sizes_per_product = sizes_per_product
+		self.timestamp = timestamp
+
+	@staticmethod
+	def product_xml(i):
+		return ("<product><code>p{0}</code><avalible>true</avalible><name>Product {0}</name><url>/product/{0}</url>"
+				"<price>{1}</price><price_old>{2}</price_old><currency>RUB</currency>"
+				"<img_small>/img/small/{0}.jpg</img_small><img_large>/img/large/{0}.jpg</img_large></product>"
+				.format(i, 100 + i % 900, 120 + i % 900))
+
+	def feed(self):
+		yield '<?xml version="1.0" encoding="utf-8"?>\n<root timestamp="{}"><products>'.format(self.timestamp).encode()
+		for i in range(self.products):
+			yield self.product_xml(i).encode()
+		yield b"</products></root>"
+
+	def product_info(self, code):
+		i = int(code.strip("'")[1:])
+		if i >= self.products:
+			return b"<root><products></products></root>"
+
+		params = "".join('<param name="{}" avalible="{}" price="{}"/>'.format(size, "true" if (i + n) % 3 else "false",
+																			   100 + i % 900 + n)
+						 for n, size in enumerate(["XS", "S", "M", "L", "XL", "XXL"][:self.sizes_per_product]))
+		return "<root><products>{}</products></root>".format(
+			self.product_xml(i).replace("</product>", "<params>{}</params></product>".format(params))).encode()
+
+	def image(self, path):
+		"""
+		A JPEG that decodes, of the size of the small or large images up to 3 bytes,
+		different for every path so that the stored images differ too
+		"""
+		size = self.large_image_size if "/large/" in path else self.small_image_size
+		seed = hashlib.md5(path.encode()).digest()
+
+		comments = []
+		padding = size - len(JPEG)
+		while padding >= 4:
+			length = min(padding - 4, COMMENT_MAX)
+			comments.append(b"\xff\xfe" + (length + 2).to_bytes(2, "big") + (seed * (length // len(seed) + 1))[:length])
+			padding -= length + 4
+		return JPEG[:JFIF_END] + b"".join(comments) + JPEG[JFIF_END:]
+
+
+class Stats:
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.requests = 0
+		self.errors = 0
+		self.bytes = 0
+
+	def add(self, size, error=False):
+		with self.lock:
+			self.requests += 1
+			self.errors += 1 if error else 0
+			self.bytes += size
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+	daemon_threads = True
+
+
+def make_handler(catalogue, stats, latency, error_rate):
+	class Handler(http.server.BaseHTTPRequestHandler):
+		protocol_version = "HTTP/1.1"
+
+		def log_message(self, format, *args):
+			pass
+
+		def send_body(self, body, content_type):
+			etag = '"{}"'.format(hashlib.md5(body).hexdigest())
+			if self.headers.get("If-None-Match") == etag:
+				self.send_response(304)
+				self.send_header("ETag", etag)
+				self.end_headers()
+				stats.add(0)
+				return
+
+			self.send_response(200)
+			self.send_header("Content-Type", content_type)
+			self.send_header("Content-Length", str(len(body)))
+			self.send_header("ETag", etag)
+			self.end_headers()
+			self.wfile.write(body)
+			stats.add(len(body))
+
+		def do_GET(self):
+			if latency:
+				time.sleep(random.uniform(latency / 2, latency * 3 / 2))
+
+			if error_rate and random.random() < error_rate:
+				self.send_response(503)
+				self.send_header("Content-Length", "0")
+				self.end_headers()
+				stats.add(0, error=True)
+				return
+
+			url = urlparse(self.path)
+			if url.path == "/feedxml_crm.php" and "code" in parse_qs(url.query):
+				self.send_body(catalogue.product_info(parse_qs(url.query)["code"][0]), "text/xml")
+			elif url.path == "/feedxml_crm.php":
+				self.send_body(b"".join(catalogue.feed()), "text/xml")
+			elif url.path.startswith("/img/"):
+				self.send_body(catalogue.image(url.path), "image/jpeg")
+			else:
+				self.send_response(404)
+				self.send_header("Content-Length", "0")
+				self.end_headers()
+				stats.add(0, error=True)
+
+	return Handler
+
+
+class FakeStorefront:
+	"""
+	One fake shop listening on 127.0.0.1:port in a background thread, its site name is "127.0.0.1:port".
+	latency is the mean response delay in seconds, error_rate the share of requests answered with 503.
+	"""
+
+	def __init__(self, catalogue, port=0, latency=0.0, error_rate=0.0):
+		self.stats = Stats()
+		self.server = ThreadingHTTPServer(("127.0.0.1", port), make_handler(catalogue, self.stats, latency, error_rate))
+		self.thread = threading.Thread(target=self.server.serve_forever, name="storefront")
+		self.thread.daemon = True
+
+	@property
+	def site_name(self):
+		return "127.0.0.1:{}".format(self.server.server_address[1])
+
+	def start(self):
+		self.thread.start()
+		return self
+
+	def stop(self):
+		self.server.shutdown()
+		self.server.server_close()
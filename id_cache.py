@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+
+import json
+import os.path
+import threading
+
+from id_storage import write_atomic
+
+
+NOT_MODIFIED = object()
+
+
+class ValidatorCache:
+	"""
+	ETag, Last-Modified and content length of the urls of a site and the feed timestamp of its last completed run,
+	kept in a json file. It is only saved after a completed run, so a 304 for a url means
+	that whatever was made of its previous response is already stored.
+	"""
+
+	def __init__(self, filename):
+		self.filename = filename
+		self.lock = threading.Lock()
+		self.feed_timestamp = None
+		self.entries = {}
+
+		if os.path.exists(filename):
+			with open(filename, encoding="utf8") as f:
+				data = json.load(f)
+			self.feed_timestamp = data["feed_timestamp"]
+			self.entries = data["urls"]
+
+	def headers(self, url):
+		entry = self.entries.get(url)
+		if entry is None:
+			return {}
+
+		etag, last_modified, length = entry
+		headers = {}
+		if etag:
+			headers["If-None-Match"] = etag
+		if last_modified:
+			headers["If-Modified-Since"] = last_modified
+		return headers
+
+	def length(self, url):
+		entry = self.entries.get(url)
+		return entry[2] if entry else None
+
+	def update(self, url, headers, length=None):
+		etag = headers.get("ETag")
+		last_modified = headers.get("Last-Modified")
+
+		with self.lock:
+			if etag or last_modified:
+				self.entries[url] = [etag, last_modified, length]
+			else:
+				self.entries.pop(url, None)
+
+	def save(self):
+		with self.lock:
+			data = json.dumps({"feed_timestamp": self.feed_timestamp, "urls": self.entries})
+
+		write_atomic(self.filename, [data.encode("utf8")])
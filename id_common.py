@@ -1,44 +1,234 @@
 # -*- coding: utf-8 -*-
 
-from lxml import etree
 import logging
+import logging.handlers
+import multiprocessing as mp
+import multiprocessing.connection
+import os
+import threading
 
+from id_config import log_mode, log_product_every
 
-def get_child(element, tag_name):
-	logger = logging.getLogger()
 
-	try:
-		el = element.find(tag_name)
-		if el is None:
-			return None
-		else:
-			return el.text
-	except etree.LxmlError as e:
-		logger.warning("Cannot get {} from xml".format(tag_name))
-		logger.exception("Error getting '{}' from xml".format(tag_name))
+def to_bool(text):
+	return True if text == "true" else False
+
+
+LOG_FORMAT = '%(asctime)s %(name)-12s %(levelname)-8s %(message)s'
+
+# extra= of the messages logged for every product, they are sampled by ProductSampler
+PER_PRODUCT = {"per_product": True}
+
+# set by start_log_listener in the runner and by init_worker_process in the pool processes,
+# the LogPipe the records of the process are sent through
+log_queue = None
+
+# the LogListener of the runner, it gives every pool process a pipe of its own
+log_listener = None
+
+
+class LogContext(logging.Filter):
+	"""
+	Adds the log file and the site the process works on to every record
+	"""
+
+	def __init__(self, filename, site=None):
+		super().__init__()
+		self.filename = filename
+		self.site = site
+
+	def filter(self, record):
+		record.log_file = self.filename
+		record.site = self.site
+		return True
+
+
+class ProductSampler(logging.Filter):
+	"""
+	Passes one of every `every` INFO and DEBUG records logged with extra=PER_PRODUCT, all other records
+	"""
+
+	def __init__(self, every):
+		super().__init__()
+		self.every = every
+		self.lock = threading.Lock()
+		self.count = 0
+
+	def filter(self, record):
+		if self.every <= 1 or record.levelno >= logging.WARNING or not getattr(record, "per_product", False):
+			return True
+
+		with self.lock:
+			self.count += 1
+			return self.count % self.every == 1
+
+
+class FileRouter(logging.Handler):
+	"""
+	Handler of the log listener: writes every record to the rotating file named by its log_file,
+	all the files are written by the one listener thread
+	"""
+
+	def __init__(self):
+		super().__init__()
+		self.files = {}
+
+	def emit(self, record):
+		handler = self.files.get(record.log_file)
+		if handler is None:
+			handler = self.files[record.log_file] = logging.handlers.RotatingFileHandler(
+				record.log_file, maxBytes=1048576, backupCount=20, encoding='utf8')
+			handler.setFormatter(logging.Formatter(LOG_FORMAT))
+		handler.handle(record)
+
+	def close(self):
+		for handler in self.files.values():
+			handler.close()
+		super().close()
+
+
+class LogPipe:
+	"""
+	The writing end of the log pipe of one process, the queue of its logging.handlers.QueueHandler.
+	The handler sends one record at a time. Processes forked from the process, which cannot send
+	into its pipe along with it, write their warnings to stderr.
+	"""
+
+	def __init__(self, connection):
+		self.connection = connection
+		self.pid = os.getpid()
+
+	def put_nowait(self, record):
+		if os.getpid() == self.pid:
+			self.connection.send(record)
+		elif record.levelno >= logging.lastResort.level:
+			logging.lastResort.handle(record)
+
+
+class LogListener:
+	"""
+	Thread writing the log records the processes send to handler. Every process sends them through
+	a pipe of its own: a process killed while it puts a record into a shared queue keeps the lock
+	of the queue and stops the logging of all the others. The pipe of a process is dropped once
+	the process is gone.
+	"""
+
+	def __init__(self, handler):
+		self.handler = handler
+		self.readers = []
+		self.lock = threading.Lock()
+		# wakes the thread up to wait for a new pipe too (False) or to stop (True)
+		self.wakeup, self.waker = mp.Pipe(duplex=False)
+		self.thread = None
+
+	def pipe(self):
+		"""
+		Writing end of a new pipe for a process, close it in this process once the process is started
+		"""
+		reader, writer = mp.Pipe(duplex=False)
+		with self.lock:
+			self.readers.append(reader)
+		self.waker.send(False)
+		return writer
+
+	def start(self):
+		self.thread = threading.Thread(target=self.run, name="log-listener", daemon=True)
+		self.thread.start()
+
+	def run(self):
+		while True:
+			with self.lock:
+				readers = list(self.readers)
+			for reader in mp.connection.wait(readers + [self.wakeup]):
+				if reader is not self.wakeup:
+					self.receive(reader)
+				elif self.wakeup.recv():
+					# what was sent before the stop
+					with self.lock:
+						readers = list(self.readers)
+					for reader in readers:
+						self.receive(reader)
+					return
+
+	def receive(self, reader):
+		try:
+			while reader.poll():
+				self.handler.handle(reader.recv())
+		except (EOFError, OSError):
+			# the process is gone
+			with self.lock:
+				self.readers.remove(reader)
+			reader.close()
+
+	def stop(self):
+		self.waker.send(True)
+		self.thread.join()
+
+
+def start_log_listener():
+	"""
+	With log_mode "queue" starts the thread writing the log records of this process and of the pool processes,
+	which only send them to it, see log_pipe. Returns the listener to stop() at exit, None otherwise.
+	"""
+	global log_queue
+	global log_listener
+
+	if log_mode != "queue":
 		return None
 
+	log_listener = LogListener(FileRouter())
+	log_listener.start()
+	log_queue = LogPipe(log_listener.pipe())
+	return log_listener
 
-def to_bool(text):
-	return True if text == "true" else False
+
+def log_pipe():
+	"""
+	Writing end of the log pipe of a new pool process, None if log_mode is not "queue"
+	"""
+	return log_listener.pipe() if log_listener else None
 
 
-def init_logger(filename):
+def init_logger(filename, site=None):
 	from logging.config import dictConfig
 
+	if log_queue is not None:
+		handler = logging.handlers.QueueHandler(log_queue)
+		handler.addFilter(ProductSampler(log_product_every))
+		handler.addFilter(LogContext(filename, site))
+
+		root = logging.getLogger()
+		for old in root.handlers[:]:
+			root.removeHandler(old)
+			old.close()
+		root.addHandler(handler)
+		root.setLevel(logging.INFO)
+		return
+
 	logging_config = {
 		'version': 1,
 		'disable_existing_loggers': False,
 		'formatters': {
 			'f': {
-				'format':
-					'%(asctime)s %(name)-12s %(levelname)-8s %(message)s'
+				'format': LOG_FORMAT
+			}
+		},
+		'filters': {
+			'sample': {
+				'()': ProductSampler,
+				'every': log_product_every
+			},
+			'context': {
+				'()': LogContext,
+				'filename': filename,
+				'site': site
 			}
 		},
 		'handlers': {
 			'h': {
 				'class': 'logging.handlers.RotatingFileHandler',
 				'formatter': 'f',
+				'filters': ['sample', 'context'],
 				'level': 'DEBUG',
 				'filename': filename,
 				'maxBytes': 1048576,
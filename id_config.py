@@ -5,7 +5,23 @@ db_password = ""
 db_host = "localhost"
 db_name = "Crm"
 
-crawl_delay = 0.15
+rate_start = 6.0  # requests/second to a host at the start of a site run, adjusted as the host responds, see id_ratelimit
+
+rate_min = 0.5  # requests/second, the rate to a host is never cut below this
+
+rate_max = 50.0  # requests/second, the rate to a host never grows above this
+
+site_rate_limits = {}  # site name -> (min, max) requests/second, overrides rate_min and rate_max for the hosts of the site
+
+rate_burst = 1.0  # requests a host may get at once after being idle
+
+rate_increase = 1.0  # requests/second, the rate of a healthy host grows by about this every second
+
+rate_decrease = 0.5  # the rate is multiplied by this on a 429 or 503, a timeout or a connection error
+
+rate_slow_latency = 5.0  # seconds, an average response time above this is treated as overload too
+
+rate_retry_after_max = 300  # seconds, longer Retry-After values are cut to this
 
 base_path = "i:/crm_root"  # do NOT include trailing "/"
 
@@ -15,3 +31,158 @@ runner_log_name = 'errors_runner.log'
 
 base_worker_logger_name = "errors_worker_"
 
+download_mode = "sync"  # "sync" - one request at a time, "async" - asyncio engine with several requests in flight,
+# "pipeline" - feed, images, product info and DB writes run as separate stages at the same time
+
+async_concurrency = 8  # requests in flight per site in "async" mode
+
+http_pool_size = 8  # keep-alive connections per site, should be >= async_concurrency
+
+http_connect_timeout = 10  # seconds
+
+http_read_timeout = 60  # seconds
+
+http_retries = 3  # retries of a failed GET on top of the first attempt
+
+http_backoff_base = 0.5  # seconds, backoff before retry N is random in [0, base * 2^N]
+
+http_backoff_max = 30  # seconds, cap of a single backoff
+
+http_retry_statuses = (429, 500, 502, 503, 504)
+
+feed_streaming = False  # parse the product list with iterparse while it is downloaded instead of loading it whole
+
+http_chunk_size = 65536  # bytes, images are streamed to disk in chunks of this size
+
+image_fsync = "never"  # "never", "file" - fsync every image before renaming it into place, "dir" - also fsync its directory
+
+db_bulk_writes = False  # buffer product rows and write them in batches instead of one transaction per row
+
+db_batch_size = 1000  # rows buffered before a batch is written
+
+db_flush_interval = 10  # seconds, a batch is written at least this often
+
+pipeline_image_workers = 4  # threads downloading images in "pipeline" mode
+
+pipeline_info_workers = 4  # threads getting product info in "pipeline" mode
+
+pipeline_queue_size = 100  # items waiting in front of each stage in "pipeline" mode
+
+pipeline_report_interval = 60  # seconds, how often the stage queue depths are logged
+
+schedule_by_cost = True  # start the sites that took longest last time first, otherwise in DB order
+
+site_stats_file = 'site_stats.json'  # duration and product count of the last run of every site
+
+http_cache = False  # send If-None-Match / If-Modified-Since and skip what did not change since the last completed run
+
+http_cache_dir = 'http_cache'  # one json file of validators per site
+
+image_store = "plain"  # "plain" - images are files under base_path/site, "cas" - files there are links to blobs named by their sha256
+# (local storage_backend only, images are written as they are downloaded)
+
+cas_dir = ".cas"  # directory of the blobs in base_path, has to be on the same volume as base_path for hard links
+
+cas_link = "hard"  # "hard" or "symbolic"
+
+cas_spool_size = 1048576  # bytes, images up to this size are hashed in memory before anything is written
+
+checkpoints = False  # journal completed product stages so that an interrupted site run resumes where it stopped
+
+checkpoint_dir = '.checkpoints'  # directory of the journals in base_path, one per site, removed when the site run completes
+
+metrics_file = 'image_downloader.prom'  # Prometheus text file (node_exporter textfile collector), rewritten after every site
+
+job_lease = 300  # seconds, distributed mode: a running job not heartbeated for this long is given to another node
+
+job_heartbeat_interval = 60  # seconds, distributed mode: how often a node extends the lease of its running jobs
+
+job_max_attempts = 3  # distributed mode: a job that failed or whose node died this many times is marked failed
+
+job_poll_interval = 30  # seconds, distributed mode: how often an idle node checks for jobs released by dead nodes
+
+daemon_min_interval = 900  # seconds, daemon mode: shortest refresh interval of a site, for sites changing on every run
+
+daemon_max_interval = 86400  # seconds, daemon mode: longest refresh interval of a site, for sites that do not change
+
+daemon_start_interval = 3600  # seconds, daemon mode: refresh interval of a site seen for the first time
+
+daemon_sites_refresh = 600  # seconds, daemon mode: how often the site list is reread from DB
+
+image_check = False  # verify every downloaded image on image_check_workers processes and drop the ones that are not images
+
+image_check_workers = 2  # processes per site worker checking images, decoding is CPU bound
+
+image_check_queue = 16  # downloaded images waiting for their check at most, a download waits for room beyond that
+
+image_max_side = 0  # pixels, larger images are downscaled to fit (needs Pillow), 0 - keep the size
+
+image_reencode = False  # re-encode JPEGs with image_jpeg_quality when that makes them smaller (needs Pillow)
+
+image_jpeg_quality = 85
+
+log_mode = "file"  # "file" - every process writes its log files itself, "queue" - pool processes send log records
+# to one listener thread of the runner that writes all the files
+
+log_product_every = 1  # only one of this many per-product INFO messages is logged, 1 - all of them
+
+pool_start_method = "fork"  # how the pool processes are started: "fork" or "forkserver" - from a server process
+# that has pool_preload imported already. forkserver processes see this file as it is, not values changed at runtime
+
+pool_preload = ["lxml.etree", "requests", "sqlalchemy", "psycopg2", "id_worker"]  # modules the fork server imports
+
+db_pool_size = 2  # connections kept by the DB engine of a process, it lives as long as the process
+
+shard_products = 0  # sites with more products than this in DB are split into shards of about this many products
+# that several pool processes run at the same time, 0 - sites are never split
+
+site_shards = {}  # site name -> number of shards, overrides shard_products
+
+spool_dir = 'feed_spool'  # product lists of the split sites, parsed once and shared by their shards during a run
+
+storage_backend = "local"  # where images are stored: "local" - files under base_path,
+# "s3" - objects in storage_bucket of an S3 compatible storage (needs boto3), keyed by the path under base_path
+
+storage_bucket = ""
+
+storage_endpoint = None  # url of the S3 compatible storage, e.g. "http://127.0.0.1:9000" for MinIO, None - AWS S3
+
+storage_prefix = ""  # prepended to the keys of the images in storage_bucket
+
+storage_write_behind = False  # images are written by storage_workers threads while the downloads go on,
+# the DB rows of a product are written once its images are stored. Local files are then fsynced with their directory
+# whatever image_fsync is, a row is not written for an image a crash could still lose
+
+storage_workers = 8  # threads writing images in storage_write_behind mode
+
+storage_queue_bytes = 67108864  # bytes of the images waiting to be written at most, downloads wait for room beyond that
+
+retry_failed = False  # keep the failed image downloads and product info requests in the retry_queue table
+# and try them again at the start of the next runs
+
+retry_delay = 3600  # seconds before the first retry of a failed item, doubled after every failure
+
+retry_max_delay = 604800  # seconds, longest wait between the retries of an item
+
+retry_max_attempts = 8  # failures in a row after which an item is given up
+
+retry_batch = 1000  # due items retried at most at the start of a run, the rest wait for the next runs
+
+profile = None  # profile the site runs: "cprofile" - every call, slows the run down, "sampling" - the stacks of all
+# threads every profile_interval seconds, low overhead; None - off. The --profile option overrides it
+
+profile_sites = []  # sites profiled when profile is on, empty - all of them. The --profile-sites option overrides it
+
+profile_interval = 0.005  # seconds between the stack samples of "sampling"
+
+profile_dir = '.'  # where the profiles of the sites are written, next to the log files:
+# <site>.prof of "cprofile" for pstats or snakeviz, <site>.folded collapsed stacks of "sampling" for flamegraph.pl
+
+image_resume = False  # keep the partial downloads of large images and continue them with Range requests
+# on the retries of the request and in the next runs
+
+image_resume_min_size = 1048576  # bytes, images at least this large (by Content-Length) are downloaded to part files
+
+image_part_dir = '.parts'  # directory of the partial downloads in base_path, one directory in it per site or shard
+
+image_part_max_age = 7  # days, partial downloads not continued for longer are removed when the site is run
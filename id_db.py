@@ -1,14 +1,17 @@
 # -*- coding: utf-8 -*-
 
-from sqlalchemy import Column, ForeignKey, Integer, String, Boolean, BigInteger, Text, TIMESTAMP, text, Numeric
+from sqlalchemy import Column, ForeignKey, Integer, String, Boolean, BigInteger, Text, TIMESTAMP, text, Numeric, Float, Index
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, func, event, inspect
 from sqlalchemy.orm import sessionmaker
 
-from id_common import get_child, to_bool
+from id_metrics import metrics
+from id_config import db_pool_size
 
 import datetime
+import io
+import time
 
 Base = declarative_base()
 
@@ -46,6 +49,10 @@ class FeedStore(Base):
 	path_img_small = Column(Text)  								# путь к малой картинке в файловой системе
 	path_img_large = Column(Text)  								# путь к большой картинке в файловой системе
 	user_load = Column(Text)
+	hash_img_small = Column(Text)								# sha256 малой картинки
+	hash_img_large = Column(Text)								# sha256 большой картинки
+	status_img_small = Column(Text)								# проверка малой картинки: ok, normalised, invalid
+	status_img_large = Column(Text)								# проверка большой картинки
 
 
 # табличка с данными по размерам продукта
@@ -69,17 +76,69 @@ class FeedProdStore(Base):
 	param_price_old = Column(Numeric)							# its old price
 
 
+# задания распределённого обхода, см. id_jobqueue
+class CrawlJob(Base):
+	__tablename__ = 'crawl_job'
+	__table_args__ = (Index('crawl_job_run_status', 'run_id', 'status'),)
+
+	id = Column(Integer, nullable=False, primary_key=True)
+	run_id = Column(Text, nullable=False)										# обход, к которому относится задание
+	site = Column(Text, nullable=False)											# сайт наименование
+	shard = Column(Integer, nullable=False, server_default=text('0'))			# часть товаров сайта
+	shard_count = Column(Integer, nullable=False, server_default=text('1'))		# на сколько частей разбит сайт
+	status = Column(Text, nullable=False, server_default=text("'queued'"))		# queued, running, done, failed
+	cost = Column(Float)														# ожидаемая длительность, секунды
+	attempts = Column(Integer, nullable=False, server_default=text('0'))
+	node = Column(Text)															# узел, который выполняет задание
+	lease_until = Column(TIMESTAMP)												# после этого времени задание может забрать другой узел
+	heartbeat_at = Column(TIMESTAMP)
+	created_at = Column(TIMESTAMP, server_default=text('NOW()'))
+	finished_at = Column(TIMESTAMP)
+	result = Column(Text)														# json со статистикой выполнения
+
+
+# неудачные загрузки картинок и информации о товаре, которые повторяются в следующих запусках, см. id_retry
+class RetryItem(Base):
+	__tablename__ = 'retry_queue'
+	__table_args__ = (Index('retry_queue_site_code_stage', 'site', 'code', 'stage', unique=True),)
+
+	id = Column(Integer, nullable=False, primary_key=True)
+	site = Column(Text, nullable=False)											# сайт наименование
+	code = Column(Text, nullable=False)											# Код
+	stage = Column(Text, nullable=False)										# images, info
+	attempts = Column(Integer, nullable=False, server_default=text('0'))		# неудачных попыток подряд
+	next_attempt_at = Column(TIMESTAMP)											# не раньше этого времени, NULL - попытки прекращены
+	last_error = Column(Text)
+	created_at = Column(TIMESTAMP, server_default=text('NOW()'))
+
+
 engine = None
+engine_url = None
 DBSession = None
 session = None
 
+# keep the engine and its connections between disconnect() and the next connect() of the process
+persistent = False
+
+
+def db_url(db_username, db_password, db_host, db_name):
+	return 'postgresql://{}:{}@{}/{}'.format(db_username, db_password, db_host, db_name)
+
 
 def connect(db_username, db_password, db_host, db_name):
 	global engine
 	global DBSession
 	global session
+	global engine_url
 
-	engine = create_engine('postgresql://{}:{}@{}/{}'.format(db_username, db_password, db_host, db_name))
+	url = db_url(db_username, db_password, db_host, db_name)
+	if persistent and engine is not None and engine_url == url:
+		session = DBSession()
+		return
+
+	engine = create_engine(url, pool_size=db_pool_size)
+	engine_url = url
+	count_round_trips(engine)
 
 	Base.metadata.bind = engine
 
@@ -88,172 +147,360 @@ def connect(db_username, db_password, db_host, db_name):
 	session = DBSession()
 
 
+def count_round_trips(engine):
+	def on_statement(conn, cursor, statement, parameters, context, executemany):
+		metrics.inc("db_round_trips_total", kind="statement")
+
+	def on_commit(conn):
+		metrics.inc("db_round_trips_total", kind="commit")
+
+	event.listen(engine, "before_cursor_execute", on_statement)
+	event.listen(engine, "commit", on_commit)
+
+
 def disconnect():
 	global engine
 	global DBSession
 	global session
 
 	session.close()
+	session = None
+	if persistent:
+		return
+
 	engine.dispose()
 
-	session = None
 	DBSession = None
 	engine = None
 
 
+# columns and tables added to the models after the tables were created in production
+UPGRADE_COLUMNS = [
+	FeedStore.__table__.c.hash_img_small,
+	FeedStore.__table__.c.hash_img_large,
+	FeedStore.__table__.c.status_img_small,
+	FeedStore.__table__.c.status_img_large,
+]
+
+UPGRADE_TABLES = [
+	CrawlJob.__table__,
+	RetryItem.__table__,
+]
+
+
 def create_db():
 	Base.metadata.create_all(engine)
 
 
+def missing_upgrades():
+	"""
+	The UPGRADE_TABLES and UPGRADE_COLUMNS the database does not have yet, as "table" and "table.column".
+	Read from the catalog, so it takes no locks
+	"""
+	inspector = inspect(engine)
+	tables = set(inspector.get_table_names())
+
+	missing = [table.name for table in UPGRADE_TABLES if table.name not in tables]
+	columns = {}
+	for column in UPGRADE_COLUMNS:
+		table = column.table.name
+		if table not in columns:
+			columns[table] = set(c["name"] for c in inspector.get_columns(table)) if table in tables else set()
+		if column.name not in columns[table]:
+			missing.append("{}.{}".format(table, column.name))
+	return missing
+
+
+def upgrade_db():
+	"""
+	Creates the tables and adds the columns missing_upgrades() reports. ALTER TABLE locks the table
+	and has to be run by its owner, so this is a step of its own (image_downloader.py --upgrade-db),
+	not a part of every run
+	"""
+	missing = missing_upgrades()
+	Base.metadata.create_all(engine, tables=UPGRADE_TABLES)
+
+	for column in UPGRADE_COLUMNS:
+		if "{}.{}".format(column.table.name, column.name) in missing:
+			session.execute(text("ALTER TABLE {} ADD COLUMN IF NOT EXISTS {} {}".format(
+				column.table.name, column.name, column.type.compile(engine.dialect))))
+	session.commit()
+	return missing
+
+
 def get_sites():
 	return session.query(Site).all()
 
 
-def get_product_codes_for_site(site_name):
-	return session.query(FeedStore.code).filter_by(site=site_name).all()
+def get_product_counts():
+	return dict(session.query(FeedStore.site, func.count(FeedStore.id)).group_by(FeedStore.site).all())
 
 
-def store_product_data(site_name, product, xml_timestamp, small_img_path, large_img_path):
-	code = get_child(product, "code")
-	db_prod = session.query(FeedStore).filter_by(site=site_name, code=code).first()
+def get_product_index_rows(site_name):
+	return session.query(FeedStore.code, FeedStore.available, FeedStore.name, FeedStore.url,
+						 FeedStore.price, FeedStore.price_old, FeedStore.currency,
+						 FeedStore.img_small, FeedStore.img_large,
+						 FeedStore.path_img_small, FeedStore.path_img_large)\
+				  .filter_by(site=site_name)\
+				  .all()
+
+
+def get_retry_items(site_name):
+	return session.query(RetryItem.code, RetryItem.stage, RetryItem.attempts, RetryItem.next_attempt_at)\
+				  .filter_by(site=site_name)\
+				  .all()
+
+
+def get_retry_products(site_name, codes, chunk_size=1000):
+	"""
+	FeedStore rows of the codes with the product fields and time_xml
+	"""
+	rows = []
+	for i in range(0, len(codes), chunk_size):
+		rows += session.query(FeedStore.code, FeedStore.available, FeedStore.name, FeedStore.url,
+							  FeedStore.price, FeedStore.price_old, FeedStore.currency,
+							  FeedStore.img_small, FeedStore.img_large, FeedStore.time_xml)\
+					   .filter(FeedStore.site == site_name, FeedStore.code.in_(codes[i:i + chunk_size]))\
+					   .all()
+	return rows
+
+
+def save_retry_items(site_name, failed, recovered):
+	"""
+	failed: dicts of code, stage, attempts, next_attempt_at, last_error of the items to add or update,
+	recovered: (code, stage) of the items to remove
+	"""
+	with metrics.timer("db_write_seconds", site=site_name, op="retries"):
+		for code, stage in recovered:
+			session.query(RetryItem).filter_by(site=site_name, code=code, stage=stage).delete(synchronize_session=False)
+
+		for item in failed:
+			updated = session.query(RetryItem)\
+				.filter_by(site=site_name, code=item["code"], stage=item["stage"])\
+				.update(item, synchronize_session=False)
+			if not updated:
+				session.add(RetryItem(site=site_name, **item))
 
-	if not db_prod:
-		db_prod = FeedStore(available=to_bool(get_child(product, "avalible")),
-							code=code,
-							name=get_child(product, "name"),
-							url=get_child(product, "url"),
-							price=int(get_child(product, "price")),
-							price_old=int(get_child(product, "price_old")),
-							currency=get_child(product, "currency"),
-							img_small=get_child(product, "img_small"),
-							img_large=get_child(product, "img_large"),
-							site=site_name,
-							time_xml=xml_timestamp,
-							path_img_small=small_img_path,
-							path_img_large=large_img_path)
-		session.add(db_prod)
 		session.commit()
+
+
+def mark_products_unavailable(site_name, codes, chunk_size=1000):
+	with metrics.timer("db_write_seconds", site=site_name, op="mark_unavailable"):
+		_mark_products_unavailable(site_name, codes, chunk_size)
+
+
+def _mark_products_unavailable(site_name, codes, chunk_size):
+	for i in range(0, len(codes), chunk_size):
+		chunk = codes[i:i + chunk_size]
+		for table in (FeedStore, FeedProdStore):
+			session.query(table)\
+				.filter(table.site == site_name, table.code.in_(chunk), table.available.is_(True))\
+				.update({table.available: False, table.time_load: datetime.datetime.now()}, synchronize_session=False)
+		# the feed no longer lists them, there is nothing to retry
+		session.query(RetryItem)\
+			.filter(RetryItem.site == site_name, RetryItem.code.in_(chunk))\
+			.delete(synchronize_session=False)
+	session.commit()
+
+
+def product_row(site_name, product, xml_timestamp, small_img_path, large_img_path, small_img_hash=None, large_img_hash=None,
+				small_img_status=None, large_img_status=None):
+	return dict(available=product.available,
+				code=product.code,
+				name=product.name,
+				url=product.url,
+				price=product.price,
+				price_old=product.price_old,
+				currency=product.currency,
+				img_small=product.img_small,
+				img_large=product.img_large,
+				site=site_name,
+				time_xml=xml_timestamp,
+				path_img_small=small_img_path,
+				path_img_large=large_img_path,
+				hash_img_small=small_img_hash,
+				hash_img_large=large_img_hash,
+				status_img_small=small_img_status,
+				status_img_large=large_img_status)
+
+
+def product_size_rows(site_name, product_info, xml_timestamp):
+	def row(param_name, param_available, param_price, param_price_old):
+		return dict(available=product_info.available,
+					code=product_info.code,
+					name=product_info.name,
+					url=product_info.url,
+					price=product_info.price,
+					price_old=product_info.price_old,
+					site=site_name,
+					time_xml=xml_timestamp,
+					param_name=param_name,
+					param_available=param_available,
+					param_price=param_price,
+					param_price_old=param_price_old)
+
+	if not product_info.params:
+		return [row(None, product_info.available, product_info.price, product_info.price_old)]
+
+	return [row(param.name, param.available, param.price, param.price_old) for param in product_info.params]
+
+
+def store_product_data(site_name, product, xml_timestamp, small_img_path, large_img_path,
+					   small_img_hash=None, large_img_hash=None, small_img_status=None, large_img_status=None):
+	with metrics.timer("db_write_seconds", site=site_name, op="product"):
+		_store_product_data(site_name, product, xml_timestamp, small_img_path, large_img_path,
+							small_img_hash, large_img_hash, small_img_status, large_img_status)
+	metrics.inc("db_rows_total", site=site_name, table=FeedStore.__tablename__)
+
+
+def _store_product_data(site_name, product, xml_timestamp, small_img_path, large_img_path,
+						small_img_hash, large_img_hash, small_img_status, large_img_status):
+	row = product_row(site_name, product, xml_timestamp, small_img_path, large_img_path, small_img_hash, large_img_hash,
+					  small_img_status, large_img_status)
+	db_prod = session.query(FeedStore).filter_by(site=site_name, code=row["code"]).first()
+
+	if not db_prod:
+		session.add(FeedStore(**row))
 	else:
-		db_prod.available = to_bool(get_child(product, "avalible"))
-		db_prod.code = code
-		db_prod.name = get_child(product, "name")
-		db_prod.url = get_child(product, "url")
-		db_prod.price = int(get_child(product, "price"))
-		db_prod.price_old = int(get_child(product, "price_old"))
-		db_prod.currency = get_child(product, "currency")
-		db_prod.img_small = get_child(product, "img_small")
-		db_prod.img_large = get_child(product, "img_large")
-		db_prod.site = site_name
-		db_prod.time_xml = xml_timestamp
+		for column, value in row.items():
+			if value is not None or column not in BulkWriter.KEEP_IF_NULL:
+				setattr(db_prod, column, value)
 		db_prod.time_load = datetime.datetime.now()
-		db_prod.path_img_small = small_img_path
-		db_prod.path_img_large = large_img_path
-		session.commit()
+
+	session.commit()
 
 
 def store_product_sizes(site_name, product_info, xml_timestamp):
-	code = get_child(product_info, "code")
-
-	params = product_info.find("params")
-	if params:
-		for param in params:
-			param_name = param.get("name")
-			param_available = param.get("avalible")
-			param_price = param.get("price")
-			try:
-				if not param_price or param_price=="0":
-					param_price = int(get_child(product_info, "price"))
-				else:
-					param_price = int(param_price)
-			except ValueError as e:
-				param_price = 0
-
-			if param_available:
-				param_available = to_bool(param_available)
-
-			param_price_old = param.get("price_old")
-			try:
-				if not param_price_old or param_price_old=="0":
-					param_price_old = int(get_child(product_info, "price_old"))
-				else:
-					param_price_old = int(param_price_old)
-			except ValueError as e:
-				param_price_old = 0
-
-			db_prod_size_entry = session.query(FeedProdStore)\
-									.filter_by(site=site_name, code=code, param_name=param_name)\
-									.first()
-
-			if not db_prod_size_entry:
-				db_prod_size_entry = FeedProdStore(available=to_bool(get_child(product_info, "avalible")),
-										code=code,
-										name=get_child(product_info, "name"),
-										url=get_child(product_info, "url"),
-										price=int(get_child(product_info, "price")),
-										price_old=int(get_child(product_info, "price_old")),
-										site=site_name,
-										time_xml=xml_timestamp,
-										param_name=param_name,
-										param_available=param_available,
-										param_price=param_price,
-										param_price_old=param_price_old)
-
-				session.add(db_prod_size_entry)
-				session.commit()
-			else:
-				db_prod_size_entry.available=to_bool(get_child(product_info, "avalible"))
-				db_prod_size_entry.code=code
-				db_prod_size_entry.name=get_child(product_info, "name")
-				db_prod_size_entry.url = get_child(product_info, "url")
-				db_prod_size_entry.price=int(get_child(product_info, "price"))
-				db_prod_size_entry.price_old=int(get_child(product_info, "price_old"))
-				db_prod_size_entry.site=site_name
-				db_prod_size_entry.time_xml=xml_timestamp
-				db_prod_size_entry.time_load=datetime.datetime.now()
-				db_prod_size_entry.param_name=param_name
-				db_prod_size_entry.param_available=param_available
-				db_prod_size_entry.param_price=param_price
-				db_prod_size_entry.param_price_old=param_price_old
-				session.commit()
-	else:
-		param_name = None
-		param_available = to_bool(get_child(product_info, "avalible"))
-		param_price = int(get_child(product_info, "price"))
-		param_price_old = int(get_child(product_info, "price_old"))
+	with metrics.timer("db_write_seconds", site=site_name, op="sizes"):
+		rows = _store_product_sizes(site_name, product_info, xml_timestamp)
+	metrics.inc("db_rows_total", rows, site=site_name, table=FeedProdStore.__tablename__)
 
-		db_prod_size_entry = session.query(FeedProdStore) \
-			.filter_by(site=site_name, code=code, param_name=param_name) \
-			.first()
+
+def _store_product_sizes(site_name, product_info, xml_timestamp):
+	rows = product_size_rows(site_name, product_info, xml_timestamp)
+	for row in rows:
+		db_prod_size_entry = session.query(FeedProdStore)\
+								.filter_by(site=site_name, code=row["code"], param_name=row["param_name"])\
+								.first()
 
 		if not db_prod_size_entry:
-			db_prod_size_entry = FeedProdStore(available=to_bool(get_child(product_info, "avalible")),
-											   code=code,
-											   name=get_child(product_info, "name"),
-											   url = get_child(product_info, "url"),
-											   price=int(get_child(product_info, "price")),
-											   price_old=int(get_child(product_info, "price_old")),
-											   site=site_name,
-											   time_xml=xml_timestamp,
-											   param_name=param_name,
-											   param_available=param_available,
-											   param_price=param_price,
-											   param_price_old=param_price_old)
-
-			session.add(db_prod_size_entry)
-			session.commit()
+			session.add(FeedProdStore(**row))
 		else:
-			db_prod_size_entry.available = to_bool(get_child(product_info, "avalible"))
-			db_prod_size_entry.code = code
-			db_prod_size_entry.name = get_child(product_info, "name")
-			db_prod_size_entry.url = get_child(product_info, "url")
-			db_prod_size_entry.price = int(get_child(product_info, "price"))
-			db_prod_size_entry.price_old = int(get_child(product_info, "price_old"))
-			db_prod_size_entry.site = site_name
-			db_prod_size_entry.time_xml = xml_timestamp
+			for column, value in row.items():
+				setattr(db_prod_size_entry, column, value)
 			db_prod_size_entry.time_load = datetime.datetime.now()
-			db_prod_size_entry.param_name = param_name
-			db_prod_size_entry.param_available = param_available
-			db_prod_size_entry.param_price = param_price
-			db_prod_size_entry.param_price_old = param_price_old
-			session.commit()
 
+		session.commit()
+
+	return len(rows)
+
+
+def copy_value(value):
+	if value is None:
+		return "\\N"
+	if isinstance(value, bool):
+		return "t" if value else "f"
+	return str(value).replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n").replace("\r", "\\r")
+
+
+class BulkWriter:
+	"""
+	Buffers FeedStore and FeedProdStore rows of a site and writes them in batches:
+	COPY into a temp staging table, then one UPDATE of the existing rows and one INSERT of the new ones,
+	one commit per batch. The tables have no unique key on (site, code[, param_name]),
+	so INSERT ... ON CONFLICT cannot be used here.
+	A batch is flushed when batch_size rows are buffered or flush_interval seconds passed since the last flush.
+	after_flush is called after every committed batch.
+	"""
+
+	# rows are matched on site and code plus these nullable columns
+	PRODUCT_KEY = ()
+	SIZE_KEY = ("param_name",)
+
+	# NULL in these columns means "not known in this run", the stored value is kept
+	KEEP_IF_NULL = ("hash_img_small", "hash_img_large", "status_img_small", "status_img_large")
+
+	def __init__(self, site_name, batch_size, flush_interval, after_flush=None):
+		self.site_name = site_name
+		self.batch_size = batch_size
+		self.flush_interval = flush_interval
+		self.after_flush = after_flush
+		self.products = {}
+		self.sizes = {}
+		self.last_flush = time.monotonic()
+
+	def add_product(self, product, xml_timestamp, small_img_path, large_img_path, small_img_hash=None, large_img_hash=None,
+					small_img_status=None, large_img_status=None):
+		row = product_row(self.site_name, product, xml_timestamp, small_img_path, large_img_path,
+						  small_img_hash, large_img_hash, small_img_status, large_img_status)
+		self.products[row["code"]] = row
+		self.maybe_flush()
+
+	def add_product_sizes(self, product_info, xml_timestamp):
+		for row in product_size_rows(self.site_name, product_info, xml_timestamp):
+			self.sizes[(row["code"], row["param_name"])] = row
+		self.maybe_flush()
+
+	def pending(self):
+		return len(self.products) + len(self.sizes)
+
+	def maybe_flush(self):
+		if self.pending() >= self.batch_size or time.monotonic() - self.last_flush >= self.flush_interval:
+			self.flush()
+
+	def flush(self):
+		try:
+			with metrics.timer("db_write_seconds", site=self.site_name, op="batch"):
+				if self.products:
+					self.merge(FeedStore.__table__, self.PRODUCT_KEY, list(self.products.values()))
+				if self.sizes:
+					self.merge(FeedProdStore.__table__, self.SIZE_KEY, list(self.sizes.values()))
+				session.commit()
+		except:
+			session.rollback()
+			raise
+
+		metrics.inc("db_rows_total", len(self.products), site=self.site_name, table=FeedStore.__tablename__)
+		metrics.inc("db_rows_total", len(self.sizes), site=self.site_name, table=FeedProdStore.__tablename__)
+
+		self.products = {}
+		self.sizes = {}
+		self.last_flush = time.monotonic()
+
+		if self.after_flush:
+			self.after_flush()
+
+	def close(self):
+		if self.pending():
+			self.flush()
+
+	def merge(self, table, key, rows):
+		columns = sorted(rows[0])
+		staging = "{}_staging".format(table.name)
+		column_list = ", ".join(columns)
+
+		session.execute(text("CREATE TEMP TABLE IF NOT EXISTS {} AS SELECT {} FROM {} WITH NO DATA"
+							 .format(staging, column_list, table.name)))
+		session.execute(text("TRUNCATE {}".format(staging)))
+
+		data = io.StringIO()
+		for row in rows:
+			data.write("\t".join(copy_value(row[c]) for c in columns))
+			data.write("\n")
+		data.seek(0)
+
+		cursor = session.connection().connection.cursor()
+		try:
+			cursor.copy_expert("COPY {} ({}) FROM STDIN".format(staging, column_list), data)
+			metrics.inc("db_round_trips_total", kind="copy")
+		finally:
+			cursor.close()
+
+		match = " AND ".join(["t.site = s.site", "t.code = s.code"] +
+							 ["t.{0} IS NOT DISTINCT FROM s.{0}".format(c) for c in key])
+
+		session.execute(text("UPDATE {} t SET {}, time_load = NOW() FROM {} s WHERE {}".format(
+			table.name, ", ".join(("{0} = COALESCE(s.{0}, t.{0})" if c in self.KEEP_IF_NULL else "{0} = s.{0}").format(c)
+								  for c in columns), staging, match)))
+		session.execute(text("INSERT INTO {0} ({1}) SELECT {1} FROM {2} s WHERE NOT EXISTS (SELECT 1 FROM {0} t WHERE {3})".format(
+			table.name, column_list, staging, match)))
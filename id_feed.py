@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+
+from lxml import etree
+
+
+class FeedStream:
+	"""
+	Product list of feedxml_crm.php parsed with iterparse as the response arrives.
+	The root timestamp is read on construction, iterating yields the children of the first
+	element of the root one by one. A product is detached from the tree as soon as the consumer
+	asks for the next one, so it lives only as long as the consumer keeps a reference to it
+	and peak memory does not depend on the feed size.
+	"""
+
+	def __init__(self, resp):
+		resp.raw.decode_content = True
+
+		self.resp = resp
+		self.events = etree.iterparse(resp.raw, events=("start", "end"))
+
+		event, self.root = next(self.events)
+		self.timestamp = self.root.get("timestamp")
+		self.count = 0
+
+	def __iter__(self):
+		depth = 1
+		container = None
+
+		try:
+			for event, element in self.events:
+				if event == "start":
+					depth += 1
+					if depth == 2 and container is None:
+						container = element
+					continue
+
+				depth -= 1
+				if depth == 2 and element.getparent() is container:
+					self.count += 1
+					yield element
+					container.remove(element)
+				elif depth == 1:
+					element.clear()
+		finally:
+			self.close()
+
+	def close(self):
+		self.resp.close()
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+
+import io
+import logging
+import multiprocessing.util
+from concurrent.futures import ProcessPoolExecutor
+
+from id_config import image_check_workers, image_max_side, image_reencode, image_jpeg_quality
+
+try:
+	from PIL import Image
+except ImportError:
+	Image = None
+
+
+OK = "ok"
+NORMALISED = "normalised"
+INVALID = "invalid"
+
+# leading bytes of the formats shops serve and the bytes their files end with, None if not checked
+SIGNATURES = [
+	(b"\xff\xd8\xff", b"\xff\xd9", "JPEG"),
+	(b"\x89PNG\r\n\x1a\n", b"IEND\xaeB`\x82", "PNG"),
+	(b"GIF87a", b";", "GIF"),
+	(b"GIF89a", b";", "GIF"),
+	(b"RIFF", None, "WEBP"),
+]
+
+
+def sniff(data):
+	"""
+	Checks the signature of the image format and that the file is not cut short,
+	returns (format, None) or (None, reason)
+	"""
+	for head, tail, image_format in SIGNATURES:
+		if not data.startswith(head):
+			continue
+
+		if image_format == "WEBP" and (data[8:12] != b"WEBP" or int.from_bytes(data[4:8], "little") + 8 > len(data)):
+			return None, "broken or truncated WEBP"
+		if tail and not data.rstrip(b"\x00\r\n").endswith(tail):
+			return None, "truncated {}".format(image_format)
+		return image_format, None
+
+	return None, "not an image, starts with {!r}".format(data[:16])
+
+
+def check_image(data):
+	"""
+	Runs in the checker processes. Verifies the image data, with Pillow by decoding it, without by its signature.
+	With Pillow images larger than image_max_side are downscaled and with image_reencode JPEGs are
+	re-encoded with image_jpeg_quality if that makes them smaller.
+	Returns (status, new content or None if the data is fine as it is, message)
+	"""
+	image_format, reason = sniff(data)
+	if image_format is None:
+		return INVALID, None, reason
+
+	if Image is None:
+		return OK, None, image_format
+
+	try:
+		with Image.open(io.BytesIO(data)) as image:
+			image.verify()
+
+		image = Image.open(io.BytesIO(data))
+		image.load()
+	except Exception as e:
+		return INVALID, None, "{}: {}".format(type(e).__name__, e)
+
+	width, height = image.size
+	resize = image_max_side and max(width, height) > image_max_side
+	if not resize and not (image_reencode and image.format == "JPEG"):
+		return OK, None, "{} {}x{}".format(image.format, width, height)
+
+	if resize:
+		image.thumbnail((image_max_side, image_max_side), Image.LANCZOS)
+
+	out = io.BytesIO()
+	if image_format == "JPEG":
+		image.convert("RGB").save(out, "JPEG", quality=image_jpeg_quality, optimize=True, progressive=True)
+	else:
+		image.save(out, image_format, optimize=True)
+
+	if not resize and out.tell() >= len(data):
+		return OK, None, "{} {}x{}".format(image_format, width, height)
+
+	return NORMALISED, out.getvalue(), "{} {}x{} -> {}x{}, {} -> {} bytes".format(
+		image_format, width, height, image.size[0], image.size[1], len(data), out.tell())
+
+
+_checker = None
+
+
+def checker():
+	"""
+	Process pool of the image checks of this process, started on the first call.
+	Call it before any threads are started, the pool processes are forked.
+	"""
+	global _checker
+
+	if _checker is None:
+		_checker = ProcessPoolExecutor(max_workers=image_check_workers)
+		# the executor forks its processes on the first submit
+		_checker.submit(int).result()
+		# a multiprocessing worker exits without atexit handlers and waits for its children,
+		# so the pool has to be shut down before that
+		multiprocessing.util.Finalize(None, _checker.shutdown, exitpriority=10)
+		if Image is None:
+			logging.getLogger().warning("Pillow is not installed, images are only checked by their signature")
+	return _checker
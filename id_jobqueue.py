@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+
+import json
+import logging
+import threading
+from collections import namedtuple
+from contextlib import contextmanager
+
+from sqlalchemy import create_engine, text
+
+from id_config import job_lease, job_heartbeat_interval, job_max_attempts
+
+
+Job = namedtuple("Job", ["id", "site", "shard", "shard_count"])
+
+
+class JobQueue:
+	"""
+	Queue of site jobs of a crawl (run_id) in the crawl_job table, shared by any number of runner nodes.
+	A job is claimed with SELECT ... FOR UPDATE SKIP LOCKED together with a lease of job_lease seconds
+	that a heartbeat thread extends while the job runs. A job whose lease expired, because its node died,
+	is claimed again by another node, up to job_max_attempts times, and is marked failed by the next claim after that.
+	Uses its own engine so that it does not interfere with the id_db session of the site jobs.
+	"""
+
+	def __init__(self, db_url, run_id, node, logger_name):
+		self.run_id = run_id
+		self.node = node
+		self.logger_name = logger_name
+		self.engine = create_engine(db_url, pool_size=2)
+
+	def close(self):
+		self.engine.dispose()
+
+	def enqueue(self, sites):
+		"""
+		Adds a job for each of (site, shard, shard_count, cost) that is not in the crawl yet
+		"""
+		with self.engine.begin() as conn:
+			for site, shard, shard_count, cost in sites:
+				conn.execute(text("""
+					INSERT INTO crawl_job (run_id, site, shard, shard_count, cost)
+					SELECT :run_id, :site, :shard, :shard_count, :cost
+					WHERE NOT EXISTS (SELECT 1 FROM crawl_job
+									  WHERE run_id = :run_id AND site = :site AND shard = :shard)
+				"""), run_id=self.run_id, site=site, shard=shard, shard_count=shard_count, cost=cost)
+
+	def last_durations(self):
+		"""
+		Duration of the last completed job of every site that read its feed, from any crawl
+		"""
+		with self.engine.connect() as conn:
+			rows = conn.execute(text("""
+				SELECT DISTINCT ON (site, shard) site, result FROM crawl_job
+				WHERE status = 'done' AND result IS NOT NULL AND result::json ->> 'duration' IS NOT NULL
+				ORDER BY site, shard, finished_at DESC
+			"""))
+			durations = {}
+			for site, result in rows:
+				durations[site] = max(durations.get(site, 0), json.loads(result)["duration"])
+			return durations
+
+	def claim(self):
+		with self.engine.begin() as conn:
+			# the node of the last attempt died, nothing else would finish the job
+			conn.execute(text("""
+				UPDATE crawl_job SET status = 'failed', finished_at = NOW(), lease_until = NULL
+				WHERE run_id = :run_id AND status = 'running' AND lease_until < NOW() AND attempts >= :max_attempts
+			"""), run_id=self.run_id, max_attempts=job_max_attempts)
+
+			row = conn.execute(text("""
+				UPDATE crawl_job SET status = 'running', node = :node, attempts = attempts + 1,
+									 lease_until = NOW() + make_interval(secs => :lease), heartbeat_at = NOW()
+				WHERE id = (SELECT id FROM crawl_job
+							WHERE run_id = :run_id AND attempts < :max_attempts
+							  AND (status = 'queued' OR (status = 'running' AND lease_until < NOW()))
+							ORDER BY cost DESC NULLS FIRST, id
+							LIMIT 1
+							FOR UPDATE SKIP LOCKED)
+				RETURNING id, site, shard, shard_count
+			"""), node=self.node, lease=job_lease, run_id=self.run_id, max_attempts=job_max_attempts).first()
+
+		return Job(*row) if row else None
+
+	def unfinished(self):
+		"""
+		True while some job of the crawl may still be (re)claimed
+		"""
+		with self.engine.connect() as conn:
+			return conn.execute(text("""
+				SELECT EXISTS (SELECT 1 FROM crawl_job
+							   WHERE run_id = :run_id AND status IN ('queued', 'running') AND attempts < :max_attempts)
+			"""), run_id=self.run_id, max_attempts=job_max_attempts).scalar()
+
+	def extend(self, job):
+		with self.engine.begin() as conn:
+			return conn.execute(text("""
+				UPDATE crawl_job SET lease_until = NOW() + make_interval(secs => :lease), heartbeat_at = NOW()
+				WHERE id = :id AND node = :node AND status = 'running'
+			"""), lease=job_lease, id=job.id, node=self.node).rowcount == 1
+
+	@contextmanager
+	def heartbeat(self, job):
+		logger = logging.getLogger(self.logger_name)
+		stop = threading.Event()
+
+		def beat():
+			while not stop.wait(job_heartbeat_interval):
+				try:
+					if not self.extend(job):
+						logger.warning("Lost the lease of job {} of site {}".format(job.id, job.site))
+				except Exception:
+					logger.exception("Cannot extend the lease of job {} of site {}".format(job.id, job.site))
+
+		thread = threading.Thread(target=beat, name="heartbeat-{}".format(job.id))
+		thread.daemon = True
+		thread.start()
+		try:
+			yield
+		finally:
+			stop.set()
+			thread.join()
+
+	def finish(self, job, result):
+		"""
+		Marks the job done with result (stats of the run), or if result is None puts it back
+		to the queue for another attempt, failed once the attempts are used up
+		"""
+		with self.engine.begin() as conn:
+			if result is not None:
+				conn.execute(text("""
+					UPDATE crawl_job SET status = 'done', finished_at = NOW(), lease_until = NULL, result = :result
+					WHERE id = :id AND node = :node
+				"""), result=json.dumps(result), id=job.id, node=self.node)
+			else:
+				conn.execute(text("""
+					UPDATE crawl_job SET status = CASE WHEN attempts < :max_attempts THEN 'queued' ELSE 'failed' END,
+										 finished_at = NOW(), lease_until = NULL
+					WHERE id = :id AND node = :node
+				"""), max_attempts=job_max_attempts, id=job.id, node=self.node)
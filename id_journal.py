@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+
+import json
+import os
+import os.path
+import threading
+
+
+IMAGES = "images"	# images downloaded and the FeedStore row written
+INFO = "info"		# product info requested, there were no sizes to write
+SIZES = "sizes"		# product info requested and its FeedProdStore rows written
+
+DONE = object()
+
+
+class Journal:
+	"""
+	Append-only checkpoint file of a site run: a header with the feed timestamp,
+	then one json line [code, stage] per completed stage of a product.
+	A run over the same feed timestamp resumes from it, a run over another timestamp starts a new one.
+	The file is removed when the run completes. A line torn by a kill is ignored when the file is read back
+	and cut off before the run resumes, so that the next line is not glued onto it.
+	"""
+
+	# bytes at the end of the file a torn line is looked for in, longer than any line
+	TAIL_SIZE = 4096
+
+	def __init__(self, filename, feed_timestamp):
+		self.filename = filename
+		self.lock = threading.Lock()
+		self.stages = {}
+
+		if os.path.exists(filename) and self.read(filename) == feed_timestamp:
+			self.cut_torn_line(filename)
+			self.file = open(filename, "a", encoding="utf8")
+		else:
+			self.stages = {}
+			self.file = open(filename, "w", encoding="utf8")
+			self.file.write(json.dumps({"feed": feed_timestamp}) + "\n")
+			self.file.flush()
+
+	def read(self, filename):
+		with open(filename, encoding="utf8") as f:
+			try:
+				feed_timestamp = json.loads(f.readline())["feed"]
+			except (ValueError, KeyError, TypeError):
+				return None
+
+			for line in f:
+				if not line.endswith("\n"):
+					# torn by a kill, even if it happens to parse
+					continue
+				try:
+					code, stage = json.loads(line)
+				except ValueError:
+					continue
+				self.stages.setdefault(code, set()).add(stage)
+
+		return feed_timestamp
+
+	def cut_torn_line(self, filename):
+		with open(filename, "rb+") as f:
+			size = f.seek(0, os.SEEK_END)
+			f.seek(max(0, size - self.TAIL_SIZE))
+			tail = f.read()
+			if not tail.endswith(b"\n"):
+				f.truncate(size - len(tail) + tail.rfind(b"\n") + 1)
+
+	def done(self, code, stage):
+		stages = self.stages.get(code)
+		if stage == INFO:
+			return stages is not None and (INFO in stages or SIZES in stages)
+		return stages is not None and stage in stages
+
+	def started(self, code):
+		return code in self.stages
+
+	def complete(self, code):
+		return self.done(code, IMAGES) and self.done(code, INFO)
+
+	def append(self, code, stage):
+		with self.lock:
+			self.stages.setdefault(code, set()).add(stage)
+			self.file.write(json.dumps([code, stage]) + "\n")
+			self.file.flush()
+
+	def close(self):
+		self.file.close()
+
+	def remove(self):
+		self.close()
+		os.remove(self.filename)
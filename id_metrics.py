@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+from id_storage import write_atomic
+
+
+PREFIX = "image_downloader_"
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+
+class Metrics:
+	"""
+	Counters and histograms keyed by name and labels.
+	A worker process records into its own instance, snapshot() of it is sent to the runner
+	that merge()s the snapshots of all processes and writes them in the Prometheus text format.
+	"""
+
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.counters = {}
+		self.histograms = {}
+
+	@staticmethod
+	def key(name, labels):
+		return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+	def inc(self, name, value=1, **labels):
+		key = self.key(name, labels)
+		with self.lock:
+			self.counters[key] = self.counters.get(key, 0) + value
+
+	def observe(self, name, value, **labels):
+		key = self.key(name, labels)
+		with self.lock:
+			histogram = self.histograms.get(key)
+			if histogram is None:
+				# bucket counts, then +Inf count, then sum
+				histogram = self.histograms[key] = [0] * (len(BUCKETS) + 1) + [0.0]
+			histogram[bisect.bisect_left(BUCKETS, value)] += 1
+			histogram[-1] += value
+
+	@contextmanager
+	def timer(self, name, **labels):
+		started = time.monotonic()
+		try:
+			yield
+		finally:
+			self.observe(name, time.monotonic() - started, **labels)
+
+	def reset(self):
+		with self.lock:
+			self.counters = {}
+			self.histograms = {}
+
+	def snapshot(self):
+		with self.lock:
+			return {"counters": dict(self.counters), "histograms": {k: list(v) for k, v in self.histograms.items()}}
+
+	def merge(self, snapshot):
+		with self.lock:
+			for key, value in snapshot["counters"].items():
+				self.counters[key] = self.counters.get(key, 0) + value
+
+			for key, value in snapshot["histograms"].items():
+				histogram = self.histograms.get(key)
+				if histogram is None:
+					self.histograms[key] = list(value)
+				else:
+					for i, v in enumerate(value):
+						histogram[i] += v
+
+	def prometheus(self):
+		lines = []
+
+		with self.lock:
+			for name in sorted(set(name for name, labels in self.counters)):
+				lines.append("# TYPE {}{} counter".format(PREFIX, name))
+				for (n, labels), value in sorted(self.counters.items()):
+					if n == name:
+						lines.append("{}{}{} {}".format(PREFIX, name, format_labels(labels), value))
+
+			for name in sorted(set(name for name, labels in self.histograms)):
+				lines.append("# TYPE {}{} histogram".format(PREFIX, name))
+				for (n, labels), value in sorted(self.histograms.items()):
+					if n != name:
+						continue
+
+					cumulative = 0
+					for bound, count in zip([str(b) for b in BUCKETS] + ["+Inf"], value[:-1]):
+						cumulative += count
+						lines.append("{}{}_bucket{} {}".format(PREFIX, name, format_labels(labels + (("le", bound),)), cumulative))
+					lines.append("{}{}_sum{} {}".format(PREFIX, name, format_labels(labels), value[-1]))
+					lines.append("{}{}_count{} {}".format(PREFIX, name, format_labels(labels), cumulative))
+
+		return "\n".join(lines) + "\n"
+
+	def write(self, filename):
+		write_atomic(filename, [self.prometheus().encode("utf8")])
+
+
+def format_labels(labels):
+	if not labels:
+		return ""
+
+	return "{" + ",".join('{}="{}"'.format(k, v.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+						  for k, v in labels) + "}"
+
+
+# metrics of this process
+metrics = Metrics()
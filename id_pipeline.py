@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import queue
+import threading
+
+
+_DONE = object()
+
+
+class Stage:
+	def __init__(self, pipeline, name, func, workers, queue_size):
+		self.pipeline = pipeline
+		self.name = name
+		self.func = func
+		self.workers = workers
+		self.queue = queue.Queue(maxsize=queue_size)
+		self.threads = []
+		self.next = None
+
+	def start(self, next_stage):
+		self.next = next_stage
+		for i in range(self.workers):
+			thread = threading.Thread(target=self.work, name="{}-{}".format(self.name, i))
+			thread.daemon = True
+			thread.start()
+			self.threads.append(thread)
+
+	def work(self):
+		while True:
+			item = self.queue.get()
+			if item is _DONE:
+				break
+
+			if self.pipeline.errors:
+				# keep draining so that the stages before this one are not blocked on a full queue
+				continue
+
+			try:
+				result = self.func(item)
+			except Exception as e:
+				self.pipeline.errors.append(e)
+				continue
+
+			if result is not None and self.next:
+				self.next.queue.put(result)
+
+	def finish(self):
+		for _ in self.threads:
+			self.queue.put(_DONE)
+		for thread in self.threads:
+			thread.join()
+
+
+class Pipeline:
+	"""
+	Chain of stages, each with its own worker threads, connected by bounded queues.
+	A stage function takes an item from its queue and returns the item for the next stage or None to drop it.
+	A full queue blocks the stage before it, so a slow stage slows down the ones feeding it
+	instead of piling up items in memory. The first exception of any stage stops the feeding
+	and is raised from run() once the stages are drained.
+	"""
+
+	def __init__(self, logger_name, report_interval=60):
+		self.logger_name = logger_name
+		self.report_interval = report_interval
+		self.stages = []
+		self.errors = []
+
+	def add_stage(self, name, func, workers, queue_size):
+		self.stages.append(Stage(self, name, func, workers, queue_size))
+
+	def depths(self):
+		return [(stage.name, stage.queue.qsize()) for stage in self.stages]
+
+	def report(self, stop):
+		logger = logging.getLogger(self.logger_name)
+
+		while not stop.wait(self.report_interval):
+			logger.info("Queue depths: {}".format(", ".join("{} {}".format(*d) for d in self.depths())))
+
+	def run(self, items):
+		for i, stage in enumerate(self.stages):
+			stage.start(self.stages[i + 1] if i + 1 < len(self.stages) else None)
+
+		stop = threading.Event()
+		reporter = threading.Thread(target=self.report, args=(stop,), name="pipeline-report")
+		reporter.daemon = True
+		reporter.start()
+
+		try:
+			for item in items:
+				if self.errors:
+					break
+				self.stages[0].queue.put(item)
+		finally:
+			for stage in self.stages:
+				stage.finish()
+
+			stop.set()
+			reporter.join()
+
+		if self.errors:
+			raise self.errors[0]
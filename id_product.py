@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+
+from id_common import to_bool
+
+
+class InvalidProduct(ValueError):
+	def __init__(self, message, code=None):
+		super().__init__(message)
+		self.code = code
+
+	def __reduce__(self):
+		return InvalidProduct, (str(self), self.code)
+
+
+def parse_int(text, field, code):
+	try:
+		return int(text)
+	except (TypeError, ValueError):
+		raise InvalidProduct("Product {} has invalid {} {!r}".format(code, field, text), code)
+
+
+class Param:
+	"""
+	One <param> of the product info: a size of the product
+	"""
+
+	__slots__ = ("name", "available", "price", "price_old")
+
+	def __init__(self, name, available, price, price_old):
+		self.name = name
+		self.available = available
+		self.price = price
+		self.price_old = price_old
+
+	@classmethod
+	def from_element(cls, param, price, price_old):
+		"""
+		Missing, empty and "0" prices of the size are the ones of the product, unparsable ones are 0
+		"""
+		available = param.get("avalible")
+
+		def size_price(text, default):
+			if not text or text == "0":
+				return default
+			try:
+				return int(text)
+			except ValueError:
+				return 0
+
+		return cls(param.get("name"),
+				   to_bool(available) if available else None,
+				   size_price(param.get("price"), price),
+				   size_price(param.get("price_old"), price_old))
+
+
+class Product:
+	"""
+	A <product> of the feed or of the product info, its fields are read in one pass over the element
+	and converted, so the element can be freed right away. params are the sizes, None for feed products.
+	Raises InvalidProduct if the code is missing or the price is not an integer.
+	"""
+
+	__slots__ = ("code", "available", "name", "url", "price", "price_old", "currency", "img_small", "img_large",
+				 "params")
+
+	# tag -> field, the tags are as the shops spell them
+	TAGS = {
+		"code": "code",
+		"avalible": "available",
+		"name": "name",
+		"url": "url",
+		"price": "price",
+		"price_old": "price_old",
+		"currency": "currency",
+		"img_small": "img_small",
+		"img_large": "img_large",
+	}
+
+	def __init__(self, code, available, name, url, price, price_old, currency, img_small, img_large, params=None):
+		self.code = code
+		self.available = available
+		self.name = name
+		self.url = url
+		self.price = price
+		self.price_old = price_old
+		self.currency = currency
+		self.img_small = img_small
+		self.img_large = img_large
+		self.params = params
+
+	@classmethod
+	def from_element(cls, element):
+		fields = {}
+		params = None
+
+		for child in element:
+			field = cls.TAGS.get(child.tag)
+			# the first of repeated tags wins, as with element.find()
+			if field is not None and field not in fields:
+				fields[field] = child.text
+			elif child.tag == "params" and params is None:
+				params = child
+
+		code = fields.get("code")
+		if code is None:
+			raise InvalidProduct("Product without code")
+
+		price = parse_int(fields.get("price"), "price", code)
+		price_old = parse_int(fields["price_old"], "price_old", code) if fields.get("price_old") else None
+
+		return cls(code,
+				   to_bool(fields.get("available")),
+				   fields.get("name"),
+				   fields.get("url"),
+				   price,
+				   price_old,
+				   fields.get("currency"),
+				   fields.get("img_small"),
+				   fields.get("img_large"),
+				   None if params is None else [Param.from_element(param, price, price_old) for param in params
+											 if isinstance(param.tag, str)])
+
+
+def parse_products(elements):
+	"""
+	Yields the Product of every element, or the InvalidProduct error if it is not valid,
+	and clears the element as soon as it is parsed
+	"""
+	for element in elements:
+		try:
+			product = Product.from_element(element)
+		except InvalidProduct as e:
+			product = e
+		element.clear()
+		yield product
@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+
+import cProfile
+import collections
+import logging
+import os
+import os.path
+import pstats
+import sys
+import threading
+from contextlib import contextmanager
+
+from id_config import profile, profile_sites, profile_interval, profile_dir
+
+
+# set from the command line by the runner and passed to the pool processes by init_worker_process
+mode = profile
+sites = profile_sites
+
+
+class CallProfiler:
+	"""
+	cProfile of the thread that starts it and of every thread started while it runs,
+	before Python 3.12 a cProfile.Profile only sees the thread it was enabled in.
+	stop() takes the stats of all of them, the threads that outlive the run are not counted after it.
+	"""
+
+	# since Python 3.12 a profile sees every thread and only one can be enabled at a time
+	PER_THREAD = sys.version_info < (3, 12)
+
+	def __init__(self):
+		self.profile = cProfile.Profile()
+		self.thread_profiles = []
+		self.stats = None
+		self.lock = threading.Lock()
+
+	def start(self):
+		if self.PER_THREAD:
+			threading.setprofile(self.start_thread)
+		self.profile.enable()
+
+	def start_thread(self, frame, event, arg):
+		# called on the first event of a new thread, enable() replaces this hook with the one of the profile
+		with self.lock:
+			if self.stats is not None:
+				# started before stop() but ran only after it
+				sys.setprofile(None)
+				return
+			thread_profile = cProfile.Profile()
+			self.thread_profiles.append(thread_profile)
+		thread_profile.enable()
+
+	def stop(self):
+		threading.setprofile(None)
+		self.profile.disable()
+		with self.lock:
+			# a profile can only be disabled in its own thread, the threads still running keep collecting
+			# into theirs, so their stats are taken now
+			self.stats = pstats.Stats(self.profile)
+			for thread_profile in self.thread_profiles:
+				self.stats.add(thread_profile)
+			self.thread_profiles = []
+
+	def write(self, name):
+		path = os.path.join(profile_dir, "{}.prof".format(name))
+		self.stats.dump_stats(path)
+		return path
+
+
+class SamplingProfiler:
+	"""
+	Takes the stacks of all the threads of the process every interval seconds on a thread of its own.
+	The run is not slowed down but by the sampling thread taking the GIL.
+	Writes the counts of the stacks collapsed to one line each, the input of flamegraph.pl and speedscope.
+	"""
+
+	def __init__(self, interval=None):
+		self.interval = interval or profile_interval
+		self.stacks = collections.Counter()
+		self.stopped = threading.Event()
+		self.thread = None
+
+	def start(self):
+		self.thread = threading.Thread(target=self.sample, name="sampling-profiler", daemon=True)
+		self.thread.start()
+
+	def sample(self):
+		own = threading.get_ident()
+		while not self.stopped.wait(self.interval):
+			for thread_id, frame in sys._current_frames().items():
+				if thread_id == own:
+					continue
+
+				stack = []
+				while frame is not None:
+					code = frame.f_code
+					stack.append("{} ({}:{})".format(code.co_name, os.path.basename(code.co_filename),
+													 code.co_firstlineno))
+					frame = frame.f_back
+				self.stacks[";".join(reversed(stack))] += 1
+
+	def stop(self):
+		self.stopped.set()
+		self.thread.join()
+
+	def write(self, name):
+		path = os.path.join(profile_dir, "{}.folded".format(name))
+		with open(path, "w", encoding="utf8") as f:
+			for stack, count in self.stacks.most_common():
+				f.write("{} {}\n".format(stack, count))
+		return path
+
+
+PROFILERS = {
+	"cprofile": CallProfiler,
+	"sampling": SamplingProfiler,
+}
+
+
+@contextmanager
+def profiled(site, name, logger_name=None):
+	"""
+	Profiles the block if profiling is on for the site and writes the profile of the block to profile_dir
+	as name.prof (cprofile) or name.folded (sampling). Does nothing else when it is off.
+	"""
+	if not mode or (sites and site not in sites):
+		yield
+		return
+
+	profiler = PROFILERS[mode]()
+	profiler.start()
+	try:
+		yield
+	finally:
+		profiler.stop()
+		os.makedirs(profile_dir, exist_ok=True)
+		path = profiler.write(name)
+		logging.getLogger(logger_name).info("Profile of {} written to {}".format(name, path))
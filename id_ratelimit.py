@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+
+import email.utils
+import logging
+import threading
+import time
+
+from id_metrics import metrics
+from id_config import rate_start, rate_min, rate_max, rate_burst, rate_increase, rate_decrease, rate_slow_latency, \
+	rate_retry_after_max
+
+
+def retry_after(value, now=None):
+	"""
+	Seconds to wait from a Retry-After header, given in seconds or as an HTTP date, None if absent or invalid
+	"""
+	if not value:
+		return None
+
+	value = value.strip()
+	if value.isdigit():
+		return int(value)
+
+	try:
+		date = email.utils.parsedate_to_datetime(value)
+	except (TypeError, ValueError):
+		return None
+	if date is None:
+		return None
+
+	return max(0, date.timestamp() - (now or time.time()))
+
+
+class HostRate:
+	"""
+	Token bucket limiting the requests to one host to rate per second with bursts of up to rate_burst.
+	The rate is controlled by AIMD: every healthy response adds rate_increase / rate, so the rate grows
+	by about rate_increase each second of traffic; a 429 or 503, a timeout or a connection error,
+	or an average latency above rate_slow_latency multiplies it by rate_decrease, at most once per
+	average latency so that the requests in flight when a host chokes cut it once.
+	Retry-After stops all requests to the host for the given time.
+	The rate stays within [minimum, maximum]. Thread safe.
+	share scales the start rate, the limits and the increase, so that the processes running shards
+	of one site together stay within the budget of the site.
+	"""
+
+	def __init__(self, host, logger_name, minimum=rate_min, maximum=rate_max, share=1.0):
+		self.host = host
+		self.logger_name = logger_name
+		self.minimum = minimum * share
+		self.maximum = maximum * share
+		self.increase = rate_increase * share
+		self.rate = min(max(rate_start * share, self.minimum), self.maximum)
+		self.lock = threading.Lock()
+		self.tokens = 1.0
+		self.updated = time.monotonic()
+		self.blocked_until = 0.0
+		self.latency = None
+		self.decreased = 0.0
+
+	def acquire(self):
+		"""
+		Waits until a request to the host may start
+		"""
+		with self.lock:
+			now = time.monotonic()
+			self.tokens = min(rate_burst, self.tokens + (now - self.updated) * self.rate)
+			self.updated = now
+
+			# the token is taken right away, a negative balance is the queue of waiting requests
+			self.tokens -= 1
+			delay = max(-self.tokens / self.rate, self.blocked_until - now)
+
+		if delay > 0:
+			time.sleep(delay)
+
+	def success(self, seconds):
+		with self.lock:
+			self.latency = seconds if self.latency is None else 0.8 * self.latency + 0.2 * seconds
+			if self.latency > rate_slow_latency:
+				self._decrease("average latency {:.1f}s".format(self.latency))
+			else:
+				self.rate = min(self.maximum, self.rate + self.increase / self.rate)
+
+	def failure(self, reason, retry_after_seconds=None):
+		with self.lock:
+			if retry_after_seconds:
+				retry_after_seconds = min(retry_after_seconds, rate_retry_after_max)
+				self.blocked_until = max(self.blocked_until, time.monotonic() + retry_after_seconds)
+				logging.getLogger(self.logger_name).warning("{} asked to retry after {:.0f}s".format(
+					self.host, retry_after_seconds))
+
+			self._decrease(reason)
+
+	def _decrease(self, reason):
+		now = time.monotonic()
+		if now - self.decreased < (self.latency or 0):
+			return
+
+		self.decreased = now
+		self.rate = max(self.minimum, self.rate * rate_decrease)
+		metrics.inc("rate_decreases_total", host=self.host)
+		logging.getLogger(self.logger_name).info("Request rate of {} cut to {:.2f}/s: {}".format(
+			self.host, self.rate, reason))
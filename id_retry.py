@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+
+import datetime
+import logging
+import threading
+
+import id_db
+from id_config import retry_delay, retry_max_delay, retry_max_attempts
+from id_sync import shard_of
+
+
+IMAGES = "images"	# an image of the product could not be downloaded
+INFO = "info"		# the product info could not be requested
+
+
+class RetryQueue:
+	"""
+	Failed image downloads and product info requests of a site, kept in the retry_queue table across runs.
+	An item failed attempts times in a row is due again retry_delay * 2 ** (attempts - 1) seconds later,
+	at most retry_max_delay, and is given up after retry_max_attempts failures.
+	Outcomes are collected in memory from any thread and written by save() from the thread of the DB session.
+	"""
+
+	def __init__(self, site_name, logger_name, rows):
+		self.site_name = site_name
+		self.logger_name = logger_name
+		# (code, stage) -> (attempts, next_attempt_at)
+		self.items = {(row.code, row.stage): (row.attempts, row.next_attempt_at) for row in rows}
+		# (code, stage) -> error of the failure, None if it succeeded, the first failure of the run wins
+		self.outcomes = {}
+		self.lock = threading.Lock()
+
+	@classmethod
+	def load(cls, site_name, logger_name, shard=0, shard_count=1):
+		rows = id_db.get_retry_items(site_name)
+		if shard_count > 1:
+			rows = [row for row in rows if shard_of(row.code, shard_count) == shard]
+		return cls(site_name, logger_name, rows)
+
+	def due(self, limit, now=None):
+		"""
+		{stage: [codes]} of the items to retry now, the longest waiting first, at most limit of them
+		"""
+		now = now or datetime.datetime.now()
+		items = sorted((next_attempt_at, code, stage) for (code, stage), (_, next_attempt_at) in self.items.items()
+					   if next_attempt_at is not None and next_attempt_at <= now)
+
+		due = {}
+		for _, code, stage in items[:limit]:
+			due.setdefault(stage, []).append(code)
+		return due
+
+	def failed(self, code, stage, error):
+		with self.lock:
+			if self.outcomes.get((code, stage)) is None:
+				self.outcomes[(code, stage)] = str(error)
+
+	def succeeded(self, code, stage):
+		with self.lock:
+			self.outcomes.setdefault((code, stage), None)
+
+	def save(self, now=None):
+		"""
+		Adds the failed items or pushes back their next attempt, removes the queued ones that succeeded
+		"""
+		logger = logging.getLogger(self.logger_name)
+		now = now or datetime.datetime.now()
+
+		with self.lock:
+			outcomes, self.outcomes = self.outcomes, {}
+
+		failed = []
+		recovered = []
+		for (code, stage), error in outcomes.items():
+			attempts, _ = self.items.get((code, stage), (0, None))
+			if error is None:
+				if (code, stage) in self.items:
+					recovered.append((code, stage))
+					del self.items[(code, stage)]
+				continue
+
+			attempts += 1
+			if attempts >= retry_max_attempts:
+				next_attempt_at = None
+				logger.warning("Giving up {} of product {}, site {} after {} attempts: {}".format(
+					stage, code, self.site_name, attempts, error))
+			else:
+				delay = min(retry_delay * 2 ** (attempts - 1), retry_max_delay)
+				next_attempt_at = now + datetime.timedelta(seconds=delay)
+
+			failed.append(dict(code=code, stage=stage, attempts=attempts, next_attempt_at=next_attempt_at,
+							   last_error=error))
+			self.items[(code, stage)] = (attempts, next_attempt_at)
+
+		if failed or recovered:
+			id_db.save_retry_items(self.site_name, failed, recovered)
+			logger.info("Retry queue of site {}: {} failed, {} recovered".format(
+				self.site_name, len(failed), len(recovered)))
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+
+import json
+import os
+import os.path
+import pickle
+from contextlib import contextmanager
+
+from id_cache import NOT_MODIFIED
+from id_product import parse_products
+from id_storage import write_atomic
+from id_sync import shard_of
+
+try:
+	import fcntl
+except ImportError:
+	fcntl = None
+
+try:
+	import msvcrt
+except ImportError:
+	msvcrt = None
+
+
+def lock_file(f):
+	"""
+	Waits for the exclusive lock of the open file f: flock on POSIX, a lock of its first byte on Windows.
+	Elsewhere there is no lock and the shards of a site may all download the feed.
+	"""
+	if fcntl:
+		fcntl.flock(f, fcntl.LOCK_EX)
+	elif msvcrt:
+		while True:
+			try:
+				# retries for 10 seconds before it gives up
+				msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+				return
+			except OSError:
+				continue
+
+
+def unlock_file(f):
+	if fcntl:
+		fcntl.flock(f, fcntl.LOCK_UN)
+	elif msvcrt:
+		f.seek(0)
+		msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+class FeedSpool:
+	"""
+	Product list of a site shared by the processes running its shards.
+	The first shard process to come downloads and parses the feed and writes the products into one
+	pickle file per shard, the others wait for it on a file lock and read their file only.
+	meta.json, written last, holds the result of the download: "ok" with the feed timestamp and product count,
+	"not_modified" or "error".
+	"""
+
+	META = "meta.json"
+
+	def __init__(self, directory, shard_count):
+		self.directory = directory
+		self.shard_count = shard_count
+		self.count = 0
+
+	def shard_path(self, shard):
+		return os.path.join(self.directory, "{}.pickle".format(shard))
+
+	@contextmanager
+	def lock(self):
+		os.makedirs(self.directory, exist_ok=True)
+		with open(os.path.join(self.directory, "lock"), "w") as f:
+			lock_file(f)
+			try:
+				yield
+			finally:
+				unlock_file(f)
+
+	def read_meta(self):
+		path = os.path.join(self.directory, self.META)
+		if not os.path.exists(path):
+			return None
+
+		with open(path, encoding="utf8") as f:
+			return json.load(f)
+
+	def write(self, elements):
+		files = [open(self.shard_path(shard), "wb") for shard in range(self.shard_count)]
+		try:
+			count = 0
+			for product in parse_products(elements):
+				if product.code is not None:
+					pickle.dump(product, files[shard_of(product.code, self.shard_count)], pickle.HIGHEST_PROTOCOL)
+				count += 1
+			return count
+		finally:
+			for f in files:
+				f.close()
+
+	def open(self, shard, get_products):
+		"""
+		Returns (products of the shard, feed timestamp) with get_products() called by the first shard only,
+		(NOT_MODIFIED, None) or (None, None) if that is what get_products() returned.
+		The products are Product records or InvalidProduct errors, as from id_product.parse_products
+		"""
+		with self.lock():
+			meta = self.read_meta()
+			if meta is None:
+				products, timestamp = get_products()
+				if products is NOT_MODIFIED:
+					meta = {"status": "not_modified"}
+				elif products is None:
+					meta = {"status": "error"}
+				else:
+					meta = {"status": "ok", "timestamp": timestamp, "count": self.write(products)}
+				write_atomic(os.path.join(self.directory, self.META), [json.dumps(meta).encode("utf8")])
+
+		if meta["status"] == "not_modified":
+			return NOT_MODIFIED, None
+		elif meta["status"] == "error":
+			return None, None
+
+		self.count = meta["count"]
+		return self.read(shard), meta["timestamp"]
+
+	def read(self, shard):
+		with open(self.shard_path(shard), "rb") as f:
+			while True:
+				try:
+					yield pickle.load(f)
+				except EOFError:
+					return
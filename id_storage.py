@@ -0,0 +1,395 @@
+# -*- coding: utf-8 -*-
+
+import hashlib
+import json
+import os
+import os.path
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from id_config import image_fsync, cas_link, cas_spool_size, storage_backend, storage_bucket, storage_endpoint, \
+	storage_prefix, image_resume_min_size, http_chunk_size
+
+try:
+	import boto3
+except ImportError:
+	boto3 = None
+
+
+_umask = os.umask(0)
+os.umask(_umask)
+
+
+def fsync_dir(directory):
+	if not hasattr(os, "O_DIRECTORY"):
+		return
+
+	fd = os.open(directory, os.O_RDONLY | os.O_DIRECTORY)
+	try:
+		os.fsync(fd)
+	finally:
+		os.close(fd)
+
+
+def write_atomic(path, chunks, fsync=None, makedirs=True):
+	"""
+	Writes chunks to a temp file in the directory of path and renames it into place,
+	so path either does not exist or has the complete content. If chunks raises
+	the temp file is removed and path is left untouched.
+	fsync is "never", "file" (fsync the file before the rename) or "dir" (also fsync the directory after it),
+	image_fsync by default. makedirs=False if the directory of path is known to exist.
+	Returns the count of bytes written.
+	"""
+	fsync = fsync or image_fsync
+	directory = os.path.dirname(path) or "."
+
+	if makedirs:
+		os.makedirs(directory, exist_ok=True)
+	fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".", suffix=".tmp")
+
+	try:
+		size = 0
+		with os.fdopen(fd, "wb") as f:
+			for chunk in chunks:
+				f.write(chunk)
+				size += len(chunk)
+
+			if fsync != "never":
+				f.flush()
+				os.fsync(f.fileno())
+
+		os.chmod(tmp_path, 0o666 & ~_umask)
+		os.replace(tmp_path, path)
+	except BaseException:
+		if os.path.exists(tmp_path):
+			os.remove(tmp_path)
+		raise
+
+	if fsync == "dir":
+		fsync_dir(directory)
+
+	return size
+
+
+def hashed(chunks, digest):
+	for chunk in chunks:
+		digest.update(chunk)
+		yield chunk
+
+
+class ContentStore:
+	"""
+	Content-addressed image store: the bytes of an image are kept once under root/<sha256[:2]>/<sha256>
+	and the image path is a hard or symbolic link (cas_link) to that blob. The body is spooled
+	in memory up to cas_spool_size bytes while it is hashed, so the data of a known blob is not written at all.
+	"""
+
+	def __init__(self, root, link=None):
+		self.root = root
+		self.link = link or cas_link
+
+	def blob_path(self, digest):
+		return os.path.join(self.root, digest[:2], digest)
+
+	def put(self, path, chunks):
+		"""
+		Stores chunks as the content of path, returns (sha256 hex digest, size)
+		"""
+		digest = hashlib.sha256()
+		size = 0
+
+		with tempfile.SpooledTemporaryFile(max_size=cas_spool_size) as spool:
+			for chunk in hashed(chunks, digest):
+				spool.write(chunk)
+				size += len(chunk)
+
+			blob = self.blob_path(digest.hexdigest())
+			if not os.path.exists(blob):
+				spool.seek(0)
+				write_atomic(blob, iter(lambda: spool.read(65536), b""))
+
+		self.link_to(blob, path)
+		return digest.hexdigest(), size
+
+	def link_to(self, blob, path):
+		directory = os.path.dirname(path) or "."
+		os.makedirs(directory, exist_ok=True)
+
+		if os.path.exists(path) and os.path.samefile(path, blob):
+			return
+
+		tmp_path = "{}.{}.{}.tmp".format(path, os.getpid(), threading.get_ident())
+		if self.link == "symbolic":
+			os.symlink(os.path.relpath(blob, directory), tmp_path)
+		else:
+			os.link(blob, tmp_path)
+
+		try:
+			os.replace(tmp_path, path)
+		except BaseException:
+			os.remove(tmp_path)
+			raise
+
+
+class LocalBackend:
+	"""
+	Images are files at their paths, written with write_atomic and fsync (image_fsync by default).
+	The directories already made are remembered, so a directory is created once per run and not once per image.
+	"""
+
+	def __init__(self, fsync=None):
+		self.fsync = fsync
+		self.directories = set()
+
+	def put(self, path, chunks):
+		"""
+		Stores chunks as the content of path, returns the count of bytes written
+		"""
+		directory = os.path.dirname(path) or "."
+		if directory not in self.directories:
+			os.makedirs(directory, exist_ok=True)
+			self.directories.add(directory)
+
+		return write_atomic(path, chunks, fsync=self.fsync, makedirs=False)
+
+	def size(self, path):
+		"""
+		Size of what is stored at path, None if nothing is
+		"""
+		return os.path.getsize(path) if os.path.exists(path) else None
+
+
+class S3Backend:
+	"""
+	Images are objects of an S3 compatible storage, keyed by storage_prefix and their path under root.
+	An object is stored completely or not at all, so no temp objects are needed.
+	"""
+
+	def __init__(self, root, bucket=None, endpoint=None, prefix=None):
+		self.root = root
+		self.bucket = bucket or storage_bucket
+		self.prefix = storage_prefix if prefix is None else prefix
+		# a boto3 client is thread safe, a session is not, so the session is not kept
+		self.client = boto3.session.Session().client("s3", endpoint_url=endpoint or storage_endpoint)
+
+	def key(self, path):
+		return self.prefix + os.path.relpath(path, self.root).replace(os.sep, "/")
+
+	def put(self, path, chunks):
+		body = b"".join(chunks)
+		self.client.put_object(Bucket=self.bucket, Key=self.key(path), Body=body)
+		return len(body)
+
+	def size(self, path):
+		from botocore.exceptions import ClientError
+
+		try:
+			return self.client.head_object(Bucket=self.bucket, Key=self.key(path))["ContentLength"]
+		except ClientError as e:
+			if e.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound"):
+				return None
+			raise
+
+
+def make_backend(root, fsync=None):
+	"""
+	Storage backend of the images under root chosen by storage_backend, fsync is that of the local files
+	"""
+	if storage_backend == "s3":
+		if boto3 is None:
+			raise RuntimeError("storage_backend \"s3\" needs boto3, which is not installed")
+		return S3Backend(root)
+	elif storage_backend == "local":
+		return LocalBackend(fsync)
+
+	raise ValueError("Unknown storage_backend {!r}".format(storage_backend))
+
+
+class WriteBehind:
+	"""
+	Runs write(path, chunks) of the images on worker threads, so the downloads do not wait for the storage.
+	The images queued or being written take at most queue_bytes of memory, put() waits for writes to finish
+	beyond that. An image larger than that is queued alone.
+	"""
+
+	def __init__(self, write, workers, queue_bytes):
+		self.write = write
+		self.pool = ThreadPoolExecutor(max_workers=workers)
+		self.queue_bytes = queue_bytes
+		self.queued = 0
+		self.room = threading.Condition()
+
+	def put(self, path, chunks):
+		"""
+		Queues the write of chunks, a list held in memory till it is written.
+		Returns the Future of the write, done when the image is stored or the write failed
+		"""
+		size = sum(len(chunk) for chunk in chunks)
+		with self.room:
+			while self.queued and self.queued + size > self.queue_bytes:
+				self.room.wait()
+			self.queued += size
+
+		try:
+			future = self.pool.submit(self.write, path, chunks)
+		except BaseException:
+			self.written(size)
+			raise
+		future.add_done_callback(lambda f: self.written(size))
+		return future
+
+	def written(self, size):
+		with self.room:
+			self.queued -= size
+			self.room.notify_all()
+
+	def close(self):
+		self.pool.shutdown()
+
+
+def validator(resp):
+	"""
+	Validator of the response for If-Range: its strong ETag or Last-Modified, None if it has neither
+	"""
+	etag = resp.headers.get("ETag")
+	if etag and not etag.startswith("W/"):
+		return etag
+	return resp.headers.get("Last-Modified")
+
+
+def range_start(resp):
+	"""
+	First byte of the body of a 206 response from its Content-Range: "bytes <first>-<last>/<length>"
+	"""
+	content_range = resp.headers.get("Content-Range", "")
+	unit, _, byte_range = content_range.partition(" ")
+	first = byte_range.partition("-")[0]
+	return int(first) if unit == "bytes" and first.isdigit() else None
+
+
+class PartStore:
+	"""
+	Partial downloads of large images kept across retries and runs: directory/<sha1 of url>.part
+	with the bytes received so far and .json with the url and the validator of the response they came with.
+	A part is continued with Range from its size and If-Range with its validator, so the server sends
+	the rest if the image has not changed and the whole new image if it has.
+	The parts being written are remembered, so that two threads never write the same one.
+	"""
+
+	def __init__(self, directory):
+		self.directory = directory
+		self.busy = set()
+		self.lock = threading.Lock()
+
+	def part_path(self, url):
+		return os.path.join(self.directory, hashlib.sha1(url.encode("utf8")).hexdigest() + ".part")
+
+	def meta_path(self, url):
+		return self.part_path(url)[:-len(".part")] + ".json"
+
+	def size(self, url):
+		path = self.part_path(url)
+		return os.path.getsize(path) if os.path.exists(path) else 0
+
+	def resume_headers(self, url):
+		"""
+		Range and If-Range headers continuing the part of url, {} if there is none or it cannot be continued
+		"""
+		size = self.size(url)
+		if not size or not os.path.exists(self.meta_path(url)):
+			return {}
+
+		with open(self.meta_path(url), encoding="utf8") as f:
+			meta = json.load(f)
+		if meta["url"] != url or not meta["validator"]:
+			return {}
+
+		return {"Range": "bytes={}-".format(size), "If-Range": meta["validator"]}
+
+	def wanted(self, resp):
+		"""
+		Whether the body of resp goes to a part file: the rest of a part, or a whole image that is
+		large enough and has a validator to resume it by
+		"""
+		if resp.status_code == 206:
+			return True
+
+		length = resp.headers.get("Content-Length", "")
+		return resp.headers.get("Content-Encoding", "identity") == "identity" and validator(resp) is not None \
+			and length.isdigit() and int(length) >= image_resume_min_size
+
+	def acquire(self, url):
+		with self.lock:
+			if url in self.busy:
+				return False
+			self.busy.add(url)
+			return True
+
+	def release(self, url):
+		with self.lock:
+			self.busy.discard(url)
+
+	def receive(self, url, resp, chunks):
+		"""
+		Writes chunks, the body of resp, to the part of url: appends the rest of the part from a 206,
+		starts the part over from a 200. Raises IncompleteResponse, after removing the part,
+		if a 206 does not continue it.
+		"""
+		# id_transport imports id_metrics, which imports this module
+		from id_transport import IncompleteResponse
+
+		if resp.status_code == 206:
+			if range_start(resp) != self.size(url):
+				self.remove(url)
+				raise IncompleteResponse("Range {!r} of {} does not continue its part".format(
+					resp.headers.get("Content-Range"), url), response=resp)
+			mode = "ab"
+		else:
+			os.makedirs(self.directory, exist_ok=True)
+			write_atomic(self.meta_path(url), [json.dumps({"url": url, "validator": validator(resp)}).encode("utf8")],
+						 fsync="never")
+			mode = "wb"
+
+		with open(self.part_path(url), mode) as f:
+			for chunk in chunks:
+				f.write(chunk)
+
+	def read(self, url):
+		with open(self.part_path(url), "rb") as f:
+			for chunk in iter(lambda: f.read(http_chunk_size), b""):
+				yield chunk
+
+	def remove(self, url):
+		for path in (self.part_path(url), self.meta_path(url)):
+			if os.path.exists(path):
+				os.remove(path)
+
+	def expire(self, max_age, now=None):
+		"""
+		Removes the parts last written to more than max_age seconds ago, whose images the feed may not
+		have any more, returns how many
+		"""
+		if not os.path.isdir(self.directory):
+			return 0
+
+		now = now or time.time()
+		# <sha1 of url> -> the time its part or .json was last written to
+		written = {}
+		for name in os.listdir(self.directory):
+			stem, ext = os.path.splitext(name)
+			if ext in (".part", ".json"):
+				mtime = os.path.getmtime(os.path.join(self.directory, name))
+				written[stem] = max(written.get(stem, 0), mtime)
+
+		expired = 0
+		for stem, mtime in written.items():
+			if now - mtime <= max_age:
+				continue
+			for ext in (".part", ".json"):
+				path = os.path.join(self.directory, stem + ext)
+				if os.path.exists(path):
+					os.remove(path)
+			expired += 1
+		return expired
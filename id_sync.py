@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+
+import hashlib
+from decimal import Decimal
+
+import id_db
+
+
+NEW = "new"
+CHANGED = "changed"
+UNCHANGED = "unchanged"
+
+
+def to_int(value):
+	"""
+	Price as an int, be it an int of the feed or a Decimal (10.00) of the Numeric column
+	"""
+	try:
+		return int(Decimal(value))
+	except (TypeError, ValueError, ArithmeticError):
+		return None
+
+
+def fingerprint(available, name, url, price, price_old, currency, img_small, img_large):
+	"""
+	Fingerprint of the fields of a product, the same for a feed product and its FeedStore row:
+	available of a row is None until it is set, of a product it is True or False
+	"""
+	values = (bool(available), name, url, to_int(price), to_int(price_old), currency, img_small, img_large)
+	return hashlib.md5("\x1f".join("" if v is None else str(v) for v in values).encode("utf8")).digest()
+
+
+def shard_of(code, shard_count):
+	return int.from_bytes(hashlib.md5(code.encode("utf8")).digest()[:4], "big") % shard_count
+
+
+def product_fingerprint(product):
+	return fingerprint(product.available, product.name, product.url, product.price, product.price_old,
+					   product.currency, product.img_small, product.img_large)
+
+
+class SiteIndex:
+	"""
+	Index of the FeedStore rows of a site:
+	code -> (fingerprint, img_small, img_large, path_img_small, path_img_large, available).
+	Classifies feed products as new, changed or unchanged and remembers which codes the feed had,
+	so that the rest are reported as removed, unless they are unavailable already.
+	"""
+
+	def __init__(self, rows):
+		self.entries = {}
+		for row in rows:
+			self.entries[row.code] = (fingerprint(row.available, row.name, row.url, row.price, row.price_old,
+												  row.currency, row.img_small, row.img_large),
+									  row.img_small, row.img_large, row.path_img_small, row.path_img_large, row.available)
+
+		self.seen = set()
+		self.counts = {NEW: 0, CHANGED: 0, UNCHANGED: 0}
+
+	@classmethod
+	def load(cls, site_name, shard=0, shard_count=1):
+		"""
+		Index of the rows of the site, of its shard if it is split into shard_count shards by shard_of
+		"""
+		rows = id_db.get_product_index_rows(site_name)
+		if shard_count > 1:
+			rows = [row for row in rows if row.code is not None and shard_of(row.code, shard_count) == shard]
+		return cls(rows)
+
+	def classify(self, product):
+		code = product.code
+		self.seen.add(code)
+
+		entry = self.entries.get(code)
+		if entry is None:
+			state = NEW
+		elif entry[0] == product_fingerprint(product):
+			state = UNCHANGED
+		else:
+			state = CHANGED
+
+		self.counts[state] += 1
+		return state
+
+	def skip(self, code):
+		"""
+		Counts the product as seen and unchanged without comparing it
+		"""
+		self.seen.add(code)
+		self.counts[UNCHANGED] += 1
+
+	def image_paths(self, product):
+		"""
+		Stored paths of the product images that did not change since they were downloaded,
+		None for the ones that have to be downloaded
+		"""
+		entry = self.entries.get(product.code)
+		if entry is None:
+			return None, None
+
+		_, img_small, img_large, path_small, path_large, _ = entry
+		return (path_small if path_small and img_small == product.img_small else None,
+				path_large if path_large and img_large == product.img_large else None)
+
+	def removed(self):
+		return [code for code, entry in self.entries.items() if code not in self.seen and entry[5]]
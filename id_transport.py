@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import random
+import threading
+import time
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from id_metrics import metrics
+from id_ratelimit import HostRate, retry_after
+from id_config import site_rate_limits, rate_min, rate_max, http_pool_size, http_connect_timeout, http_read_timeout, \
+	http_retries, http_backoff_base, http_backoff_max, http_retry_statuses, http_chunk_size
+
+
+class IncompleteResponse(requests.RequestException):
+	pass
+
+
+class Transport:
+	"""
+	HTTP transport for one site: a keep-alive session with a connection pool of http_pool_size,
+	connect/read timeouts and retries of idempotent GETs with jittered exponential backoff.
+	Every attempt, retries included, waits for the adaptive rate limit of the host it goes to
+	(id_ratelimit.HostRate) and reports the outcome back to it. share is the part of the rate budget
+	of the site this transport may use.
+	stage ("feed", "info", "image") only labels the request metrics.
+	"""
+
+	RETRY_EXCEPTIONS = (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError)
+
+	OVERLOAD_STATUSES = (429, 503)
+
+	def __init__(self, site_name, logger_name, share=1.0):
+		self.site_name = site_name
+		self.logger_name = logger_name
+		self.share = share
+		self.rates = {}
+		self.rates_lock = threading.Lock()
+
+		adapter = HTTPAdapter(pool_connections=1, pool_maxsize=http_pool_size, max_retries=0)
+		self.session = requests.Session()
+		self.session.verify = False
+		self.session.mount("http://", adapter)
+		self.session.mount("https://", adapter)
+
+	def host_rate(self, url):
+		host = urlparse(url).netloc
+		with self.rates_lock:
+			rate = self.rates.get(host)
+			if rate is None:
+				minimum, maximum = site_rate_limits.get(self.site_name, (rate_min, rate_max))
+				rate = self.rates[host] = HostRate(host, self.logger_name, minimum, maximum, self.share)
+			return rate
+
+	def get(self, url, stage="other", **kwargs):
+		logger = logging.getLogger(self.logger_name)
+
+		kwargs.setdefault("timeout", (http_connect_timeout, http_read_timeout))
+
+		rate = self.host_rate(url)
+		attempt = 0
+		while True:
+			rate.acquire()
+			started = time.monotonic()
+			try:
+				resp = self.session.get(url, **kwargs)
+			except self.RETRY_EXCEPTIONS as e:
+				metrics.inc("http_errors_total", site=self.site_name, stage=stage, error=type(e).__name__)
+				if isinstance(e, (requests.ConnectionError, requests.Timeout)):
+					rate.failure(type(e).__name__)
+				if attempt >= http_retries:
+					raise
+				logger.warning("{} when getting {}, retrying".format(type(e).__name__, url))
+			else:
+				metrics.observe("http_request_seconds", time.monotonic() - started, site=self.site_name, stage=stage)
+				metrics.inc("http_requests_total", site=self.site_name, stage=stage, status=resp.status_code)
+				if not kwargs.get("stream"):
+					metrics.inc("http_bytes_total", len(resp.content), site=self.site_name, stage=stage)
+
+				if resp.status_code in self.OVERLOAD_STATUSES:
+					rate.failure("status {}".format(resp.status_code), retry_after(resp.headers.get("Retry-After")))
+				elif resp.status_code < 500:
+					rate.success(time.monotonic() - started)
+
+				if resp.status_code not in http_retry_statuses or attempt >= http_retries:
+					return resp
+				logger.warning("Error {} when getting {}, retrying".format(resp.status_code, url))
+				resp.close()
+
+			metrics.inc("http_retries_total", site=self.site_name, stage=stage)
+			time.sleep(self.backoff(attempt))
+			attempt += 1
+
+	def download(self, url, receive, stage="image", headers=None):
+		"""
+		GETs url with stream=True and passes the response and the iterator over its body to receive(resp, chunks).
+		Returns the response and what receive returned, None if the response is not a 2xx one.
+		A body that breaks off (the exceptions of get and IncompleteResponse raised while receive reads it)
+		is requested again with the same backoff, up to http_retries times.
+		headers may be a function called before every attempt, so that an attempt can continue what the
+		one before it received.
+		"""
+		logger = logging.getLogger(self.logger_name)
+
+		attempt = 0
+		while True:
+			resp = self.get(url, stage=stage, stream=True, headers=headers() if callable(headers) else headers)
+			with resp:
+				if not 200 <= resp.status_code < 300:
+					return resp, None
+
+				try:
+					return resp, receive(resp, self.iter_body(resp, stage))
+				except self.RETRY_EXCEPTIONS + (IncompleteResponse,) as e:
+					metrics.inc("http_errors_total", site=self.site_name, stage=stage, error=type(e).__name__)
+					if isinstance(e, (requests.ConnectionError, requests.Timeout)):
+						self.host_rate(url).failure(type(e).__name__)
+					if attempt >= http_retries:
+						raise
+					logger.warning("{} when reading {}, retrying".format(type(e).__name__, url))
+
+			metrics.inc("http_retries_total", site=self.site_name, stage=stage)
+			time.sleep(self.backoff(attempt))
+			attempt += 1
+
+	def iter_body(self, resp, stage="image"):
+		"""
+		Iterates over the body of a stream=True response in http_chunk_size chunks.
+		Raises IncompleteResponse at the end if the body is shorter or longer than its Content-Length
+		"""
+		expected = resp.headers.get("Content-Length")
+		if resp.headers.get("Content-Encoding", "identity") != "identity":
+			expected = None
+
+		size = 0
+		try:
+			for chunk in resp.iter_content(chunk_size=http_chunk_size):
+				size += len(chunk)
+				yield chunk
+		finally:
+			metrics.inc("http_bytes_total", size, site=self.site_name, stage=stage)
+
+		if expected is not None and expected.isdigit() and size != int(expected):
+			raise IncompleteResponse("Got {} bytes of {} from {}".format(size, expected, resp.url), response=resp)
+
+	@staticmethod
+	def backoff(attempt):
+		# "full jitter": uniform in [0, base * 2^attempt], capped
+		return random.uniform(0, min(http_backoff_max, http_backoff_base * 2 ** attempt))
+
+	def close(self):
+		self.session.close()
@@ -1,85 +1,569 @@
 #!/usr/bin/python3.5
 # -*- coding: utf-8 -*-
 
+import asyncio
+import functools
+import hashlib
 import logging
 import os
 import os.path
+import threading
 import time
+from concurrent.futures import Future, ThreadPoolExecutor
 
 import requests
 from lxml import etree
 
 import id_db
-from id_common import get_child, init_logger
-from id_config import program_name, base_worker_logger_name, crawl_delay
+import id_imaging
+import id_retry
+import id_sync
+from id_common import init_logger, PER_PRODUCT
+from id_config import program_name, base_worker_logger_name, download_mode, async_concurrency, feed_streaming, \
+	db_bulk_writes, db_batch_size, db_flush_interval, pipeline_image_workers, pipeline_info_workers, \
+	pipeline_queue_size, pipeline_report_interval, http_cache, http_cache_dir, image_store, cas_dir, \
+	checkpoints, checkpoint_dir, image_check, image_check_workers, image_check_queue, storage_backend, \
+	storage_write_behind, storage_workers, storage_queue_bytes, retry_failed, retry_batch, image_resume, image_part_dir, \
+	image_part_max_age
+from id_cache import ValidatorCache, NOT_MODIFIED
+from id_journal import Journal, DONE, IMAGES, INFO, SIZES
+from id_metrics import metrics
+from id_feed import FeedStream
+from id_pipeline import Pipeline
+from id_product import Product, InvalidProduct, parse_products
+from id_spool import FeedSpool
+from id_storage import hashed, ContentStore, WriteBehind, PartStore, make_backend
+from id_transport import Transport
+
+
+def timed(stage):
+	"""
+	Records the duration of every call of an ImageDownloader method as stage_seconds of the stage
+	"""
+	def decorator(method):
+		@functools.wraps(method)
+		def wrapper(self, *args, **kwargs):
+			with metrics.timer("stage_seconds", site=self.site_name, stage=stage):
+				return method(self, *args, **kwargs)
+		return wrapper
+	return decorator
+
+
+def image_row(small, large):
+	"""
+	[path_small, path_large, hash_small, hash_large, status_small, status_large] of a product
+	from the (path, sha256, status) of its images, a Future of it if an image is a Future still being checked
+	"""
+	pending = [image for image in (small, large) if isinstance(image, Future)]
+	if not pending:
+		(path_small, hash_small, status_small), (path_large, hash_large, status_large) = small, large
+		return [path_small, path_large, hash_small, hash_large, status_small, status_large]
+
+	row = Future()
+
+	def next_done(_=None):
+		# the callback of the next Future is added once the one before it is done, so the row is set once
+		if pending:
+			pending.pop().add_done_callback(next_done)
+			return
+
+		try:
+			row.set_result(image_row(*[image.result() if isinstance(image, Future) else image
+									   for image in (small, large)]))
+		except Exception as e:
+			row.set_exception(e)
+
+	next_done()
+	return row
 
 
 class ImageDownloader:
-	def __init__(self, site_name, base_path):
+	"""
+	Downloads the products and images of a site, or of one of its shard_count shards (see id_sync.shard_of).
+	The shards of a site share the feed through a FeedSpool in spool_dir and its request rate budget.
+	"""
+
+	def __init__(self, site_name, base_path, mode=None, shard=0, shard_count=1, spool_dir=None):
 		self.site_name = site_name
 		self.base_path = base_path
+		self.mode = mode or download_mode
+		self.shard = shard
+		self.shard_count = shard_count
+		self.spool = FeedSpool(os.path.join(spool_dir, site_name), shard_count) if shard_count > 1 else None
+		# name of the per-site state files, journal and validator cache, which shards keep separately
+		self.state_name = site_name if shard_count == 1 else "{}.{}-of-{}".format(site_name, shard, shard_count)
 		self.worker_logger_name = "{}{}.log".format(base_worker_logger_name, self.site_name)
+		self.transport = None
+		self.index = None
+		self.writer = None
+		self.journal = None
+		self.retries = None
+		self.pending_checkpoints = []
+		self.pipeline = None
+		self.cache = None
+		self.content_store = ContentStore(base_path + "/" + cas_dir) \
+			if image_store == "cas" and storage_backend == "local" else None
+		self.storage = None
+		self.write_behind = None
+		self.parts = PartStore(os.path.join(base_path, image_part_dir, self.state_name)) if image_resume else None
+		# product code -> Futures of its image writes queued by write_behind
+		self.pending_writes = {}
+		# (product, xml_timestamp, paths, writes) of the products whose image rows wait for their writes
+		self.waiting_rows = []
+		self.feed_headers = {}
+		self.stats_lock = threading.Lock()
+		self.image_count = 0
+		self.image_bytes = 0
+		self.image_cache_hits = 0
+		self.image_invalid = 0
+		# images and product infos that could not be downloaded or stored
+		self.failed_items = 0
+		self.checker = None
+		# threads checking and storing the downloaded images, so that a download does not wait for its check
+		self.check_pool = None
+		self.check_slots = None
 
 	def run(self):
+		"""
+		Returns {"duration": seconds, "products": products in the feed, "changed": products new, changed or removed}
+		if the site was processed, {"changed": 0, "skipped": True} if its feed has not changed, None otherwise
+		"""
 		from id_config import db_username, db_password, db_host, db_name
 
-		init_logger(self.worker_logger_name)
+		started = time.monotonic()
+
+		init_logger(self.worker_logger_name, self.site_name)
 
 		logger = logging.getLogger(self.worker_logger_name)
 
-		logger.info("Started site {}".format(self.site_name))
+		logger.info("Started site {} in {} mode".format(self.state_name, self.mode))
+
+		self.transport = Transport(self.site_name, self.worker_logger_name, share=1.0 / self.shard_count)
+		self.checker = id_imaging.checker() if image_check else None
+		if self.checker:
+			self.check_pool = ThreadPoolExecutor(max_workers=image_check_workers)
+			self.check_slots = threading.BoundedSemaphore(image_check_queue)
 
 		try:
 			id_db.connect(db_username, db_password, db_host, db_name)
 
-			products, xml_timestamp = self.get_products(self.site_name)
+			if storage_write_behind and not self.content_store:
+				self.storage = make_backend(self.base_path, fsync="dir")
+				self.write_behind = WriteBehind(self.write_image, storage_workers, storage_queue_bytes)
+			else:
+				self.storage = make_backend(self.base_path)
+
+			if self.parts:
+				expired = self.parts.expire(image_part_max_age * 24 * 3600)
+				if expired:
+					logger.info("Removed {} partial downloads not continued for {} days".format(
+						expired, image_part_max_age))
+
+			if http_cache:
+				os.makedirs(http_cache_dir, exist_ok=True)
+				self.cache = ValidatorCache(os.path.join(http_cache_dir, "{}.json".format(self.state_name)))
+
+			if retry_failed:
+				self.drain_retries()
+
+			if self.spool:
+				products, xml_timestamp = self.spool.open(self.shard, lambda: self.get_products(self.site_name))
+			else:
+				products, xml_timestamp = self.get_products(self.site_name)
+			if products is NOT_MODIFIED or (self.cache and xml_timestamp and xml_timestamp == self.cache.feed_timestamp):
+				if isinstance(products, FeedStream):
+					products.close()
+				logger.info("Product list of site {} has not changed since the last run".format(self.site_name))
+				return {"changed": 0, "skipped": True}
+
 			if products is None:
 				logger.error("Skipping site {} due to error while getting product list".format(self.site_name))
 				return
 
-			processed_codes = id_db.get_product_codes_for_site(self.site_name)
-			processed_codes = [c[0] for c in processed_codes]
-			skip_count = 0
+			self.index = id_sync.SiteIndex.load(self.site_name, self.shard, self.shard_count)
+			if db_bulk_writes:
+				self.writer = id_db.BulkWriter(self.site_name, db_batch_size, db_flush_interval,
+											   after_flush=self.flush_checkpoints)
+
+			if checkpoints and xml_timestamp:
+				journal_dir = os.path.join(self.base_path, checkpoint_dir)
+				os.makedirs(journal_dir, exist_ok=True)
+				self.journal = Journal(os.path.join(journal_dir, "{}.journal".format(self.state_name)), xml_timestamp)
+				if self.journal.stages:
+					logger.info("Resuming site {} from {} checkpointed products".format(
+						self.site_name, len(self.journal.stages)))
+
+			if not self.spool:
+				products = parse_products(products)
+
+			if self.mode == "async":
+				self.process_products_async(self.changed_products(products), xml_timestamp)
+			elif self.mode == "pipeline":
+				self.process_products_pipeline(self.changed_products(products), xml_timestamp)
+			else:
+				self.process_products(self.changed_products(products), xml_timestamp)
 
-			for product in products:
-				code = get_child(product, "code")
-				if code is None:
-					continue
+			if self.write_behind:
+				self.store_written(wait=True)
 
-				if code in processed_codes:
-					skip_count += 1
-					continue
+			if self.writer:
+				self.writer.close()
 
-				paths = self.download_images(self.site_name, product, self.base_path)
-				if paths:
-					id_db.store_product_data(self.site_name, product, xml_timestamp, *paths)
-				else:
-					logger.warning(
-						"Images were not downloaded for product code {}, site {}".format(get_child(product, "code"),
-																						 self.site_name))
+			if self.retries:
+				self.retries.save()
 
-				product_info = self.get_product_info(self.site_name, product)
-				if product_info:
-					id_db.store_product_sizes(self.site_name, product_info, xml_timestamp)
-				else:
-					logger.info(
-						"Cannot get product sizes for product code {}, site {}".format(get_child(product, "code"),
-																					   self.site_name))
+			if not (self.spool.count if self.spool else self.index.seen):
+				logger.error("Empty xml of product list for some reason for site {}".format(self.site_name))
+				return
 
-			logger.info("Skipped {} products as they where already in DB".format(skip_count))
-			logger.info("Finished site {}".format(self.site_name))
+			removed = self.index.removed()
+			if removed:
+				id_db.mark_products_unavailable(self.site_name, removed)
+
+			logger.info("Products: {} new, {} changed, {} unchanged, {} removed".format(
+				self.index.counts[id_sync.NEW], self.index.counts[id_sync.CHANGED],
+				self.index.counts[id_sync.UNCHANGED], len(removed)))
+			logger.info("Downloaded {} images, {} bytes, {} images not modified, {} invalid".format(
+				self.image_count, self.image_bytes, self.image_cache_hits, self.image_invalid))
+
+			if self.cache and self.failed_items:
+				# the feed is read again the next run, so that what failed is retried even if it has not changed
+				logger.info("{} items of site {} failed, the feed is not skipped the next run".format(
+					self.failed_items, self.site_name))
+			elif self.cache:
+				self.cache.update(self.feed_url(self.site_name), self.feed_headers)
+				self.cache.feed_timestamp = xml_timestamp
+			if self.cache:
+				self.cache.save()
+
+			if self.journal:
+				self.journal.remove()
+				self.journal = None
+
+			logger.info("Finished site {}".format(self.state_name))
+			metrics.inc("products_total", self.index.counts[id_sync.NEW], site=self.site_name, state=id_sync.NEW)
+			metrics.inc("products_total", self.index.counts[id_sync.CHANGED], site=self.site_name, state=id_sync.CHANGED)
+			metrics.inc("products_total", self.index.counts[id_sync.UNCHANGED], site=self.site_name, state=id_sync.UNCHANGED)
+			metrics.inc("products_total", len(removed), site=self.site_name, state="removed")
+
+			return {"duration": time.monotonic() - started, "products": len(self.index.seen),
+					"changed": self.index.counts[id_sync.NEW] + self.index.counts[id_sync.CHANGED] + len(removed)}
 		except Exception as e:
 			logger.exception("Exception during {} run".format(program_name))
 			logger.error("Skipping site {}".format(self.site_name))
+
+			if self.writer and self.writer.pending():
+				try:
+					self.writer.flush()
+				except Exception as e:
+					logger.exception("Cannot write {} buffered rows of site {}".format(self.writer.pending(), self.site_name))
+
+			if self.retries:
+				try:
+					self.retries.save()
+				except Exception as e:
+					logger.exception("Cannot save the retry queue of site {}".format(self.site_name))
 		finally:
+			if self.check_pool:
+				self.check_pool.shutdown()
+			if self.write_behind:
+				self.write_behind.close()
+			if self.journal:
+				self.journal.close()
+			self.transport.close()
 			id_db.disconnect()
 
+	def drain_retries(self):
+		"""
+		Retries the due items of the retry queue before the feed is read. The products are rebuilt
+		from their FeedStore rows and only the images with empty paths are downloaded again.
+		"""
+		logger = logging.getLogger(self.worker_logger_name)
+
+		self.retries = id_retry.RetryQueue.load(self.site_name, self.worker_logger_name, self.shard, self.shard_count)
+		due = self.retries.due(retry_batch)
+		if not due:
+			return
+
+		codes = sorted(set(code for stage_codes in due.values() for code in stage_codes))
+		logger.info("Retrying {} failed items of site {}".format(sum(len(c) for c in due.values()), self.site_name))
+
+		# image_paths of the index keep the images that were downloaded
+		self.index = id_sync.SiteIndex.load(self.site_name, self.shard, self.shard_count)
+		rows = {row.code: row for row in id_db.get_retry_products(self.site_name, codes)}
+
+		for stage, stage_codes in sorted(due.items()):
+			for code in stage_codes:
+				row = rows.get(code)
+				if row is None or not row.available:
+					# nothing stored to retry or the product was removed from the feed,
+					# the feed has it as a new or changed one if it lists it again
+					self.retries.succeeded(code, stage)
+					continue
+
+				product = Product(row.code, row.available, row.name, row.url, row.price, row.price_old, row.currency,
+								  row.img_small, row.img_large)
+				if stage == id_retry.IMAGES:
+					paths = self.download_images(self.site_name, product, self.base_path)
+					self.store_images(product, row.time_xml, paths)
+				else:
+					product_info = self.get_product_info(self.site_name, product)
+					self.store_product_info(product, row.time_xml, product_info)
+
+		if self.write_behind:
+			self.store_written(wait=True)
+
+		self.retries.save()
+
+	def retry_later(self, code, stage, error):
+		with self.stats_lock:
+			self.failed_items += 1
+		if self.retries:
+			self.retries.failed(code, stage, error)
+
+	def retry_done(self, code, stage):
+		if self.retries:
+			self.retries.succeeded(code, stage)
+
+	def changed_products(self, products):
+		"""
+		Yields the Product records of the feed products (see id_product.parse_products) that are new
+		or changed since the last run and of the ones an interrupted run over the same feed did not finish.
+		Invalid products are logged and left as they are stored.
+		"""
+		logger = logging.getLogger(self.worker_logger_name)
+
+		for product in products:
+			if isinstance(product, InvalidProduct):
+				if product.code is not None:
+					self.index.skip(product.code)
+				metrics.inc("products_invalid_total", site=self.site_name)
+				logger.warning("Skipping product: {}".format(product))
+				continue
+
+			if self.journal and self.journal.complete(product.code):
+				self.index.skip(product.code)
+				continue
+
+			if self.index.classify(product) != id_sync.UNCHANGED or (self.journal and self.journal.started(product.code)):
+				yield product
+
+	def checkpoint(self, product, stage):
+		if not self.journal:
+			return
+
+		code = product.code
+		if self.writer:
+			# the rows are only buffered, the stage is done once they are flushed
+			self.pending_checkpoints.append((code, stage))
+		else:
+			self.journal.append(code, stage)
+
+	def flush_checkpoints(self):
+		if self.journal:
+			for code, stage in self.pending_checkpoints:
+				self.journal.append(code, stage)
+		self.pending_checkpoints = []
+
+	def process_products(self, products, xml_timestamp):
+		for product in products:
+			paths = self.download_images(self.site_name, product, self.base_path)
+			self.store_images(product, xml_timestamp, paths)
+
+			product_info = self.get_product_info(self.site_name, product)
+			self.store_product_info(product, xml_timestamp, product_info)
+
+	def process_products_async(self, products, xml_timestamp):
+		"""
+		Same as process_products, but keeps up to async_concurrency products in flight.
+		Requests are run on a thread pool of async_concurrency threads and are still paced
+		by the adaptive rate limit of the transport, DB writes go through a single thread one at a time.
+		"""
+		loop = asyncio.new_event_loop()
+		asyncio.set_event_loop(loop)
+
+		net_pool = ThreadPoolExecutor(max_workers=async_concurrency)
+		db_pool = ThreadPoolExecutor(max_workers=1)
+
+		try:
+			loop.run_until_complete(self._process_products_async(loop, net_pool, db_pool, products, xml_timestamp))
+		finally:
+			net_pool.shutdown()
+			db_pool.shutdown()
+			asyncio.set_event_loop(None)
+			loop.close()
+
+	async def _process_products_async(self, loop, net_pool, db_pool, products, xml_timestamp):
+		semaphore = asyncio.Semaphore(async_concurrency)
+		tasks = set()
+		errors = []
+
+		async def process_product(product):
+			try:
+				images = loop.run_in_executor(net_pool, self.download_images, self.site_name, product, self.base_path)
+				info = loop.run_in_executor(net_pool, self.get_product_info, self.site_name, product)
+				paths, product_info = await asyncio.gather(images, info)
+
+				await loop.run_in_executor(db_pool, self.store_images, product, xml_timestamp, paths)
+				await loop.run_in_executor(db_pool, self.store_product_info, product, xml_timestamp, product_info)
+			except Exception as e:
+				errors.append(e)
+			finally:
+				semaphore.release()
+
+		for product in products:
+			if errors:
+				break
+
+			await semaphore.acquire()
+			task = asyncio.ensure_future(process_product(product))
+			tasks.add(task)
+			task.add_done_callback(tasks.discard)
+
+		if tasks:
+			await asyncio.wait(tasks)
+
+		if errors:
+			raise errors[0]
+
+	def process_products_pipeline(self, products, xml_timestamp):
+		"""
+		Same as process_products, but split into stages connected by bounded queues:
+		feed reader (this thread) -> image fetch -> product info fetch -> DB writer.
+		The DB writer has one thread since id_db keeps a single session.
+		"""
+		def fetch_images(product):
+			return product, self.download_images(self.site_name, product, self.base_path)
+
+		def fetch_info(item):
+			product, paths = item
+			return product, paths, self.get_product_info(self.site_name, product)
+
+		def store(item):
+			product, paths, product_info = item
+			self.store_images(product, xml_timestamp, paths)
+			self.store_product_info(product, xml_timestamp, product_info)
+
+		pipeline = Pipeline(self.worker_logger_name, pipeline_report_interval)
+		pipeline.add_stage("images", fetch_images, pipeline_image_workers, pipeline_queue_size)
+		pipeline.add_stage("info", fetch_info, pipeline_info_workers, pipeline_queue_size)
+		pipeline.add_stage("db", store, 1, pipeline_queue_size)
+
+		self.pipeline = pipeline
+		try:
+			pipeline.run(products)
+		finally:
+			self.pipeline = None
+
+	def store_images(self, product, xml_timestamp, paths):
+		"""
+		Stores the image rows of the product once its images are checked, with write_behind once they are written
+		"""
+		if paths is DONE:
+			return
+
+		if isinstance(paths, Future):
+			# the images are checked and stored by now, with write_behind their writes are queued
+			paths = paths.result()
+
+		if not self.write_behind:
+			self.store_image_rows(product, xml_timestamp, paths)
+			return
+
+		with self.stats_lock:
+			writes = self.pending_writes.pop(product.code, [])
+		self.waiting_rows.append((product, xml_timestamp, paths, writes))
+		self.store_written()
+
+	def store_written(self, wait=False):
+		"""
+		Stores the image rows of the products whose image writes are done, with wait of all of them
+		once their writes are done. A product an image of which cannot be written gets no image rows
+		and is downloaded again the next run.
+		"""
+		logger = logging.getLogger(self.worker_logger_name)
+
+		waiting = []
+		for product, xml_timestamp, paths, writes in self.waiting_rows:
+			if not wait and not all(write.done() for write in writes):
+				waiting.append((product, xml_timestamp, paths, writes))
+				continue
+
+			errors = [write.exception() for write in writes if write.exception() is not None]
+			if errors:
+				logger.error("Images of product code {}, site {} cannot be stored: {}".format(
+					product.code, self.site_name, errors[0]))
+				self.retry_later(product.code, id_retry.IMAGES, errors[0])
+				continue
+
+			self.store_image_rows(product, xml_timestamp, paths)
+
+		self.waiting_rows = waiting
+
+	@timed("db")
+	def store_image_rows(self, product, xml_timestamp, paths):
+		logger = logging.getLogger(self.worker_logger_name)
+
+		if paths and self.writer:
+			self.checkpoint(product, IMAGES)
+			self.writer.add_product(product, xml_timestamp, *paths)
+		elif paths:
+			id_db.store_product_data(self.site_name, product, xml_timestamp, *paths)
+			self.checkpoint(product, IMAGES)
+		else:
+			logger.warning(
+				"Images were not downloaded for product code {}, site {}".format(product.code, self.site_name))
+
+	@timed("db")
+	def store_product_info(self, product, xml_timestamp, product_info):
+		logger = logging.getLogger(self.worker_logger_name)
+
+		if product_info is DONE:
+			return
+
+		if product_info is NOT_MODIFIED:
+			self.checkpoint(product, INFO)
+		elif product_info is not None and self.writer:
+			self.checkpoint(product, SIZES)
+			self.writer.add_product_sizes(product_info, xml_timestamp)
+		elif product_info is not None:
+			id_db.store_product_sizes(self.site_name, product_info, xml_timestamp)
+			self.checkpoint(product, SIZES)
+		else:
+			logger.info(
+				"Cannot get product sizes for product code {}, site {}".format(product.code, self.site_name),
+				extra=PER_PRODUCT)
+
+	@staticmethod
+	def feed_url(site_name):
+		return "http://{}/feedxml_crm.php".format(site_name)
+
+	def conditional_headers(self, url):
+		return self.cache.headers(url) if self.cache else {}
+
+	@timed("feed")
 	def get_products(self, site_name):
+		"""
+		Returns the product list and its timestamp, (None, None) on errors,
+		(NOT_MODIFIED, None) if the feed did not change since the last completed run
+		"""
 		logger = logging.getLogger(self.worker_logger_name)
 
 		try:
-			resp = requests.get("http://{}/feedxml_crm.php".format(site_name), verify=False)
-			if resp.ok:
+			url = self.feed_url(site_name)
+			# the feed a shard reads is the one of all the shards, a 304 to the validators of the shard
+			# would skip the others too. A shard skips an unchanged feed by the timestamp it completed instead
+			headers = self.conditional_headers(url) if not self.spool else {}
+			resp = self.transport.get(url, stage="feed", stream=feed_streaming, headers=headers)
+			if resp.status_code == 304:
+				resp.close()
+				return NOT_MODIFIED, None
+
+			self.feed_headers = resp.headers
+			if resp.ok and feed_streaming:
+				feed = FeedStream(resp)
+				return feed, feed.timestamp
+			elif resp.ok:
 				root = etree.fromstring(resp.content)
 				if len(root) == 0:
 					logger.error("Empty xml of product list for some reason for site {}".format(site_name))
@@ -87,85 +571,252 @@ class ImageDownloader:
 
 				return root[0], root.get("timestamp")
 			else:
+				resp.close()
 				logger.error("Error {} when getting {} products".format(resp.status_code, site_name))
 				return None, None
 		except requests.RequestException as e:
 			logger.exception("Requests exception when getting {} products".format(site_name))
 			return None, None
 
+	@timed("info")
 	def get_product_info(self, site_name, product):
+		"""
+		Returns the Product record of the product info with its sizes, None on errors,
+		NOT_MODIFIED or DONE if there is nothing to write
+		"""
 		logger = logging.getLogger(self.worker_logger_name)
 
-		code = get_child(product, "code")
-		if code is None:
-			return None
+		code = product.code
+
+		if self.journal and self.journal.done(code, INFO):
+			return DONE
 
-		logger.info("Getting product {} info ".format(code))
+		logger.info("Getting product {} info ".format(code), extra=PER_PRODUCT)
 
 		try:
-			time.sleep(crawl_delay)
-			resp = requests.get("http://{}/feedxml_crm.php?code='{}'".format(site_name, code), verify=False)
-			if resp.ok:
+			url = "http://{}/feedxml_crm.php?code='{}'".format(site_name, code)
+			resp = self.transport.get(url, stage="info", headers=self.conditional_headers(url))
+			if resp.status_code == 304:
+				self.retry_done(code, id_retry.INFO)
+				return NOT_MODIFIED
+			elif resp.ok:
+				if self.cache:
+					self.cache.update(url, resp.headers)
+
 				root = etree.fromstring(resp.content)
 				if len(root) == 0 or len(root[0]) == 0:
 					logger.info("Empty xml for site {}".format(site_name))
+					self.retry_later(code, id_retry.INFO, "empty xml")
+					return None
+
+				try:
+					product_info = Product.from_element(root[0][0])
+				except InvalidProduct as e:
+					logger.warning("Invalid product info of {}: {}".format(site_name, e))
+					self.retry_later(code, id_retry.INFO, e)
 					return None
 
-				return root[0][0]
+				self.retry_done(code, id_retry.INFO)
+				return product_info
 			else:
 				logger.error("Error {} when getting {} product {}".format(resp.status_code, site_name, code))
+				self.retry_later(code, id_retry.INFO, "HTTP {}".format(resp.status_code))
 				return None
 		except requests.RequestException as e:
 			logger.exception("Requests exception when getting {} product {}".format(site_name, code))
+			self.retry_later(code, id_retry.INFO, e)
 			return None
 
+	@timed("images")
 	def download_images(self, site_name, product, base_path):
 		logger = logging.getLogger(self.worker_logger_name)
 		paths = None
 
-		code = get_child(product, "code")
-		img_small = get_child(product, "img_small")
-		img_large = get_child(product, "img_large")
+		code = product.code
+		img_small = product.img_small
+		img_large = product.img_large
 
-		try:
-			path_small = ""
-			path_large = ""
-
-			if img_small:
-				time.sleep(crawl_delay)
-				resp = requests.get("http://{}/{}".format(site_name, img_small), verify=False)
-
-				if resp.ok:
-					if not img_small.startswith("/"):
-						path_small = base_path + "/" + site_name + "/" + img_small
-					else:
-						path_small = base_path + "/" + site_name + img_small
-
-					os.makedirs(os.path.dirname(path_small), exist_ok=True)
-					with open(path_small, "wb") as f:
-						f.write(resp.content)
-				else:
-					logger.error("Error {} when downloading images for {} of {}".format(resp.status_code, code, site_name))
+		if self.journal and self.journal.done(code, IMAGES):
+			return DONE
 
-			if img_large:
-				time.sleep(crawl_delay)
-				resp = requests.get("http://{}/{}".format(site_name, img_large), verify=False)
+		path_small, path_large = self.index.image_paths(product) if self.index else (None, None)
+		small = (path_small, None, None)
+		large = (path_large, None, None)
 
-				if resp.ok:
-					if not img_large.startswith("/"):
-						path_large = base_path + "/" + site_name + "/" + img_large
-					else:
-						path_large = base_path + "/" + site_name + img_large
+		try:
+			if path_small is None:
+				small = self.download_image(site_name, code, img_small, base_path)
 
-					os.makedirs(os.path.dirname(path_large), exist_ok=True)
-					with open(path_large, "wb") as f:
-						f.write(resp.content)
-				else:
-					logger.error("Error {} when downloading images for {} of {}".format(resp.status_code, code, site_name))
+			if path_large is None:
+				large = self.download_image(site_name, code, img_large, base_path)
 
-			paths = [path_small, path_large]
+			paths = image_row(small, large)
+			self.retry_done(code, id_retry.IMAGES)
 		except requests.RequestException as e:
+			self.retry_later(code, id_retry.IMAGES, e)
 			logger.warning("Images were not downloaded due to network error")
 			logger.exception("Requests exception when downloading images for {} of {}".format(code, site_name))
 
-		return paths
\ No newline at end of file
+		return paths
+
+	def download_image(self, site_name, code, img, base_path):
+		"""
+		Downloads one image of the product, returns its path, sha256 and check status (see id_imaging),
+		("", None, None) if there is no image or it cannot be downloaded, ("", None, "invalid") if it is not an image.
+		The sha256 and status are None if the image was not downloaded because it has not changed
+		and the status is None if images are not checked. With image_check a downloaded image is
+		a Future of them, done when it is checked and stored.
+		"""
+		if not img:
+			return "", None, None
+
+		url = "http://{}/{}".format(site_name, img)
+
+		if not img.startswith("/"):
+			path = base_path + "/" + site_name + "/" + img
+		else:
+			path = base_path + "/" + site_name + img
+
+		# another thread downloading the same image keeps its part to itself
+		if self.parts and self.parts.acquire(url):
+			try:
+				return self.fetch_image(code, url, path, self.parts)
+			finally:
+				self.parts.release(url)
+
+		return self.fetch_image(code, url, path, None)
+
+	def fetch_image(self, code, url, path, parts):
+		"""
+		download_image of the image at url, continuing its part from parts if there is one
+		and keeping the part of a large image until it is stored.
+		The body is requested again if it breaks off, from where the part got to if the image has one.
+		"""
+		logger = logging.getLogger(self.worker_logger_name)
+
+		def headers():
+			resume = parts.resume_headers(url) if parts else {}
+			if resume:
+				metrics.inc("image_resumes_total", site=self.site_name)
+				return resume
+			if self.cache and self.cache.length(url) is not None \
+					and self.storage.size(path) == self.cache.length(url):
+				return self.cache.headers(url)
+			return {}
+
+		def receive(resp, body):
+			if parts and parts.wanted(resp):
+				parts.receive(url, resp, body)
+				body = parts.read(url)
+			elif parts:
+				# a 200 for a part is the image changed or sent whole, what is in the part is of no use
+				parts.remove(url)
+
+			if self.checker:
+				# the image is checked before it is stored, so what is not an image never gets there
+				return b"".join(body)
+			return self.store_image(code, path, body)
+
+		resp, received = self.transport.download(url, receive, stage="image", headers=headers)
+
+		if resp.status_code == 304:
+			with self.stats_lock:
+				self.image_cache_hits += 1
+			return path, None, None
+
+		if resp.status_code == 416 and parts and parts.size(url):
+			# the part does not fit the image any more, other errors keep it for the next attempt
+			parts.remove(url)
+			return self.fetch_image(code, url, path, parts)
+
+		if not resp.ok:
+			logger.error("Error {} when downloading images for {} of {}".format(
+				resp.status_code, code, self.site_name))
+			self.retry_later(code, id_retry.IMAGES, "HTTP {} for {}".format(resp.status_code, url))
+			return "", None, None
+
+		if parts:
+			parts.remove(url)
+
+		if not self.checker:
+			return self.stored(url, path, resp, received, None)
+
+		# checked and stored on the check threads, the download goes on with the next image meanwhile
+		self.check_slots.acquire()
+		try:
+			check = self.check_pool.submit(self.check_image, code, url, path, resp, received)
+		except BaseException:
+			self.check_slots.release()
+			raise
+		check.add_done_callback(lambda f: self.check_slots.release())
+		return check
+
+	def stored(self, url, path, resp, stored, status):
+		"""
+		Counts the image stored by store_image and keeps its validators, returns its path, sha256 and check status
+		"""
+		digest, size, write = stored
+		if self.cache and write:
+			# the validators are only good once the image is stored
+			def update_cache(future):
+				if future.exception() is None:
+					self.cache.update(url, resp.headers, size)
+
+			write.add_done_callback(update_cache)
+		elif self.cache:
+			self.cache.update(url, resp.headers, size)
+
+		with self.stats_lock:
+			self.image_count += 1
+			self.image_bytes += size
+
+		return path, digest, status
+
+	def store_image(self, code, path, chunks):
+		"""
+		Stores the image at path, returns its sha256, size and the Future of its write if write_behind queued it,
+		None if it is written already
+		"""
+		if self.content_store:
+			digest, size = self.content_store.put(path, chunks)
+			return digest, size, None
+
+		sha256 = hashlib.sha256()
+		if not self.write_behind:
+			size = self.write_image(path, hashed(chunks, sha256))
+			return sha256.hexdigest(), size, None
+
+		data = b"".join(hashed(chunks, sha256))
+		write = self.write_behind.put(path, [data])
+		with self.stats_lock:
+			self.pending_writes.setdefault(code, []).append(write)
+		return sha256.hexdigest(), len(data), write
+
+	@timed("storage")
+	def write_image(self, path, chunks):
+		return self.storage.put(path, chunks)
+
+	@timed("check")
+	def check_image(self, code, url, path, resp, data):
+		"""
+		Verifies the downloaded image on the checker processes and stores it, the normalised one
+		if the checker made it. Runs on the check threads, returns what download_image does.
+		"""
+		logger = logging.getLogger(self.worker_logger_name)
+
+		status, content, message = self.checker.submit(id_imaging.check_image, data).result()
+		metrics.inc("images_checked_total", site=self.site_name, status=status)
+
+		if status == id_imaging.INVALID:
+			logger.warning("Image {} of {} is rejected: {}".format(path, code, message))
+			with self.stats_lock:
+				self.image_invalid += 1
+			# often an error page sent with a 200, the image may well be there the next time
+			self.retry_later(code, id_retry.IMAGES, "{}: {}".format(url, message))
+			return "", None, status
+
+		if content is not None:
+			logger.info("Image {} of {} is normalised: {}".format(path, code, message))
+			data = content
+
+		return self.stored(url, path, resp, self.store_image(code, path, [data]), status)
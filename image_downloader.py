@@ -1,59 +1,452 @@
 #!/usr/bin/python3.5
 # -*- coding: utf-8 -*-
+import argparse
+import datetime
+import json
 import logging
-from utils.process import SilentProcessPool
+import os.path
+import shutil
+import signal
+import socket
+import threading
+import time
+from utils.process import SilentProcessPool, ResidentProcessPool
 
 from id_config import program_name
 
 import id_db
 import id_worker
 import id_common
+import id_profiler
+from id_metrics import metrics, Metrics
 
 
-def start_downloader_instance(q):
-	site, base_path = q
+def run_site(site, base_path, shard=0, shard_count=1, spool_dir=None):
+	from id_config import runner_log_name
+
 	try:
-		image_downloader = id_worker.ImageDownloader(site, base_path)
-		image_downloader.run()
+		image_downloader = id_worker.ImageDownloader(site, base_path, shard=shard, shard_count=shard_count,
+													 spool_dir=spool_dir)
+		with id_profiler.profiled(site, image_downloader.state_name, runner_log_name):
+			return image_downloader.run()
 	except KeyboardInterrupt:
 		raise
 	except:
-		pass
+		return None
+
+
+def start_downloader_instance(q):
+	# (site, base_path) or (site, base_path, shard, shard_count, spool_dir) for a shard of a split site
+	site, base_path = q[:2]
+	metrics.reset()
+	return site, run_site(site, base_path, *q[2:]), metrics.snapshot()
 
 # end of StartCrawler
 
 
-def main():
-	from id_config import db_username, db_password, db_host, db_name, base_path, process_pool_size, runner_log_name
+def init_worker_process(log_pipe, daemon, profile):
+	"""
+	Runs in every pool process before its first job. The process keeps its DB engine for all the jobs it runs.
+	log_pipe is the pipe of the process to the log listener of the runner, None if log_mode is not "queue",
+	and profile is (id_profiler.mode, id_profiler.sites) of the runner, processes that are not forked do not inherit it.
+	Daemon processes ignore SIGTERM, the runner lets them finish their current site when it gets one.
+	"""
+	from id_config import runner_log_name
 
+	if daemon:
+		signal.signal(signal.SIGTERM, signal.SIG_IGN)
+	id_db.persistent = True
+	id_common.log_queue = id_common.LogPipe(log_pipe) if log_pipe else None
+	id_profiler.mode, id_profiler.sites = profile
+	id_common.init_logger(runner_log_name)
+
+
+def pool_options(daemon=False):
+	from id_config import pool_start_method, pool_preload
+
+	return dict(context=pool_start_method, preload=pool_preload,
+				initializer=init_worker_process,
+				initargs=lambda: (id_common.log_pipe(), daemon, (id_profiler.mode, id_profiler.sites)))
+
+
+def drain_job_queue(q):
+	"""
+	Worker of the distributed mode: runs the jobs of the crawl claimed from crawl_job until none is left.
+	While jobs of other nodes are still running it keeps polling, as their jobs come back if the nodes die.
+	"""
+	from id_config import db_username, db_password, db_host, db_name, runner_log_name, job_poll_interval
+	from id_jobqueue import JobQueue
+
+	run_id, node, base_path, spool_dir = q
+	logger = logging.getLogger(runner_log_name)
+	metrics.reset()
+
+	results = []
+	queue = JobQueue(id_db.db_url(db_username, db_password, db_host, db_name), run_id, node, runner_log_name)
+	try:
+		while True:
+			job = queue.claim()
+			if job is None:
+				if not queue.unfinished():
+					break
+				time.sleep(job_poll_interval)
+				continue
+
+			logger.info("{} took job {} of site {}".format(node, job.id, job.site))
+			started = time.monotonic()
+			with queue.heartbeat(job):
+				site_stats = run_site(job.site, base_path, job.shard, job.shard_count, spool_dir)
+			queue.finish(job, site_stats)
+
+			metrics.observe("job_seconds", time.monotonic() - started, site=job.site)
+			metrics.inc("jobs_total", result="ok" if site_stats else "failed")
+			results.append((job.site, site_stats))
+	finally:
+		queue.close()
+
+	return node, results, metrics.snapshot()
+
+# end of drain_job_queue
+
+
+def load_site_stats(filename):
+	if not os.path.exists(filename):
+		return {}
+
+	with open(filename, encoding="utf8") as f:
+		return json.load(f)
+
+
+def save_site_stats(filename, stats):
+	tmp_filename = filename + ".tmp"
+	with open(tmp_filename, "w", encoding="utf8") as f:
+		json.dump(stats, f, indent=1, sort_keys=True)
+	os.replace(tmp_filename, filename)
+
+
+def site_cost(stats, product_counts):
+	"""
+	Estimated duration of a site job: the duration of its last run, or for sites that have not run yet
+	its product count in DB times the average time per product of the sites that have.
+	"""
+	runs = [s for s in stats.values() if "duration" in s]
+	total_duration = sum(s["duration"] for s in runs)
+	total_products = sum(s["products"] for s in runs)
+	per_product = total_duration / total_products if total_products else 1
+
+	def cost(job):
+		site = job[0]
+		shard_count = job[3] if len(job) > 3 else 1
+		if "duration" in stats.get(site, {}):
+			return stats[site]["duration"] / shard_count
+		return product_counts.get(site, 0) * per_product / shard_count
+
+	return cost
+
+# end of site_cost
+
+
+def shard_count(site, product_counts):
+	from id_config import shard_products, site_shards, process_pool_size
+
+	if site in site_shards:
+		return site_shards[site]
+	if not shard_products:
+		return 1
+	return max(1, min(process_pool_size, -(-product_counts.get(site, 0) // shard_products)))
+
+
+def site_jobs(sites, product_counts, base_path, spool_dir):
+	jobs = []
+	for site in sites:
+		count = shard_count(site, product_counts)
+		if count == 1:
+			jobs.append((site, base_path))
+		else:
+			jobs.extend((site, base_path, shard, count, spool_dir) for shard in range(count))
+	return jobs
+
+
+def merge_shard_stats(results):
+	"""
+	Stats of every site from the results of its jobs, summed over the shards of split sites.
+	A site is left out if any of its jobs failed or skipped its unchanged feed,
+	its stats stay those of its last run that read the feed.
+	"""
+	merged = {}
+	left_out = set()
+	for site, site_stats, snapshot in results:
+		if not site_stats or site_stats.get("skipped"):
+			left_out.add(site)
+		elif site in merged:
+			merged[site] = {key: merged[site][key] + value for key, value in site_stats.items()}
+		else:
+			merged[site] = dict(site_stats)
+
+	return {site: site_stats for site, site_stats in merged.items() if site not in left_out}
+
+
+def metrics_collector(filename, per_job=True):
+	"""
+	on_result callback of the pool: merges the metrics of every finished site job
+	and rewrites the Prometheus text file with the totals of the run so far.
+	Without per_job the pool jobs are job queue drainers that count their site jobs themselves.
+	"""
+	totals = Metrics()
+
+	def on_result(result, seconds):
+		totals.merge(result[-1])
+		if per_job:
+			site, site_stats, snapshot = result
+			totals.observe("job_seconds", seconds, site=site)
+			totals.inc("jobs_total", result="ok" if site_stats else "failed")
+		if filename:
+			totals.write(filename)
+
+	return on_result
+
+# end of metrics_collector
+
+
+def schedule_site(stats, site, site_stats):
+	"""
+	Sets the next run of a site in daemon mode after a run that returned site_stats, None if it failed.
+	The refresh interval of the site is halved after a run that found changes and grown by half
+	after one that did not, within daemon_min_interval and daemon_max_interval.
+	A failed site keeps its interval and is retried after daemon_min_interval.
+	"""
+	from id_config import daemon_min_interval, daemon_max_interval, daemon_start_interval
+
+	previous = stats.get(site, {})
+	if site_stats is None:
+		stats[site] = dict(previous, next_run=time.time() + daemon_min_interval)
+		return
+
+	interval = previous.get("interval", daemon_start_interval)
+	interval = interval / 2 if site_stats["changed"] else interval * 1.5
+	interval = min(max(interval, daemon_min_interval), daemon_max_interval)
+	if site_stats.get("skipped"):
+		# the duration and product count are the ones of the last run that read the feed
+		site_stats = {}
+	stats[site] = dict(previous, interval=interval, next_run=time.time() + interval, **site_stats)
+
+# end of schedule_site
+
+
+def get_site_names():
+	from id_config import db_username, db_password, db_host, db_name
+
+	id_db.connect(db_username, db_password, db_host, db_name)
+	try:
+		return [site.name for site in id_db.get_sites()]
+	finally:
+		id_db.disconnect()
+
+
+def run_daemon(base_path, sites, product_counts):
+	"""
+	Keeps process_pool_size worker processes up and runs every site when its refresh interval
+	(see schedule_site) is over, the longest ones first. The next runs are kept in site_stats_file,
+	so a restarted daemon continues the schedule. On SIGTERM stops taking sites,
+	waits for the running ones and returns.
+	"""
+	from id_config import process_pool_size, runner_log_name, site_stats_file, metrics_file, daemon_sites_refresh
+
+	logger = logging.getLogger(runner_log_name)
+
+	stopping = threading.Event()
+
+	def on_sigterm(signum, frame):
+		stopping.set()
+
+	signal.signal(signal.SIGTERM, on_sigterm)
+
+	stats = load_site_stats(site_stats_file)
+	cost = site_cost(stats, product_counts)
+
+	pp = ResidentProcessPool(poolLength=process_pool_size, worker=start_downloader_instance,
+							 on_result=metrics_collector(metrics_file), **pool_options(daemon=True))
+	pp.logger_name = runner_log_name
+	pp.Start()
+
+	running = set()
+	sites_read = time.time()
+	while not stopping.is_set():
+		if time.time() - sites_read >= daemon_sites_refresh:
+			try:
+				sites = get_site_names()
+			except Exception as e:
+				logger.exception("Cannot reread the site list, keeping the old one")
+			sites_read = time.time()
+
+		now = time.time()
+		due = [site for site in sites if site not in running and stats.get(site, {}).get("next_run", 0) <= now]
+		due.sort(key=lambda site: cost((site, base_path)), reverse=True)
+		for site in due[:process_pool_size - len(running)]:
+			pp.Submit((site, base_path))
+			running.add(site)
+
+		results, lost = pp.Results(timeout=1)
+		for site, site_stats, snapshot in results:
+			running.discard(site)
+			schedule_site(stats, site, site_stats)
+		for site, _ in lost:
+			running.discard(site)
+			schedule_site(stats, site, None)
+
+		if results or lost:
+			save_site_stats(site_stats_file, stats)
+
+	logger.info("Stopping, waiting for {} running sites".format(len(running)))
+	for site, site_stats, snapshot in pp.Stop():
+		schedule_site(stats, site, site_stats)
+	save_site_stats(site_stats_file, stats)
+
+# end of run_daemon
+
+
+def parse_args():
+	parser = argparse.ArgumentParser(description="Downloads product data and images of the shops")
+	parser.add_argument("--daemon", action="store_true",
+						help="stay running and refresh every site on its own interval until SIGTERM")
+	parser.add_argument("--distributed", action="store_true",
+						help="take site jobs from the crawl_job table together with the other nodes of the crawl")
+	parser.add_argument("--enqueue", action="store_true",
+						help="with --distributed: first add a job for every site to the crawl, once per crawl is enough")
+	parser.add_argument("--run-id", default=datetime.date.today().isoformat(),
+						help="with --distributed: crawl the nodes cooperate on, today's date by default")
+	parser.add_argument("--upgrade-db", action="store_true",
+						help="create the tables and columns added since the database was created, then exit")
+	parser.add_argument("--profile", choices=sorted(id_profiler.PROFILERS),
+						help="profile the site runs and write the profiles to profile_dir, overrides profile of id_config")
+	parser.add_argument("--profile-sites", metavar="SITE,...",
+						help="with --profile: profile only these sites, overrides profile_sites of id_config")
+	options = parser.parse_args()
+	if options.profile_sites and not options.profile:
+		parser.error("--profile-sites needs --profile")
+	return options
+
+
+def enqueue_sites(run_id, sites, product_counts):
+	from id_config import db_username, db_password, db_host, db_name, runner_log_name
+	from id_jobqueue import JobQueue
+
+	queue = JobQueue(id_db.db_url(db_username, db_password, db_host, db_name), run_id, None, runner_log_name)
+	try:
+		durations = queue.last_durations()
+		jobs = []
+		for site in sites:
+			count = shard_count(site, product_counts)
+			jobs.extend((site, shard, count, durations.get(site)) for shard in range(count))
+		queue.enqueue(jobs)
+	finally:
+		queue.close()
+
+
+def run_distributed(run_id, base_path):
+	from id_config import process_pool_size, runner_log_name, metrics_file, spool_dir
+
+	logger = logging.getLogger(runner_log_name)
+
+	node = "{}:{}".format(socket.gethostname(), os.getpid())
+	# the first shard of a split site on this node reads the feed into it for the other shards the node gets
+	node_spool_dir = os.path.abspath(os.path.join(spool_dir, "{}-{}".format(run_id, os.getpid())))
+	pp = SilentProcessPool(poolLength=process_pool_size, worker=drain_job_queue,
+						   data=[(run_id, "{}/{}".format(node, i), base_path, node_spool_dir)
+								 for i in range(process_pool_size)],
+						   on_result=metrics_collector(metrics_file, per_job=False), **pool_options())
+	pp.logger_name = runner_log_name
+	try:
+		results = pp.Run()
+	finally:
+		shutil.rmtree(node_spool_dir, ignore_errors=True)
+
+	jobs = [job for worker_node, worker_jobs, snapshot in results for job in worker_jobs]
+	logger.info("Crawl {}: {} ran {} jobs, {} failed".format(run_id, node, len(jobs),
+															 sum(1 for site, site_stats in jobs if not site_stats)))
+
+# end of run_distributed
+
+
+def main(options=None):
+	from id_config import db_username, db_password, db_host, db_name, base_path, process_pool_size, runner_log_name, \
+		schedule_by_cost, site_stats_file, metrics_file, shard_products, site_shards, spool_dir
+
+	if options is not None and options.profile:
+		id_profiler.mode = options.profile
+		if options.profile_sites:
+			id_profiler.sites = options.profile_sites.split(",")
+
+	log_listener = id_common.start_log_listener()
 	id_common.init_logger(runner_log_name)
 
 	logger = logging.getLogger(runner_log_name)
 
 	try:
 		id_db.connect(db_username, db_password, db_host, db_name)
+		if options is not None and options.upgrade_db:
+			missing = id_db.upgrade_db()
+			logger.info("Database upgraded: {}".format(", ".join(missing) or "nothing was missing"))
+			id_db.disconnect()
+			return
+
+		missing = id_db.missing_upgrades()
+		if missing:
+			logger.error("The database has no {}, run image_downloader.py --upgrade-db first".format(", ".join(missing)))
+			id_db.disconnect()
+			return
 
 		sites = id_db.get_sites()
 		sites = [site.name for site in sites]
+		product_counts = id_db.get_product_counts() if schedule_by_cost or shard_products or site_shards else {}
 
 		id_db.disconnect()
 
+		if options is not None and options.daemon:
+			run_daemon(base_path, sites, product_counts)
+			logger.info("Finished!!!")
+			return
+
+		if options is not None and options.distributed:
+			if options.enqueue:
+				enqueue_sites(options.run_id, sites, product_counts)
+			run_distributed(options.run_id, base_path)
+			logger.info("Finished!!!")
+			return
+
+		stats = load_site_stats(site_stats_file)
+
+		run_spool_dir = os.path.abspath(os.path.join(spool_dir, "{}-{}".format(
+			datetime.datetime.now().strftime("%Y%m%d%H%M%S"), os.getpid())))
+
 		pp = SilentProcessPool(poolLength=process_pool_size, worker=start_downloader_instance,
-							   data=zip(sites, [base_path] * len(sites)))
+							   data=site_jobs(sites, product_counts, base_path, run_spool_dir),
+							   cost=site_cost(stats, product_counts) if schedule_by_cost else None,
+							   on_result=metrics_collector(metrics_file), **pool_options())
 		pp.logger_name = runner_log_name
-		pp.Run()
+		try:
+			results = pp.Run()
+		finally:
+			shutil.rmtree(run_spool_dir, ignore_errors=True)
+
+		for site, site_stats in merge_shard_stats(results).items():
+			stats[site] = dict(stats.get(site, {}), **site_stats)
+		save_site_stats(site_stats_file, stats)
 
 		logger.info("Finished!!!")
 
 	except Exception as e:
 		logger.exception("Exception during {} run".format(program_name))
 		raise
+	finally:
+		if log_listener:
+			log_listener.stop()
 
 # end of main
 
 
 if __name__ == "__main__":
-	main()
+	main(parse_args())
 
 
 
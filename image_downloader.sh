@@ -1,4 +1,70 @@
 #!/bin/bash
+# image_downloader.sh              - batch run of all the sites, from cron: replaces a batch run that is still going,
+#                                    does nothing while the daemon runs
+# image_downloader.sh --daemon     - runs image_downloader.py --daemon in the foreground (from systemd, supervisord or
+#                                    @reboot in cron) and starts it again if it dies, until it is stopped
+# image_downloader.sh --stop       - stops the daemon: it finishes the sites it is running, then exits
+# image_downloader.sh --upgrade-db - adds the tables and columns of a new version, run it once as the owner of the tables
+# other arguments are passed to image_downloader.py
+
+DOWNLOADER=/home/django/ImageDownloader/image_downloader.py
+# held by the daemon and its processes while they run, has the pid of image_downloader.sh --daemon
+DAEMON_LOCK=/tmp/image_downloader.daemon.lock
+RESTART_DELAY=60
+
+daemon_running() {
+    ! flock -n "$DAEMON_LOCK" true
+}
+
+case "$1" in
+--daemon)
+    exec 9>>"$DAEMON_LOCK"
+    if ! flock -n 9; then
+        echo "The daemon is running already" >&2
+        exit 1
+    fi
+    echo $$ > "$DAEMON_LOCK"
+
+    # SIGTERM lets the daemon finish its running sites
+    trap 'stopping=1; kill -TERM $child 2>/dev/null' TERM INT
+    while true; do
+        "$DOWNLOADER" "$@" &
+        child=$!
+        wait $child
+        status=$?
+        if [ -n "$stopping" ]; then
+            wait $child
+            exit 0
+        fi
+        if [ $status -eq 0 ]; then
+            exit 0
+        fi
+        echo "The daemon exited with $status, starting it again in $RESTART_DELAY seconds" >&2
+        sleep $RESTART_DELAY
+    done
+    ;;
+
+--stop)
+    if ! daemon_running; then
+        echo "The daemon is not running" >&2
+        exit 0
+    fi
+    kill -TERM $(cat "$DAEMON_LOCK")
+    # until the daemon and its processes are gone
+    flock "$DAEMON_LOCK" true
+    exit 0
+    ;;
+
+--upgrade-db)
+    exec "$DOWNLOADER" "$@"
+    ;;
+esac
+
+if daemon_running; then
+    echo "The daemon is running, no batch run" >&2
+    exit 0
+fi
+
 for pid in $(pidof -x image_downloader.sh); do
     if [ $pid != $$ ]; then
       kill -9 $pid
@@ -10,4 +76,4 @@ for pid in $(pidof -x image_downloader.py); do
       kill -9 $pid
 done
 
-/home/django/ImageDownloader/image_downloader.py
+"$DOWNLOADER" "$@"
@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+
+import pytest
+
+# the modules of the downloader are imported from the repository root, as image_downloader.py does
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def db_url():
+	"""
+	URL of a PostgreSQL database the tests may create tables in, from ID_TEST_DB_URL,
+	e.g. postgresql://postgres@/postgres?host=/var/run/postgresql for a local server.
+	The tests that need one are skipped without it
+	"""
+	url = os.environ.get("ID_TEST_DB_URL")
+	if not url:
+		pytest.skip("ID_TEST_DB_URL is not set")
+	return url
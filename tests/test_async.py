@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+
+import threading
+import time
+
+import pytest
+
+import id_worker
+from id_config import async_concurrency
+from id_product import Product
+
+
+def product(code):
+	return Product(code, True, "name", "url", 10, None, "RUB", "/s.jpg", "/l.jpg")
+
+
+def downloader(tmpdir, download_images):
+	d = id_worker.ImageDownloader("shop", str(tmpdir), mode="async")
+	stored = []
+	d.download_images = download_images
+	d.get_product_info = lambda site_name, p: None
+	d.store_images = lambda p, xml_timestamp, paths: stored.append((p.code, paths))
+	d.store_product_info = lambda p, xml_timestamp, product_info: None
+	return d, stored
+
+
+def test_async_stores_every_product_with_bounded_concurrency(tmpdir):
+	lock = threading.Lock()
+	in_flight = [0, 0]
+
+	def download_images(site_name, p, base_path):
+		with lock:
+			in_flight[0] += 1
+			in_flight[1] = max(in_flight[1], in_flight[0])
+		time.sleep(0.01)
+		with lock:
+			in_flight[0] -= 1
+		return [p.code]
+
+	d, stored = downloader(tmpdir, download_images)
+	d.process_products_async((product("c{}".format(i)) for i in range(async_concurrency * 3)), "1000")
+
+	assert sorted(code for code, paths in stored) == sorted("c{}".format(i) for i in range(async_concurrency * 3))
+	assert all(paths == [code] for code, paths in stored)
+	assert 1 < in_flight[1] <= async_concurrency
+
+
+def test_async_raises_the_error_of_a_product(tmpdir):
+	def download_images(site_name, p, base_path):
+		if p.code == "bad":
+			raise RuntimeError("broken")
+		return []
+
+	d, stored = downloader(tmpdir, download_images)
+	with pytest.raises(RuntimeError):
+		d.process_products_async(iter([product("ok"), product("bad")]), "1000")
@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+
+import uuid
+
+import pytest
+from sqlalchemy import create_engine, text
+from sqlalchemy.orm import sessionmaker
+
+import id_db
+from id_db import BulkWriter, FeedProdStore, FeedStore
+from id_product import Param, Product
+from id_sync import CHANGED, UNCHANGED, SiteIndex
+
+
+@pytest.fixture
+def site(db_url, monkeypatch):
+	"""
+	A site of its own in the database of db_url, its rows are deleted afterwards
+	"""
+	engine = create_engine(db_url)
+	FeedStore.__table__.create(engine, checkfirst=True)
+	FeedProdStore.__table__.create(engine, checkfirst=True)
+	session = sessionmaker(bind=engine)()
+	monkeypatch.setattr(id_db, "engine", engine)
+	monkeypatch.setattr(id_db, "session", session)
+
+	site_name = "test-{}".format(uuid.uuid4().hex)
+	yield site_name
+
+	session.rollback()
+	session.query(FeedStore).filter_by(site=site_name).delete()
+	session.query(FeedProdStore).filter_by(site=site_name).delete()
+	session.commit()
+	session.close()
+	engine.dispose()
+
+
+def product(code, name="name", params=None):
+	return Product(code, True, name, "http://shop/" + code, 10, 12, "RUB", "http://shop/s.jpg", None, params)
+
+
+def stored(site_name):
+	columns = ("code", "available", "name", "price", "price_old", "path_img_small", "hash_img_small", "status_img_small")
+	return sorted(tuple(getattr(row, c) for c in columns)
+				  for row in id_db.session.query(FeedStore).filter_by(site=site_name))
+
+
+def stored_sizes(site_name):
+	return sorted((row.code, row.param_name or "", row.param_available, row.param_price)
+				  for row in id_db.session.query(FeedProdStore).filter_by(site=site_name))
+
+
+def write(site_name, writer=None):
+	"""
+	Writes the same products and sizes through writer, a BulkWriter, or row by row without one
+	"""
+	products = [product("a", "plain"), product("b", "tab\there\\ and\nnewline")]
+	sizes = [product("a", params=[Param("S", True, 10, 12), Param("M", False, 11, 12)]), product("b")]
+
+	for item in products:
+		if writer:
+			writer.add_product(item, 1000, "a.jpg", None, "h1", None, "ok")
+		else:
+			id_db.store_product_data(site_name, item, 1000, "a.jpg", None, "h1", None, "ok")
+	for item in sizes:
+		if writer:
+			writer.add_product_sizes(item, 1000)
+		else:
+			id_db.store_product_sizes(site_name, item, 1000)
+	if writer:
+		writer.close()
+
+
+def test_batch_writes_the_rows_the_per_row_path_does(site):
+	write(site, BulkWriter(site, 100, 60))
+	batch = stored(site), stored_sizes(site)
+
+	id_db.session.query(FeedStore).filter_by(site=site).delete()
+	id_db.session.query(FeedProdStore).filter_by(site=site).delete()
+	id_db.session.commit()
+	write(site)
+
+	assert (stored(site), stored_sizes(site)) == batch
+	assert batch[1] == [("a", "M", False, 11), ("a", "S", True, 10), ("b", "", True, 10)]
+	assert [row[2] for row in batch[0]] == ["plain", "tab\there\\ and\nnewline"]
+
+
+def test_batch_updates_existing_rows_and_keeps_unknown_hashes(site):
+	writer = BulkWriter(site, 100, 60)
+	writer.add_product(product("a"), 1000, "a.jpg", None, "h1", None, "ok")
+	writer.add_product_sizes(product("a"), 1000)
+	writer.close()
+
+	writer = BulkWriter(site, 100, 60)
+	# the image was not checked in this run, its hash and status are not known
+	writer.add_product(product("a", "renamed"), 2000, "a2.jpg", None)
+	writer.add_product_sizes(product("a", "renamed"), 2000)
+	writer.close()
+
+	assert stored(site) == [("a", True, "renamed", 10, 12, "a2.jpg", "h1", "ok")]
+	assert len(stored_sizes(site)) == 1
+
+
+def test_batch_is_flushed_when_full(site):
+	flushes = []
+	writer = BulkWriter(site, 2, 60, after_flush=lambda: flushes.append(1))
+
+	writer.add_product(product("a"), 1000, None, None)
+	assert not flushes
+	writer.add_product(product("b"), 1000, None, None)
+	assert flushes == [1]
+	assert writer.pending() == 0
+	assert [row[0] for row in stored(site)] == ["a", "b"]
+
+
+def test_rows_read_back_have_the_fingerprints_of_the_products(site):
+	writer = BulkWriter(site, 100, 60)
+	writer.add_product(product("a"), 1000, "a.jpg", None)
+	writer.add_product(Product("b", False, "name", "http://shop/b", 10, None, "RUB", None, None), 1000, None, None)
+	writer.close()
+
+	index = SiteIndex.load(site)
+	assert index.classify(product("a")) == UNCHANGED
+	assert index.classify(Product("b", False, "name", "http://shop/b", 10, None, "RUB", None, None)) == UNCHANGED
+	assert index.classify(Product("b", False, "name", "http://shop/b", 11, None, "RUB", None, None)) == CHANGED
+
+
+def test_upgrade_adds_only_what_is_missing(db_url, monkeypatch):
+	schema = "test_{}".format(uuid.uuid4().hex)
+	engine = create_engine(db_url)
+	with engine.begin() as conn:
+		conn.execute(text("CREATE SCHEMA {}".format(schema)))
+	schema_engine = create_engine(db_url, connect_args={"options": "-c search_path={}".format(schema)})
+	session = sessionmaker(bind=schema_engine)()
+	try:
+		id_db.Base.metadata.create_all(schema_engine, tables=[FeedStore.__table__])
+		with schema_engine.begin() as conn:
+			conn.execute(text("ALTER TABLE feed_store DROP COLUMN hash_img_small"))
+
+		monkeypatch.setattr(id_db, "engine", schema_engine)
+		monkeypatch.setattr(id_db, "session", session)
+
+		missing = id_db.missing_upgrades()
+		assert "feed_store.hash_img_small" in missing and "retry_queue" in missing
+		assert "feed_store.hash_img_large" not in missing
+
+		assert id_db.upgrade_db() == missing
+		assert id_db.missing_upgrades() == []
+	finally:
+		session.close()
+		schema_engine.dispose()
+		with engine.begin() as conn:
+			conn.execute(text("DROP SCHEMA {} CASCADE".format(schema)))
+		engine.dispose()
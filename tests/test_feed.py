@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+
+from id_feed import FeedStream
+from id_product import InvalidProduct, parse_products
+
+
+FEED = (b'<root timestamp="1000"><products>'
+		b'<product><code>a</code><avalible>true</avalible><price>10</price></product>'
+		b'<product><code>b</code><avalible>false</avalible><price>x</price></product>'
+		b'<product><code>c</code><avalible>false</avalible><price>12</price></product>'
+		b'</products><info><product><code>d</code></product></info></root>')
+
+
+class Raw:
+	"""
+	Body of a response that arrives a few bytes at a time
+	"""
+
+	def __init__(self, data, chunk_size=7):
+		self.data = data
+		self.chunk_size = chunk_size
+		self.read_bytes = 0
+
+	def read(self, size=-1):
+		chunk = self.data[self.read_bytes:self.read_bytes + min(size, self.chunk_size)]
+		self.read_bytes += len(chunk)
+		return chunk
+
+
+class Response:
+	def __init__(self, data):
+		self.raw = Raw(data)
+		self.closed = False
+
+	def close(self):
+		self.closed = True
+
+
+def test_products_are_the_children_of_the_first_element():
+	resp = Response(FEED)
+	feed = FeedStream(resp)
+	assert feed.timestamp == "1000"
+
+	products = list(parse_products(feed))
+	assert [product.code for product in products] == ["a", "b", "c"]
+	assert [isinstance(product, InvalidProduct) for product in products] == [False, True, False]
+	assert feed.count == 3
+	assert resp.closed
+
+
+def test_products_are_parsed_as_they_arrive_and_freed_once_passed():
+	resp = Response(FEED)
+	feed = FeedStream(resp)
+	elements = iter(feed)
+
+	first = next(elements)
+	assert first.findtext("code") == "a"
+	assert resp.raw.read_bytes < len(FEED)
+	container = first.getparent()
+
+	second = next(elements)
+	assert first.getparent() is None
+	assert list(container) == [second]
+
+
+def test_response_is_closed_when_the_consumer_stops():
+	resp = Response(FEED)
+	elements = iter(FeedStream(resp))
+
+	next(elements)
+	elements.close()
+	assert resp.closed
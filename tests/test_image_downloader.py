@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import os
+import signal
+
+import id_common
+import id_config
+from image_downloader import merge_shard_stats, pool_options, schedule_site
+from utils.process import SilentProcessPool
+
+
+SKIPPED = {"changed": 0, "skipped": True}
+
+
+def test_merge_shard_stats_sums_the_shards_of_a_site():
+	results = [
+		("big", {"duration": 10.0, "products": 100, "changed": 1}, {}),
+		("big", {"duration": 20.0, "products": 150, "changed": 0}, {}),
+		("small", {"duration": 1.0, "products": 5, "changed": 0}, {}),
+	]
+
+	assert merge_shard_stats(results) == {
+		"big": {"duration": 30.0, "products": 250, "changed": 1},
+		"small": {"duration": 1.0, "products": 5, "changed": 0},
+	}
+
+
+def test_merge_shard_stats_leaves_out_failed_and_skipped_sites():
+	results = [
+		("failed", {"duration": 10.0, "products": 100, "changed": 1}, {}),
+		("failed", None, {}),
+		("skipped", SKIPPED, {}),
+	]
+
+	assert merge_shard_stats(results) == {}
+
+
+def test_skipped_run_keeps_the_stats_of_the_last_one():
+	stats = {"shop": {"duration": 60.0, "products": 1000, "changed": 3, "interval": 3600}}
+
+	schedule_site(stats, "shop", SKIPPED)
+
+	assert stats["shop"]["duration"] == 60.0
+	assert stats["shop"]["products"] == 1000
+	assert "skipped" not in stats["shop"]
+	# nothing changed, the site is refreshed less often
+	assert stats["shop"]["interval"] > 3600
+
+
+def log_job(value):
+	if value == "die":
+		os.kill(os.getpid(), signal.SIGKILL)
+	logging.getLogger("test").info("job %s", value)
+	return value
+
+
+def logged_run(tmpdir, monkeypatch, start_method, data):
+	monkeypatch.chdir(tmpdir)
+	monkeypatch.setattr(id_common, "log_mode", "queue")
+	monkeypatch.setattr(id_config, "pool_start_method", start_method)
+	monkeypatch.setattr(id_config, "pool_preload", [])
+
+	listener = id_common.start_log_listener()
+	try:
+		pool = SilentProcessPool(poolLength=2, worker=log_job, data=data, **pool_options())
+		results = pool.Run()
+	finally:
+		listener.stop()
+		id_common.log_queue = None
+		id_common.log_listener = None
+
+	# the pipes of the processes are dropped, the one of the runner is left
+	assert len(listener.readers) == 1
+	return sorted(results), tmpdir.join(id_config.runner_log_name).read()
+
+
+def test_forkserver_processes_log_through_the_runner(tmpdir, monkeypatch):
+	results, log = logged_run(tmpdir, monkeypatch, "forkserver", ["a", "b"])
+
+	assert results == ["a", "b"]
+	assert "job a" in log and "job b" in log
+
+
+def test_killed_process_does_not_stop_the_logging_of_the_others(tmpdir, monkeypatch):
+	results, log = logged_run(tmpdir, monkeypatch, "fork", ["a", "die", "b", "c", "d"])
+
+	assert results == ["a", "b", "c", "d"]
+	assert all("job {}".format(value) in log for value in results)
@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+
+import time
+import uuid
+
+import pytest
+from sqlalchemy import create_engine, text
+
+import id_db
+import id_jobqueue
+from id_jobqueue import JobQueue
+
+
+@pytest.fixture
+def queues(db_url, monkeypatch):
+	"""
+	Job queues of three nodes over a crawl of their own
+	"""
+	# a lease that is over as soon as the claim is committed, as if the node died right away
+	monkeypatch.setattr(id_jobqueue, "job_lease", 0)
+	monkeypatch.setattr(id_jobqueue, "job_max_attempts", 2)
+
+	engine = create_engine(db_url)
+	id_db.CrawlJob.__table__.create(engine, checkfirst=True)
+	run_id = "test-{}".format(uuid.uuid4().hex)
+	queues = [JobQueue(db_url, run_id, node, "test") for node in ("first", "second", "third")]
+	yield queues
+
+	for queue in queues:
+		queue.close()
+	with engine.begin() as conn:
+		conn.execute(text("DELETE FROM crawl_job WHERE run_id = :run_id"), run_id=run_id)
+	engine.dispose()
+
+
+def job_status(queue):
+	with queue.engine.connect() as conn:
+		return tuple(conn.execute(text("SELECT status, attempts FROM crawl_job WHERE run_id = :run_id"),
+								  run_id=queue.run_id).first())
+
+
+def test_job_of_a_dead_node_is_claimed_again_then_failed(queues):
+	first, second, third = queues
+	first.enqueue([("shop", 0, 1, None)])
+
+	job = first.claim()
+	assert job.site == "shop"
+	time.sleep(0.01)
+
+	# the lease of the first node is over
+	assert second.claim() == job
+	assert job_status(second) == ("running", 2)
+	time.sleep(0.01)
+
+	# and so is the one of the second node, the job has no attempts left
+	assert third.claim() is None
+	assert job_status(third) == ("failed", 2)
+	assert not third.unfinished()
+
+
+def test_shards_are_separate_jobs(queues, monkeypatch):
+	monkeypatch.setattr(id_jobqueue, "job_lease", 300)
+	first = queues[0]
+	first.enqueue([("shop", shard, 2, 10.0) for shard in range(2)])
+	# enqueued again by another node of the same crawl
+	first.enqueue([("shop", shard, 2, 10.0) for shard in range(2)])
+
+	jobs = [first.claim(), first.claim()]
+	assert sorted((job.site, job.shard, job.shard_count) for job in jobs) == [("shop", 0, 2), ("shop", 1, 2)]
+
+
+def test_job_locked_by_a_claim_in_progress_is_skipped(queues, monkeypatch):
+	monkeypatch.setattr(id_jobqueue, "job_lease", 300)
+	first, second = queues[:2]
+	first.enqueue([("big", 0, 1, 20.0), ("small", 0, 1, 10.0)])
+
+	with first.engine.connect() as conn:
+		with conn.begin():
+			conn.execute(text("SELECT id FROM crawl_job WHERE run_id = :run_id AND site = 'big' FOR UPDATE"),
+						 run_id=first.run_id)
+			# the longest job is being claimed by the first node, the second one takes the next
+			assert second.claim().site == "small"
+
+
+def test_finished_jobs(queues, monkeypatch):
+	monkeypatch.setattr(id_jobqueue, "job_lease", 300)
+	first, second = queues[:2]
+	site = first.run_id
+	first.enqueue([(site, 0, 2, None), (site, 1, 2, None), (site + "-skipped", 0, 1, None)])
+
+	jobs = {(job.site, job.shard): job for job in (first.claim(), first.claim(), first.claim())}
+	assert first.extend(jobs[(site, 0)])
+	assert not second.extend(jobs[(site, 0)])
+
+	first.finish(jobs[(site, 0)], {"duration": 5.0})
+	first.finish(jobs[(site, 1)], None)
+	first.finish(jobs[(site + "-skipped", 0)], {"changed": 0, "skipped": True})
+
+	# the shard that failed is queued again
+	assert second.claim() == jobs[(site, 1)]
+	second.finish(jobs[(site, 1)], {"duration": 7.0})
+
+	durations = first.last_durations()
+	assert durations[site] == 7.0
+	assert site + "-skipped" not in durations
@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+
+from id_journal import IMAGES, INFO, Journal
+
+
+def test_run_resumes_after_a_torn_line(tmpdir):
+	path = str(tmpdir.join("shop.journal"))
+	journal = Journal(path, "1000")
+	journal.append("a", IMAGES)
+	journal.close()
+	# killed while writing the next line
+	with open(path, "a", encoding="utf8") as f:
+		f.write('["b", "ima')
+
+	journal = Journal(path, "1000")
+	assert journal.done("a", IMAGES)
+	assert not journal.started("b")
+	journal.append("b", IMAGES)
+	journal.append("a", INFO)
+	journal.close()
+
+	journal = Journal(path, "1000")
+	assert journal.complete("a")
+	assert journal.done("b", IMAGES)
+	journal.close()
+
+
+def test_torn_line_that_parses_is_not_counted(tmpdir):
+	path = str(tmpdir.join("shop.journal"))
+	Journal(path, "1000").close()
+	with open(path, "a", encoding="utf8") as f:
+		f.write('["a", "images"]')
+
+	journal = Journal(path, "1000")
+	assert not journal.started("a")
+	journal.close()
+
+
+def test_journal_of_another_feed_starts_over(tmpdir):
+	path = str(tmpdir.join("shop.journal"))
+	journal = Journal(path, "1000")
+	journal.append("a", IMAGES)
+	journal.close()
+
+	journal = Journal(path, "2000")
+	assert not journal.started("a")
+	journal.remove()
+	assert not tmpdir.join("shop.journal").exists()
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+
+import os
+import signal
+import threading
+import time
+
+from utils.process import ProcessPool, ResidentProcessPool
+
+
+def job(value):
+	if value == "die":
+		os.kill(os.getpid(), signal.SIGKILL)
+	if value == "slow":
+		time.sleep(1)
+	return os.getpid(), value
+
+
+def results(pool, count, timeout=10):
+	got = []
+	lost = []
+	deadline = time.time() + timeout
+	while len(got) + len(lost) < count and time.time() < deadline:
+		values, jobs = pool.Results(0.2)
+		got += values
+		lost += jobs
+	return got, lost
+
+
+def test_job_of_a_process_killed_after_it_is_not_lost():
+	pool = ResidentProcessPool(1, job, context="fork")
+	pool.Start()
+	try:
+		pool.Submit("first")
+		got, lost = results(pool, 1)
+		assert [value for pid, value in got] == ["first"]
+
+		# the process dies while idle, between jobs
+		os.kill(got[0][0], signal.SIGKILL)
+		pool.workers[0].join(5)
+		got, lost = pool.Results(0.5)
+		assert lost == []
+		assert pool.running == {}
+
+		pool.Submit("second")
+		got, lost = results(pool, 1)
+		assert [value for pid, value in got] == ["second"]
+	finally:
+		pool.Stop()
+
+
+def test_job_of_a_process_killed_while_running_it_is_lost():
+	pool = ResidentProcessPool(1, job, context="fork")
+	pool.Start()
+	try:
+		pool.Submit("die")
+		got, lost = results(pool, 1)
+		assert got == []
+		assert lost == ["die"]
+	finally:
+		pool.Stop()
+
+
+def test_run_goes_on_when_a_process_waiting_for_a_job_is_killed():
+	def kill(result, seconds):
+		pid, value = result
+		if value == "first":
+			# the process is idle, waiting for its next job
+			os.kill(pid, signal.SIGKILL)
+
+	pool = ProcessPool(2, job, ["first", "slow", "die", "last"], on_result=kill, context="fork")
+	results = []
+	run = threading.Thread(target=lambda: results.extend(pool.Run()))
+	run.start()
+	run.join(30)
+
+	assert not run.is_alive()
+	assert sorted(value for pid, value in results) == ["first", "last", "slow"]
@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+
+import pstats
+import threading
+import time
+
+import id_profiler
+from id_profiler import CallProfiler
+
+
+def work():
+	time.sleep(0.001)
+
+
+def calls(stats):
+	return sum(stat[1] for (_, _, name), stat in stats.stats.items() if name == "work")
+
+
+def test_threads_outliving_the_run_are_not_counted_after_stop(tmpdir, monkeypatch):
+	monkeypatch.setattr(id_profiler, "profile_dir", str(tmpdir))
+	stopped = threading.Event()
+
+	def loop():
+		while not stopped.is_set():
+			work()
+
+	profiler = CallProfiler()
+	profiler.start()
+	thread = threading.Thread(target=loop)
+	thread.start()
+	try:
+		work()
+		time.sleep(0.1)
+		profiler.stop()
+		at_stop = calls(profiler.stats)
+		time.sleep(0.1)
+		path = profiler.write("site")
+	finally:
+		stopped.set()
+		thread.join()
+
+	assert at_stop > 10
+	assert calls(pstats.Stats(path)) == at_stop
@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+
+import id_ratelimit
+from id_ratelimit import HostRate, retry_after
+
+
+class Clock:
+	"""
+	time of id_ratelimit, sleep() moves it forward instead of waiting
+	"""
+
+	def __init__(self):
+		self.now = 1000.0
+		self.slept = []
+
+	def monotonic(self):
+		return self.now
+
+	def time(self):
+		return self.now
+
+	def sleep(self, seconds):
+		self.slept.append(seconds)
+		self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+	clock = Clock()
+	monkeypatch.setattr(id_ratelimit, "time", clock)
+	monkeypatch.setattr(id_ratelimit, "rate_start", 4.0)
+	monkeypatch.setattr(id_ratelimit, "rate_increase", 1.0)
+	monkeypatch.setattr(id_ratelimit, "rate_decrease", 0.5)
+	monkeypatch.setattr(id_ratelimit, "rate_slow_latency", 5.0)
+	monkeypatch.setattr(id_ratelimit, "rate_burst", 1.0)
+	return clock
+
+
+def test_rate_grows_additively_and_is_cut_multiplicatively(clock):
+	rate = HostRate("shop", "test", minimum=1.0, maximum=5.0)
+
+	rate.success(0.1)
+	assert rate.rate == pytest.approx(4.25)
+
+	rate.failure("HTTP 503")
+	assert rate.rate == pytest.approx(2.125)
+
+	for _ in range(100):
+		rate.success(0.1)
+	assert rate.rate == 5.0
+
+	for _ in range(10):
+		clock.now += 1
+		rate.failure("timeout")
+	assert rate.rate == 1.0
+
+
+def test_requests_in_flight_cut_the_rate_once(clock):
+	rate = HostRate("shop", "test", minimum=0.5, maximum=50.0)
+	rate.success(2.0)
+	assert rate.rate == pytest.approx(4.25)
+
+	rate.failure("timeout")
+	rate.failure("timeout")
+	assert rate.rate == pytest.approx(2.125)
+
+	# one average latency later
+	clock.now += 2.0
+	rate.failure("timeout")
+	assert rate.rate == pytest.approx(1.0625)
+
+
+def test_slow_host_is_cut(clock):
+	rate = HostRate("shop", "test")
+
+	rate.success(10.0)
+	assert rate.rate == pytest.approx(2.0)
+
+
+def test_share_scales_the_limits(clock):
+	rate = HostRate("shop", "test", minimum=1.0, maximum=10.0, share=0.25)
+
+	assert (rate.minimum, rate.maximum, rate.rate) == (0.25, 2.5, 1.0)
+
+
+def test_requests_wait_for_the_rate_and_retry_after(clock):
+	rate = HostRate("shop", "test", minimum=1.0, maximum=5.0)
+
+	rate.acquire()
+	rate.acquire()
+	assert clock.slept == [pytest.approx(0.25)]
+
+	rate.failure("HTTP 429", retry_after_seconds=30)
+	rate.acquire()
+	assert clock.slept[-1] == pytest.approx(30)
+
+
+def test_retry_after():
+	assert retry_after("120") == 120
+	assert retry_after("Thu, 01 Jan 1970 00:01:40 GMT", now=40) == 60
+	assert retry_after("Thu, 01 Jan 1970 00:01:40 GMT", now=1000) == 0
+	assert retry_after("soon") is None
+	assert retry_after(None) is None
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+
+import datetime
+from collections import namedtuple
+
+import pytest
+
+import id_db
+import id_retry
+from id_retry import IMAGES, INFO, RetryQueue
+
+
+Row = namedtuple("Row", "code stage attempts next_attempt_at")
+
+NOW = datetime.datetime(2020, 1, 1)
+
+
+@pytest.fixture
+def saved(monkeypatch):
+	"""
+	(failed, recovered) of every save_retry_items call
+	"""
+	monkeypatch.setattr(id_retry, "retry_delay", 60)
+	monkeypatch.setattr(id_retry, "retry_max_delay", 600)
+	monkeypatch.setattr(id_retry, "retry_max_attempts", 4)
+
+	calls = []
+	monkeypatch.setattr(id_db, "save_retry_items", lambda site_name, failed, recovered: calls.append((failed, recovered)))
+	return calls
+
+
+def fail(queue, code="a", now=NOW):
+	queue.failed(code, IMAGES, "timeout")
+	queue.save(now)
+	return queue.items[(code, IMAGES)]
+
+
+def test_delay_doubles_up_to_the_max_then_the_item_is_given_up(saved):
+	queue = RetryQueue("shop", "test", [])
+
+	delays = []
+	for attempts in range(1, 4):
+		assert fail(queue)[0] == attempts
+		delays.append((queue.items[("a", IMAGES)][1] - NOW).total_seconds())
+	assert delays == [60, 120, 240]
+
+	queue = RetryQueue("shop", "test", [Row("a", IMAGES, 3, NOW)])
+	assert fail(queue) == (4, None)
+	assert saved[-1][0][0]["next_attempt_at"] is None
+	# given up items are never due again
+	assert queue.due(10, NOW + datetime.timedelta(days=365)) == {}
+
+
+def test_delay_is_capped(saved, monkeypatch):
+	monkeypatch.setattr(id_retry, "retry_max_attempts", 10)
+	queue = RetryQueue("shop", "test", [Row("a", IMAGES, 5, NOW)])
+
+	assert fail(queue) == (6, NOW + datetime.timedelta(seconds=600))
+
+
+def test_first_failure_of_the_run_wins_and_successes_are_removed(saved):
+	queue = RetryQueue("shop", "test", [Row("a", IMAGES, 1, NOW), Row("b", INFO, 1, NOW)])
+
+	queue.failed("a", IMAGES, "timeout")
+	queue.succeeded("a", IMAGES)
+	queue.succeeded("b", INFO)
+	queue.succeeded("c", IMAGES)
+	queue.save(NOW)
+
+	failed, recovered = saved[-1]
+	assert [(item["code"], item["attempts"], item["last_error"]) for item in failed] == [("a", 2, "timeout")]
+	assert recovered == [("b", INFO)]
+	assert ("b", INFO) not in queue.items
+
+
+def test_due_items_are_the_longest_waiting_first():
+	hour = datetime.timedelta(hours=1)
+	queue = RetryQueue("shop", "test", [Row("a", IMAGES, 1, NOW - hour), Row("b", INFO, 1, NOW - 2 * hour),
+										Row("c", IMAGES, 1, NOW + hour), Row("d", IMAGES, 8, None)])
+
+	assert queue.due(10, NOW) == {IMAGES: ["a"], INFO: ["b"]}
+	assert queue.due(1, NOW) == {INFO: ["b"]}
@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+
+from lxml import etree
+
+from id_cache import NOT_MODIFIED
+from id_spool import FeedSpool
+from id_sync import shard_of
+
+
+FEED = b"""<root timestamp="1000"><products>{}</products></root>"""
+PRODUCT = "<product><code>c{0}</code><avalible>true</avalible><name>n{0}</name><url>u</url><price>10</price></product>"
+
+
+def feed(count):
+	root = etree.fromstring(FEED.replace(b"{}", "".join(PRODUCT.format(i) for i in range(count)).encode()))
+	return root[0], root.get("timestamp")
+
+
+def test_feed_is_read_once_and_split_by_shard(tmpdir):
+	calls = []
+
+	def get_products():
+		calls.append(1)
+		return feed(20)
+
+	shards = []
+	for shard in range(2):
+		products, timestamp = FeedSpool(str(tmpdir), 2).open(shard, get_products)
+		assert timestamp == "1000"
+		shards.append([product.code for product in products])
+
+	assert len(calls) == 1
+	assert sorted(shards[0] + shards[1]) == sorted("c{}".format(i) for i in range(20))
+	assert all(shard_of(code, 2) == shard for shard, codes in enumerate(shards) for code in codes)
+
+
+def test_not_modified_feed_is_not_modified_for_every_shard(tmpdir):
+	for shard in range(2):
+		assert FeedSpool(str(tmpdir), 2).open(shard, lambda: (NOT_MODIFIED, None)) == (NOT_MODIFIED, None)
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+
+import os
+import threading
+import time
+
+import pytest
+import requests
+
+from id_config import image_resume_min_size
+from id_storage import PartStore, WriteBehind, range_start
+from id_transport import IncompleteResponse
+
+
+URL = "http://shop/i/1.jpg"
+
+
+def response(status, **headers):
+	resp = requests.Response()
+	resp.status_code = status
+	resp.url = URL
+	resp.headers.update(headers)
+	return resp
+
+
+def test_range_start():
+	assert range_start(response(206, **{"Content-Range": "bytes 100-199/200"})) == 100
+	assert range_start(response(206, **{"Content-Range": "bytes */200"})) is None
+	assert range_start(response(206)) is None
+
+
+def test_part_is_continued_from_its_size(tmpdir):
+	parts = PartStore(str(tmpdir))
+	assert parts.resume_headers(URL) == {}
+
+	parts.receive(URL, response(200, ETag='"v1"'), [b"abc", b"de"])
+	assert parts.resume_headers(URL) == {"Range": "bytes=5-", "If-Range": '"v1"'}
+
+	parts.receive(URL, response(206, **{"Content-Range": "bytes 5-7/8"}), [b"fgh"])
+	assert b"".join(parts.read(URL)) == b"abcdefgh"
+
+	parts.remove(URL)
+	assert parts.size(URL) == 0
+	assert os.listdir(str(tmpdir)) == []
+
+
+def test_part_without_validator_is_not_continued(tmpdir):
+	parts = PartStore(str(tmpdir))
+	parts.receive(URL, response(200, **{"ETag": 'W/"weak"'}), [b"abc"])
+
+	assert parts.resume_headers(URL) == {}
+
+
+def test_range_that_does_not_continue_the_part_removes_it(tmpdir):
+	parts = PartStore(str(tmpdir))
+	parts.receive(URL, response(200, ETag='"v1"'), [b"abc"])
+
+	with pytest.raises(IncompleteResponse):
+		parts.receive(URL, response(206, **{"Content-Range": "bytes 10-19/20"}), [b"x" * 10])
+	assert parts.size(URL) == 0
+
+
+def test_wanted(tmpdir):
+	parts = PartStore(str(tmpdir))
+	large = str(image_resume_min_size)
+
+	assert parts.wanted(response(206))
+	assert parts.wanted(response(200, ETag='"v1"', **{"Content-Length": large}))
+	assert not parts.wanted(response(200, **{"Content-Length": large}))
+	assert not parts.wanted(response(200, ETag='"v1"', **{"Content-Length": "10"}))
+	assert not parts.wanted(response(200, ETag='"v1"', **{"Content-Length": large, "Content-Encoding": "gzip"}))
+
+
+def test_expire_removes_parts_not_written_to(tmpdir):
+	parts = PartStore(str(tmpdir))
+	parts.receive(URL, response(200, ETag='"v1"'), [b"old"])
+	parts.receive(URL + "?2", response(200, ETag='"v2"'), [b"new"])
+
+	day = 24 * 3600
+	for path in (parts.part_path(URL), parts.meta_path(URL)):
+		os.utime(path, (time.time() - 8 * day, time.time() - 8 * day))
+
+	assert parts.expire(7 * day) == 1
+	assert parts.size(URL) == 0
+	assert parts.size(URL + "?2") == 3
+	assert PartStore(str(tmpdir.join("none"))).expire(7 * day) == 0
+
+
+def test_write_behind_is_bounded_by_bytes():
+	release = threading.Event()
+	written = []
+
+	def write(path, chunks):
+		release.wait(5)
+		written.append(path)
+
+	write_behind = WriteBehind(write, 4, 10)
+	try:
+		first = write_behind.put("a", [b"x" * 6])
+		second = threading.Thread(target=write_behind.put, args=("b", [b"x" * 6]))
+		second.start()
+		second.join(0.2)
+		# 12 bytes do not fit into 10, "b" waits for "a" to be written
+		assert second.is_alive()
+
+		release.set()
+		first.result(5)
+		second.join(5)
+		assert not second.is_alive()
+
+		# an image larger than the queue is written once the queue is empty
+		write_behind.put("c", [b"x" * 20]).result(5)
+	finally:
+		write_behind.close()
+	assert sorted(written) == ["a", "b", "c"]
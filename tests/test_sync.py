@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+
+from collections import namedtuple
+from decimal import Decimal
+
+from id_product import Product
+from id_sync import CHANGED, NEW, UNCHANGED, SiteIndex, shard_of
+
+
+Row = namedtuple("Row", "code available name url price price_old currency img_small img_large "
+						"path_img_small path_img_large")
+
+
+def product(code, available=False, price=10, img_small="http://shop/s.jpg"):
+	return Product(code, available, "name", "http://shop/" + code, price, None, "RUB", img_small, None)
+
+
+def row(code, available=None, price=Decimal("10.00"), img_small="http://shop/s.jpg"):
+	return Row(code, available, "name", "http://shop/" + code, price, None, "RUB", img_small, None,
+			   "s.jpg", None)
+
+
+def test_row_is_unchanged_as_read_back_from_the_db():
+	index = SiteIndex([row("a"), row("b", available=True, price=Decimal("10"))])
+
+	assert index.classify(product("a")) == UNCHANGED
+	assert index.classify(product("b", available=True)) == UNCHANGED
+
+
+def test_products_are_classified_and_the_rest_removed():
+	index = SiteIndex([row("a"), row("b"), row("c", available=True)])
+
+	assert index.classify(product("a", price=11)) == CHANGED
+	assert index.classify(product("b", available=True)) == CHANGED
+	assert index.classify(product("d")) == NEW
+	assert index.counts == {NEW: 1, CHANGED: 2, UNCHANGED: 0}
+	assert index.removed() == ["c"]
+
+
+def test_products_removed_before_are_not_removed_again():
+	index = SiteIndex([row("a", available=True), row("b", available=False), row("c")])
+
+	assert index.removed() == ["a"]
+
+
+def test_image_paths_are_kept_for_unchanged_images():
+	index = SiteIndex([row("a")])
+
+	assert index.image_paths(product("a")) == ("s.jpg", None)
+	assert index.image_paths(product("a", img_small="http://shop/s2.jpg")) == (None, None)
+	assert index.image_paths(product("d")) == (None, None)
+
+
+def test_shard_of_is_stable_and_in_range():
+	codes = ["c{}".format(i) for i in range(100)]
+
+	assert [shard_of(code, 4) for code in codes] == [shard_of(code, 4) for code in codes]
+	assert set(shard_of(code, 4) for code in codes) == {0, 1, 2, 3}
+	assert all(shard_of(code, 1) == 0 for code in codes)
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+
+import io
+
+import pytest
+import requests
+
+from id_config import http_retries
+from id_transport import Transport, IncompleteResponse
+
+
+URL = "http://shop/i/1.jpg"
+
+
+class BrokenBody(io.BytesIO):
+	"""
+	Body that breaks off after its data, like a connection dropped in the middle of a chunked response
+	"""
+
+	def read(self, *args):
+		data = super(BrokenBody, self).read(*args)
+		if not data:
+			raise requests.exceptions.ChunkedEncodingError("connection dropped")
+		return data
+
+
+def response(status, body, length=None, broken=False):
+	resp = requests.Response()
+	resp.status_code = status
+	resp.url = URL
+	resp.raw = BrokenBody(body) if broken else io.BytesIO(body)
+	if length is not None:
+		resp.headers["Content-Length"] = str(length)
+	return resp
+
+
+class Session:
+	def __init__(self, responses):
+		self.responses = list(responses)
+		self.requests = []
+
+	def get(self, url, **kwargs):
+		self.requests.append(kwargs.get("headers"))
+		return self.responses.pop(0)
+
+	def close(self):
+		pass
+
+
+@pytest.fixture
+def transport(monkeypatch):
+	monkeypatch.setattr(Transport, "backoff", staticmethod(lambda attempt: 0))
+	transport = Transport("shop", "test")
+	yield transport
+	transport.close()
+
+
+def test_download_requests_a_body_that_broke_off_again(transport):
+	transport.session = Session([response(200, b"abc", broken=True), response(200, b"abcdef", length=6)])
+	attempts = []
+
+	def headers():
+		attempts.append(len(attempts))
+		return {"X-Attempt": str(len(attempts))}
+
+	resp, data = transport.download(URL, lambda resp, chunks: b"".join(chunks), headers=headers)
+
+	assert resp.status_code == 200
+	assert data == b"abcdef"
+	# the headers are made anew for every attempt
+	assert transport.session.requests == [{"X-Attempt": "1"}, {"X-Attempt": "2"}]
+
+
+def test_download_gives_up_a_short_body_after_http_retries(transport):
+	transport.session = Session([response(200, b"abc", length=6) for _ in range(http_retries + 1)])
+
+	with pytest.raises(IncompleteResponse):
+		transport.download(URL, lambda resp, chunks: b"".join(chunks))
+	assert transport.session.responses == []
+
+
+def test_download_does_not_receive_an_error(transport):
+	transport.session = Session([response(404, b"not found")])
+	received = []
+
+	resp, data = transport.download(URL, lambda resp, chunks: received.append(resp))
+
+	assert resp.status_code == 404
+	assert data is None
+	assert received == []
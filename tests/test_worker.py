@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+
+import datetime
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import pytest
+
+import id_db
+import id_imaging
+from id_retry import IMAGES, RetryQueue
+from id_worker import ImageDownloader, image_row
+
+
+def test_image_row_of_stored_images():
+	assert image_row(("s.jpg", "h1", None), ("l.jpg", "h2", None)) == ["s.jpg", "l.jpg", "h1", "h2", None, None]
+
+
+def test_image_row_is_done_once_every_check_is():
+	small, large = Future(), Future()
+	row = image_row(small, large)
+
+	small.set_result(("s.jpg", "h1", "ok"))
+	assert not row.done()
+	large.set_result(("", None, "invalid"))
+	assert row.result(0) == ["s.jpg", "", "h1", None, "ok", "invalid"]
+
+
+def test_image_row_fails_with_its_check():
+	large = Future()
+	row = image_row(("s.jpg", "h1", None), large)
+
+	large.set_exception(OSError("disk full"))
+	with pytest.raises(OSError):
+		row.result(0)
+
+
+def test_rejected_image_is_retried(tmpdir, monkeypatch):
+	monkeypatch.setattr(id_db, "save_retry_items", lambda site_name, failed, recovered: None)
+	worker = ImageDownloader("shop", str(tmpdir))
+	worker.checker = ThreadPoolExecutor(1)
+	worker.retries = RetryQueue("shop", "test", [])
+	try:
+		# the images of the product are done with, their checks are not
+		worker.retry_done("a", IMAGES)
+		image = worker.check_image("a", "http://shop/a.jpg", str(tmpdir.join("a.jpg")), None, b"<html>Error</html>")
+	finally:
+		worker.checker.shutdown()
+
+	assert image == ("", None, id_imaging.INVALID)
+	assert worker.failed_items == 1
+	worker.retries.save()
+	assert worker.retries.due(10, datetime.datetime.now() + datetime.timedelta(days=1)) == {IMAGES: ["a"]}
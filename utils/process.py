@@ -1,9 +1,10 @@
+import collections
 import os
 import time
 import logging
-import queue
 import subprocess, threading
 import multiprocessing as mp
+import multiprocessing.connection
 
 
 class Command(object):
@@ -41,67 +42,247 @@ class ProcessTimeoutError(Exception):
 class ProcessPool(object):
     """
     The class represents pool of processes that do some jobs
-    The count of processes is determined by len() of data constructor argument
+    The count of processes is determined by poolLength constructor argument
+    Every process has a job queue and a result pipe of its own and is given the next job when it is idle:
+    a process killed while it waits for a job or puts its result would hold the lock of a shared queue
+    forever, that must not block the others. A process that dies is replaced by a new one,
+    the job it was running is lost.
+    If cost is given jobs are given out by cost(job) descending (longest first),
+    otherwise in the order of data.
+    Run() returns the list of values returned by worker, on_result(value, seconds)
+    is called in the parent process for each of them as soon as it arrives.
+    seconds is the time the job took in the worker.
+    context is the multiprocessing start method ("fork", "forkserver", "spawn"), the platform default if None.
+    With "forkserver" the modules named in preload are imported once in the fork server, so every
+    process starts with them loaded. initializer(*initargs) is called in every process before its first job.
+    initargs may be a function, then it is called in the parent for every process started and the process gets
+    what it returns, e.g. a pipe of its own. The connections among them are closed in the parent once the process
+    is started, so that the other end of such a pipe sees its end when the process is gone.
     Supports Ctrl-C. When hit stops all the child processes with KeyboardInterrupt,
     waits for them and finishes.
     """
 
-    def __init__(self, poolLength, worker, data):
+    STARTED = "started"
+    RESULT = "result"
+    EXIT = "exit"
+
+    # used in the parent process only, not sent to the children (cost and on_result may be closures)
+    PARENT_ONLY = ("data", "cost", "on_result", "initargs", "workers", "job_queues", "result_pipes", "idle", "pending", "running",
+                   "mp_context")
+
+    def __init__(self, poolLength, worker, data, cost=None, on_result=None,
+                 context=None, preload=None, initializer=None, initargs=()):
         self.poolLength = poolLength
         self.worker = worker
         self.data = data
+        self.cost = cost
+        self.on_result = on_result
+        self.context = context
+        self.preload = preload
+        self.initializer = initializer
+        self.initargs = initargs
         self.logger_name = "errors.log"
+        self.mp_context = None
+        self.workers = []
+        self.job_queues = {}
+        self.result_pipes = {}
+        self.idle = []
+        self.pending = collections.deque()
+        self.running = {}
 
     # end of __init__
 
-    def JobDispatcher(self, job_queue, result_queue):
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for name in self.PARENT_ONLY:
+            state[name] = None
+        return state
+
+    # end of __getstate__
+
+    def Context(self):
+        context = mp.get_context(self.context)
+        if self.context == "forkserver" and self.preload:
+            context.set_forkserver_preload(self.preload)
+        return context
+
+    # end of Context
+
+    def JobDispatcher(self, job_queue, result_queue, initargs):
+        if self.initializer:
+            self.initializer(*initargs)
+
         logger = logging.getLogger(self.logger_name)
         # logger = Logger.GetLogger(Logger.Type.Fw)
         logger.info("Process started: %d" % os.getpid())
         try:
-            while not job_queue.empty():
+            while True:
                 logger.info("Getting new job")
-                job = job_queue.get(block=False)
+                job = job_queue.get()
+                if job is None:
+                    break
                 logger.info("Job started: %s" % str(job) )
-                result_queue.put(self.worker(job))
+                result_queue.put((self.STARTED, (os.getpid(), job)))
+                started = time.time()
+                result = self.worker(job)
+                result_queue.put((self.RESULT, (os.getpid(), result, time.time() - started)))
                 logger.info("Job finished: %s" % str(job) )
-        except queue.Empty:
-            logger.warning("QUEUE EMPTY")
-            pass
+        finally:
+            result_queue.put((self.EXIT, os.getpid()))
 
         logger.info( "Exiting: %s" % str(os.getpid()) )
 
     # end of JobDispatcher
 
-    def Run(self):
+    def Jobs(self):
+        jobs = list(self.data)
+        if self.cost:
+            jobs.sort(key=self.cost, reverse=True)
+        return jobs
+
+    # end of Jobs
+
+    def StartWorker(self):
+        job_queue = self.mp_context.Queue()
+        reader, writer = self.mp_context.Pipe(duplex=False)
+        initargs = self.initargs() if callable(self.initargs) else self.initargs
+        worker = self.mp_context.Process(target=self.JobDispatcher, args=(job_queue, ResultPipe(writer), initargs))
+        worker.start()
+        # the pipes are at their end once the process is gone
+        writer.close()
+        for arg in initargs:
+            if isinstance(arg, mp.connection.Connection):
+                arg.close()
+        self.job_queues[worker.pid] = job_queue
+        self.result_pipes[worker.pid] = reader
+        self.idle.append(worker.pid)
+        return worker
+
+    # end of StartWorker
+
+    def Start(self):
+        self.mp_context = self.Context()
+        self.workers = [self.StartWorker() for _ in range(self.poolLength)]
+
+    # end of Start
+
+    def Submit(self, job):
+        self.pending.append(job)
+        self.Dispatch()
+
+    # end of Submit
+
+    def Dispatch(self):
+        while self.pending and self.idle:
+            pid = self.idle.pop(0)
+            job = self.pending.popleft()
+            self.running[pid] = job
+            self.job_queues[pid].put(job)
+
+    # end of Dispatch
+
+    def Receive(self, timeout):
+        """
+        Values returned by worker that arrive within timeout seconds, all that are there once something is
+        """
+        results = []
+        ready = mp.connection.wait(list(self.result_pipes.values()), timeout)
+        for pid, reader in list(self.result_pipes.items()):
+            if reader not in ready:
+                continue
+
+            try:
+                while reader.poll():
+                    kind, value = reader.recv()
+                    if kind != self.RESULT:
+                        continue
+
+                    _, result, seconds = value
+                    # the job is done, the process may still die before it gets the next one
+                    if self.running.pop(pid, None) is not None:
+                        self.idle.append(pid)
+                    results.append(result)
+                    if self.on_result:
+                        self.on_result(result, seconds)
+            except (EOFError, OSError):
+                # the process is gone
+                self.result_pipes.pop(pid).close()
+
+        return results
+
+    # end of Receive
+
+    def Results(self, timeout):
         logger = logging.getLogger(self.logger_name)
-        # logger = Logger.GetLogger(Logger.Type.Fw)
 
-        job_queue = mp.Queue()
-        result_queue = mp.Queue()
+        results = self.Receive(timeout)
+        lost = []
+        for i, worker in enumerate(self.workers):
+            if worker.is_alive():
+                continue
+            logger.error("----------------------------------Process %s died with exit code %s, starting a new one" %
+                         (worker.pid, worker.exitcode))
+            # what it sent before it died
+            results += self.Receive(0)
+            job = self.running.pop(worker.pid, None)
+            if job is not None:
+                lost.append(job)
+            if worker.pid in self.idle:
+                self.idle.remove(worker.pid)
+            self.job_queues.pop(worker.pid).close()
+            if worker.pid in self.result_pipes:
+                self.result_pipes.pop(worker.pid).close()
+            self.workers[i] = self.StartWorker()
+
+        self.Dispatch()
+        return results, lost
+
+    # end of Results
+
+    def Stop(self):
+        logger = logging.getLogger(self.logger_name)
+
+        self.pending.clear()
+        for worker in self.workers:
+            self.job_queues[worker.pid].put(None)
+
+        results = []
+        while any(worker.is_alive() for worker in self.workers):
+            results += self.Receive(1)
+        results += self.Receive(0)
 
-        for data in self.data:
-            job_queue.put(data)
+        for worker in self.workers:
+            logger.info("----------------------------------Joining process %s" % worker.pid)
+            worker.join()
 
-        workers = []
-        for _ in range(self.poolLength):
-            tmp = mp.Process(target=self.JobDispatcher,
-                             args=(job_queue, result_queue))
-            tmp.start()
-            workers.append(tmp)
+        return results
+
+    # end of Stop
+
+    def Run(self):
+        logger = logging.getLogger(self.logger_name)
+        # logger = Logger.GetLogger(Logger.Type.Fw)
+
+        self.Start()
+        self.pending.extend(self.Jobs())
+        self.Dispatch()
 
         logger.info("----------------------------------Started.")
         try:
-            for worker in workers:
-                logger.info("----------------------------------Joining process %s" % worker.pid)
-                worker.join()
+            results = []
+            while self.pending or self.running:
+                values, lost = self.Results(1)
+                results += values
+                for job in lost:
+                    logger.error("----------------------------------Job lost, its process died: %s" % str(job))
+            results += self.Stop()
         except KeyboardInterrupt:
             while True:
                 time.sleep(1)
                 logger.info("----------------------------------Waiting for child processes to finish outputting the results...")
 
                 aliveCount = 0
-                for worker in workers:
+                for worker in self.workers:
                     if worker.is_alive():
                         aliveCount += 1
 
@@ -111,9 +292,9 @@ class ProcessPool(object):
                     logger.info("----------------------------------Done!")
                     break
 
-            return result_queue
+            return []
 
-        return result_queue
+        return results
 
     # end of Run
 
@@ -121,18 +302,48 @@ class ProcessPool(object):
 
 
 class SilentProcessPool(ProcessPool):
-    def JobDispatcher(self, job_queue, result_queue):
+    def JobDispatcher(self, job_queue, result_queue, initargs):
 
-        super(SilentProcessPool, self).JobDispatcher(job_queue, result_queue)
+        super(SilentProcessPool, self).JobDispatcher(job_queue, result_queue, initargs)
 
     # end of JobDispatcher
 
 # end of SilentProcessPool
- 
 
 
+class ResultPipe(object):
+    """
+    The writing end of the result pipe of one process, put like into a queue, but synchronously and
+    without a lock shared with the other processes
+    """
 
+    def __init__(self, connection):
+        self.connection = connection
+
+    # end of __init__
 
+    def put(self, message):
+        self.connection.send(message)
 
+    # end of put
 
+# end of ResultPipe
+
+
+class ResidentProcessPool(ProcessPool):
+    """
+    Pool of processes that stay up between jobs, so they are started and warmed up once.
+    Start() starts the processes, Submit(job) queues a job, Results(timeout) returns
+    (values returned by worker, jobs lost) since the last call, waiting up to timeout seconds
+    for something to happen. A job is lost when its process died while running it,
+    such a process is replaced by a new one.
+    Stop() drops the jobs that did not start yet, lets the processes finish the running ones
+    and waits for them, their results are returned by Stop().
+    """
+
+    def __init__(self, poolLength, worker, on_result=None, **kwargs):
+        super(ResidentProcessPool, self).__init__(poolLength, worker, [], on_result=on_result, **kwargs)
+
+    # end of __init__
 
+# end of ResidentProcessPool